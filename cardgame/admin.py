@@ -7,7 +7,8 @@ Author: BLANK
 """
 
 from django.contrib import admin
-from .models import Card, UserProfile, Challenge, Question, Trade
+from .models import (Card, UserProfile, Challenge, Question, Trade,
+                     RenderJob)
 
 # Register your models here.
 admin.site.register(Card)
@@ -15,3 +16,4 @@ admin.site.register(UserProfile)
 admin.site.register(Challenge)
 admin.site.register(Question)
 admin.site.register(Trade)
+admin.site.register(RenderJob)
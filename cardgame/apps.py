@@ -13,5 +13,5 @@ class CardgameConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "cardgame"
 
-    # def ready(self):
-    # import cardgame.signals
+    def ready(self):
+        import cardgame.signals  # noqa: F401
@@ -0,0 +1,113 @@
+"""
+How battle events are framed on the websocket.
+
+Clients pick an encoding when they connect by offering websocket
+subprotocols, most preferred first:
+
+- battle.msgpack: binary msgpack frames (if msgpack is installed)
+- battle.orjson: binary frames of UTF-8 JSON encoded with orjson
+  (if orjson is installed)
+- battle.json: compact JSON text frames, always available
+
+Clients that offer no subprotocol, or none of these, get JSON text
+frames and the handshake is accepted without a subprotocol: a client
+must fail the connection if the server picks one it didn't offer.
+
+Events for a client are not sent one by one. EventBatcher collects the
+events produced in the same pass of the event loop and sends them as a
+single frame: the event itself if there is only one, otherwise
+{"event": "batch", "events": [...]}.
+"""
+
+import asyncio
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# binary says whether frames are sent as bytes_data instead of text_data
+Codec = namedtuple("Codec", ["subprotocol", "binary", "dumps", "loads"])
+
+JSON = Codec("battle.json", False,
+             lambda event: json.dumps(event, separators=(",", ":")),
+             json.loads)
+
+CODECS = {JSON.subprotocol: JSON}
+if orjson is not None:
+    CODECS["battle.orjson"] = Codec("battle.orjson", True,
+                                    orjson.dumps, orjson.loads)
+if msgpack is not None:
+    CODECS["battle.msgpack"] = Codec("battle.msgpack", True,
+                                     msgpack.packb, msgpack.unpackb)
+
+
+def negotiate(subprotocols):
+    """
+    Returns the Codec for the first of the client's subprotocols that the
+    server supports. Clients that offer none of them get plain JSON
+    without a subprotocol.
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol in CODECS:
+            return CODECS[subprotocol]
+    return JSON._replace(subprotocol=None)
+
+
+def decode(codec, text_data=None, bytes_data=None):
+    """Decodes a frame received from the client."""
+    if bytes_data is not None:
+        return codec.loads(bytes_data)
+    return json.loads(text_data)
+
+
+class EventBatcher:
+    """
+    Sends the events emitted for one websocket client, coalescing those
+    emitted in the same event loop pass into one frame.
+
+    Args:
+        consumer: the AsyncWebsocketConsumer to send through
+        codec: the negotiated Codec
+    """
+
+    def __init__(self, consumer, codec):
+        self.consumer = consumer
+        self.codec = codec
+        self._pending = []
+        self._flushing = None
+
+    def emit(self, event):
+        """Queues event to be sent once the current pass is over."""
+        self._pending.append(event)
+        if self._flushing is None:
+            self._flushing = asyncio.get_running_loop().create_task(
+                self.flush())
+
+    async def flush(self):
+        """Sends everything emitted so far as one frame."""
+        # Yields once, so everything emitted in this pass is included
+        await asyncio.sleep(0)
+        events, self._pending = self._pending, []
+        self._flushing = None
+        if not events:
+            return
+        frame = events[0] if len(events) == 1 \
+            else {"event": "batch", "events": events}
+        data = self.codec.dumps(frame)
+        if self.codec.binary:
+            await self.consumer.send(bytes_data=data)
+        else:
+            await self.consumer.send(text_data=data)
+
+    async def drain(self):
+        """Waits until every emitted event has been sent."""
+        while self._flushing is not None:
+            await self._flushing
@@ -0,0 +1,96 @@
+"""
+Clears finished and abandoned battles out of the Battle table.
+
+- Completed battles that haven't changed for BATTLE_ARCHIVE_AFTER seconds
+  (default 300) are archived as a BattleSummary and deleted with their
+  decks.
+- Battles that aren't completed but haven't changed for BATTLE_IDLE_TTL
+  seconds (default 3600), e.g. rooms nobody joined or left behind by a
+  crash, are deleted without a summary.
+
+Battles are handled batch_size at a time: each batch is read in one query
+and its deck cards, decks and battles are deleted with one query each, so
+the cost of a run grows with the number of batches, not of rows.
+
+Run it with `python manage.py reap_battles`.
+"""
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Battle, BattleDeck, BattleSummary
+
+BATCH_SIZE = 500
+POLL_SECONDS = 60
+
+SUMMARY_FIELDS = ("pk", "room_id", "player1_id", "player2_id",
+                  "player1_score", "player2_score", "winner_id",
+                  "created_at", "updated_at")
+
+
+def archive_after():
+    return timedelta(seconds=getattr(settings, "BATTLE_ARCHIVE_AFTER", 300))
+
+
+def idle_ttl():
+    return timedelta(seconds=getattr(settings, "BATTLE_IDLE_TTL", 3600))
+
+
+def delete_battles(battle_ids):
+    """Deletes the battles with battle_ids, their decks and deck cards."""
+    BattleDeck.cards.through.objects.filter(
+        battledeck__battle_id__in=battle_ids).delete()
+    BattleDeck.objects.filter(battle_id__in=battle_ids).delete()
+    Battle.objects.filter(pk__in=battle_ids).delete()
+
+
+def archive_completed(now=None, batch_size=BATCH_SIZE):
+    """Archives completed battles, returning how many there were."""
+    cutoff = (now or timezone.now()) - archive_after()
+    completed = Battle.objects.filter(status="completed",
+                                      updated_at__lt=cutoff)\
+        .order_by("pk").values(*SUMMARY_FIELDS)
+    archived = 0
+    while True:
+        with transaction.atomic():
+            batch = list(completed[:batch_size])
+            if not batch:
+                return archived
+            BattleSummary.objects.bulk_create(
+                BattleSummary(room_id=row["room_id"],
+                              player1_id=row["player1_id"],
+                              player2_id=row["player2_id"],
+                              player1_score=row["player1_score"],
+                              player2_score=row["player2_score"],
+                              winner_id=row["winner_id"],
+                              started_at=row["created_at"],
+                              finished_at=row["updated_at"])
+                for row in batch)
+            delete_battles([row["pk"] for row in batch])
+        archived += len(batch)
+
+
+def expire_idle(now=None, batch_size=BATCH_SIZE):
+    """Deletes abandoned battles, returning how many there were."""
+    cutoff = (now or timezone.now()) - idle_ttl()
+    idle = Battle.objects.exclude(status="completed")\
+        .filter(updated_at__lt=cutoff).order_by("pk")\
+        .values_list("pk", flat=True)
+    expired = 0
+    while True:
+        with transaction.atomic():
+            batch = list(idle[:batch_size])
+            if not batch:
+                return expired
+            delete_battles(batch)
+        expired += len(batch)
+
+
+def reap(now=None, batch_size=BATCH_SIZE):
+    """
+    Archives completed battles and expires idle ones. Returns how many
+    battles were archived and expired.
+    """
+    return (archive_completed(now, batch_size),
+            expire_idle(now, batch_size))
@@ -0,0 +1,259 @@
+"""
+In-memory state of running battles.
+
+Once both players are ready, a battle's shuffled decks, position and
+scores are loaded into a BattleState and kept in battle_states, keyed by
+room. Rounds are then played against that object instead of reloading the
+Battle, both BattleDecks and their cards on every websocket event. The
+database is only written at checkpoints: when the battle starts, at the
+end of each round and when it is completed. A process that doesn't have a
+room's state (e.g. after a restart) rebuilds it from the last checkpoint.
+
+With several worker processes the two players of a room may be served by
+different processes, each with its own copy of the state. Every round
+result is broadcast to the room, and observe() brings the copy of the
+other process up to date from it.
+"""
+
+import threading
+from collections import namedtuple
+from django.db import transaction
+from django.utils import timezone
+from .models import Battle, BattleDeck, Card
+
+STATS = ("environmental_friendliness", "beauty", "cost")
+
+# What a round needs to know about a card, captured when the battle
+# starts so that rounds don't touch the database.
+BattleCard = namedtuple("BattleCard",
+                        ["name", "image", "image_srcset",
+                         "environmental_friendliness", "beauty", "cost"])
+
+
+def battle_card(card):
+    has_image = bool(card.card_image_link)
+    return BattleCard(card.card_name,
+                      card.image_url("thumb") if has_image else None,
+                      card.image_srcset() if has_image else None,
+                      card.environmental_friendliness, card.beauty,
+                      card.cost)
+
+
+def card_dict(card, value=None):
+    result = card._asdict()
+    if value is not None:
+        result["value"] = value
+    return result
+
+
+class BattleError(Exception):
+    """A move that isn't allowed, with the message to send back."""
+
+
+class BattleState:
+    """
+    Everything needed to play the rounds of one battle.
+
+    Attributes:
+        room_id (str): The battle's room
+        battle_id (int): Primary key of the Battle row
+        user_ids (tuple): User ids of player 1 and player 2
+        decks (tuple): Each player's BattleCards, in playing order
+        index (int): How many rounds have been played
+        scores (list): Player 1's and player 2's scores
+        current_turn (int): 1 or 2, whoever picks the next stat
+    """
+
+    __slots__ = ("room_id", "battle_id", "user_ids", "decks", "index",
+                 "scores", "current_turn")
+
+    def __init__(self, room_id, battle_id, user_ids, decks, index=0,
+                 scores=(0, 0), current_turn=1):
+        self.room_id = room_id
+        self.battle_id = battle_id
+        self.user_ids = tuple(user_ids)
+        self.decks = tuple(decks)
+        self.index = index
+        self.scores = list(scores)
+        self.current_turn = current_turn
+
+    @classmethod
+    def load(cls, room_id):
+        """
+        Builds the state of a started battle from its last checkpoint.
+        Completed battles raise BattleError, so nothing can be played
+        in them again.
+        """
+        battle = Battle.objects.select_related("player1", "player2")\
+            .filter(room_id=room_id).exclude(status="completed").first()
+        if battle is None:
+            raise BattleError("This battle has ended")
+        if battle.player2 is None:
+            raise BattleError("Waiting for an opponent")
+        decks = {deck.player_id: deck for deck in
+                 BattleDeck.objects.filter(battle=battle)}
+        try:
+            p1_deck = decks[battle.player1_id]
+            p2_deck = decks[battle.player2_id]
+        except KeyError:
+            raise BattleError("Both players must select their cards")
+        # The decks store their shuffled order, so both players' cards
+        # come back in one query
+        orders = (p1_deck.play_order(), p2_deck.play_order())
+        cards = Card.objects.in_bulk(orders[0] + orders[1])
+        return cls(room_id, battle.pk,
+                   (battle.player1.user_id, battle.player2.user_id),
+                   tuple([battle_card(cards[name]) for name in order]
+                         for order in orders),
+                   index=min(p1_deck.current_card_index,
+                             p2_deck.current_card_index),
+                   scores=(battle.player1_score, battle.player2_score),
+                   current_turn=battle.current_turn)
+
+    def player(self, user):
+        """Returns 1 or 2 for the players of this battle, else None."""
+        try:
+            return self.user_ids.index(user.id) + 1
+        except ValueError:
+            return None
+
+    @property
+    def cards_remaining(self):
+        return min(len(deck) for deck in self.decks) - self.index
+
+    @property
+    def finished(self):
+        return self.cards_remaining <= 0
+
+    def current_cards(self, player):
+        """Returns the current_cards event for player (1 or 2)."""
+        mine, theirs = self.decks[player - 1], self.decks[2 - player]
+        opponent = theirs[self.index]
+        return {
+            "event": "current_cards",
+            "current_turn": self.current_turn,
+            "player1_score": self.scores[0],
+            "player2_score": self.scores[1],
+            "cards_remaining": self.cards_remaining,
+            "player_card": card_dict(mine[self.index]),
+            "opponent_card": {"name": opponent.name,
+                              "image": opponent.image,
+                              "image_srcset": opponent.image_srcset},
+            "is_my_turn": self.current_turn == player,
+        }
+
+    def play(self, player, stat):
+        """
+        Plays a round with player (1 or 2) choosing stat and returns the
+        round_result event. Raises BattleError for moves that aren't
+        allowed.
+        """
+        if stat not in STATS:
+            raise BattleError("Invalid stat selected")
+        if player != self.current_turn:
+            raise BattleError("Not your turn")
+        if self.finished:
+            raise BattleError("This battle has ended")
+
+        p1_card = self.decks[0][self.index]
+        p2_card = self.decks[1][self.index]
+        p1_value = getattr(p1_card, stat)
+        p2_value = getattr(p2_card, stat)
+        # For cost, lower is better; for other stats, higher is better
+        if p1_value == p2_value:
+            result = "tie"
+        elif (p1_value < p2_value) == (stat == "cost"):
+            self.scores[0] += 1
+            result = "player1"
+        else:
+            self.scores[1] += 1
+            result = "player2"
+
+        self.index += 1
+        self.current_turn = 2 if self.current_turn == 1 else 1
+        return {
+            "event": "round_result",
+            "notify_room": True,  # Send to both players
+            "stat": stat,
+            "p1_card": card_dict(p1_card, p1_value),
+            "p2_card": card_dict(p2_card, p2_value),
+            "result": result,
+            "player1_score": self.scores[0],
+            "player2_score": self.scores[1],
+            "next_turn": self.current_turn,
+            "cards_remaining": self.cards_remaining,
+        }
+
+    def checkpoint(self):
+        """Writes the scores, turn and position back to the database."""
+        with transaction.atomic():
+            Battle.objects.filter(pk=self.battle_id).update(
+                player1_score=self.scores[0],
+                player2_score=self.scores[1],
+                current_turn=self.current_turn,
+                updated_at=timezone.now())
+            BattleDeck.objects.filter(battle_id=self.battle_id).update(
+                current_card_index=self.index)
+
+
+class BattleStates:
+    """The BattleState of every running battle in this process."""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, room_id):
+        """Returns the state of room_id, loading it if needed."""
+        with self._lock:
+            state = self._states.get(room_id)
+        if state is None:
+            state = BattleState.load(room_id)
+            with self._lock:
+                state = self._states.setdefault(room_id, state)
+        return state
+
+    def cached(self, room_id):
+        with self._lock:
+            return self._states.get(room_id)
+
+    def start(self, room_id):
+        """(Re)loads the state of room_id, e.g. when its battle starts."""
+        state = BattleState.load(room_id)
+        with self._lock:
+            self._states[room_id] = state
+        return state
+
+    def discard(self, room_id):
+        with self._lock:
+            self._states.pop(room_id, None)
+
+    def observe(self, room_id, message):
+        """
+        Applies a round_result or battle_completed event of room_id that
+        may have been played in another process.
+        """
+        event = message.get("event")
+        if event == "battle_completed":
+            self.discard(room_id)
+            return
+        if event != "round_result":
+            return
+        with self._lock:
+            state = self._states.get(room_id)
+            if state is None:
+                return
+            index = min(len(deck) for deck in state.decks) \
+                - message["cards_remaining"]
+            if index > state.index:
+                state.index = index
+                state.scores = [message["player1_score"],
+                                message["player2_score"]]
+                state.current_turn = message["next_turn"]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._states)
+
+
+battle_states = BattleStates()
@@ -0,0 +1,442 @@
+"""
+A channel layer for running several ASGI worker processes on one host
+without a message broker.
+
+InMemoryChannelLayer only delivers messages inside one process, so every
+player of a battle room has to be connected to the same worker.
+SQLiteChannelLayer keeps group memberships and messages for other
+processes in a shared SQLite file instead:
+
+- Each process names its channels "<prefix>.<process id>!<suffix>", so
+  the sender knows which process a channel lives in. Messages for a
+  channel of the sending process go straight onto an asyncio queue, just
+  like with the in-memory layer.
+- Messages for other processes are rows in the mailbox table. Each
+  process reads its own rows and hands them to the waiting consumers.
+- After writing to a mailbox, the sender pokes the receiving process
+  through a Unix datagram socket, so delivery doesn't wait for a polling
+  interval. Where Unix sockets aren't available, processes poll every
+  poll_interval to max_poll_interval seconds instead.
+
+Enable it with CHANNEL_LAYER=sqlite in the environment (see
+cards/settings.py). The per-channel capacity only applies to channels of
+the receiving process, and "python manage.py bench_channel_layer" compares
+group_send throughput with the in-memory layer.
+"""
+
+import asyncio
+import atexit
+import base64
+import json
+import os
+import random
+import socket
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    process TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mailbox_process ON mailbox (process, id);
+CREATE INDEX IF NOT EXISTS mailbox_channel ON mailbox (channel, id);
+CREATE TABLE IF NOT EXISTS channel_groups (
+    group_name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    process TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (group_name, channel)
+);
+CREATE INDEX IF NOT EXISTS channel_groups_process
+    ON channel_groups (process);
+"""
+
+# How often expired messages and memberships are deleted, in seconds
+CLEANUP_INTERVAL = 30
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    raise TypeError(f"{type(value).__name__} can't be sent over a channel")
+
+
+def _object_hook(value):
+    if len(value) == 1 and "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+def encode(message):
+    return json.dumps(message, default=_default, separators=(",", ":"))
+
+
+def decode(body):
+    return json.loads(body, object_hook=_object_hook)
+
+
+def channel_process(channel):
+    """
+    Returns the id of the process a specific channel belongs to, or ""
+    for general channels.
+    """
+    local, bang, _ = channel.partition("!")
+    if not bang:
+        return ""
+    return local.rpartition(".")[2]
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer shared by the processes using the same SQLite file.
+
+    Args:
+        path: the SQLite file holding mailboxes and groups
+        socket_dir: where each process creates its wake-up socket
+        expiry: seconds before an undelivered message is dropped
+        group_expiry: seconds before a group membership is dropped
+        capacity: messages a channel can hold before ChannelFull
+        poll_interval: seconds between mailbox checks after a delivery
+        max_poll_interval: longest wait between mailbox checks
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, path="channels.sqlite3", socket_dir=None, expiry=60,
+                 group_expiry=86400, capacity=100, channel_capacity=None,
+                 poll_interval=0.005, max_poll_interval=0.5, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity,
+                         channel_capacity=channel_capacity, **kwargs)
+        self.path = str(path)
+        self.socket_dir = socket_dir or tempfile.gettempdir()
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.process_id = uuid.uuid4().hex[:12]
+        self._queues = {}
+        self._receivers = 0
+        self._poller = None
+        self._last_cleanup = 0.0
+        # Every database call runs on this one thread, which keeps them
+        # off the event loop and serialized on one connection.
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="channel-layer")
+        self._db = None
+        self._sender = None
+        self._sender_lock = threading.Lock()
+        # Bound straight away: a missing socket tells senders that the
+        # process has exited.
+        self._wake_socket = self._open_wake_socket()
+        atexit.register(self._remove_wake_socket)
+
+    # Database helpers, run on the executor thread
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=30,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _insert(self, rows):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT INTO mailbox (process, channel, expires, "
+                           "body) VALUES (?, ?, ?, ?)", rows)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _take_mail(self):
+        """Removes and returns this process's messages, oldest first."""
+        # Only this process reads its mailbox, so the rows can't be taken
+        # by anyone else between the read and the delete, and checking an
+        # empty mailbox doesn't need the write lock.
+        db = self._connection()
+        rows = db.execute("SELECT id, channel, expires, body FROM mailbox"
+                          " WHERE process = ? ORDER BY id",
+                          (self.process_id,)).fetchall()
+        if rows:
+            db.execute("DELETE FROM mailbox WHERE process = ? AND id <= ?",
+                       (self.process_id, rows[-1][0]))
+        return rows
+
+    def _take_general(self, channel):
+        db = self._connection()
+        row = db.execute("DELETE FROM mailbox WHERE id = (SELECT id FROM "
+                         "mailbox WHERE process = '' AND channel = ? "
+                         "AND expires >= ? ORDER BY id LIMIT 1) "
+                         "RETURNING body", (channel, time.time())).fetchone()
+        return row and row[0]
+
+    def _group_members(self, group):
+        return self._connection().execute(
+            "SELECT channel, process FROM channel_groups "
+            "WHERE group_name = ? AND expires >= ?",
+            (group, time.time())).fetchall()
+
+    def _cleanup(self):
+        db = self._connection()
+        now = time.time()
+        db.execute("DELETE FROM mailbox WHERE expires < ?", (now,))
+        db.execute("DELETE FROM channel_groups WHERE expires < ?", (now,))
+
+    def _forget_process(self, process):
+        """Drops the memberships and mail of a process that has exited."""
+        db = self._connection()
+        db.execute("DELETE FROM channel_groups WHERE process = ?", (process,))
+        db.execute("DELETE FROM mailbox WHERE process = ?", (process,))
+
+    # Waking up other processes
+
+    def _socket_path(self, process):
+        return os.path.join(self.socket_dir, f"chlayer-{process}.sock")
+
+    def _wake(self, processes):
+        """
+        Pokes the given processes to read their mailboxes. Returns the
+        processes whose socket is gone, i.e. which have exited.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            return []
+        gone = []
+        with self._sender_lock:
+            if self._sender is None:
+                self._sender = socket.socket(socket.AF_UNIX,
+                                             socket.SOCK_DGRAM)
+                self._sender.setblocking(False)
+            for process in processes:
+                try:
+                    self._sender.sendto(b"!", self._socket_path(process))
+                except (FileNotFoundError, ConnectionRefusedError):
+                    gone.append(process)
+                except OSError:
+                    # e.g. its socket buffer is full, so it is awake anyway
+                    pass
+        return gone
+
+    def _open_wake_socket(self):
+        if not hasattr(socket, "AF_UNIX"):
+            return None
+        path = self._socket_path(self.process_id)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(path)
+        except OSError:
+            sock.close()
+            return None
+        sock.setblocking(False)
+        return sock
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific"):
+        """
+        Returns a new channel name that can be used by something in this
+        process as a specific channel.
+        """
+        suffix = "".join(random.choice(string.ascii_letters)
+                         for _ in range(12))
+        return f"{prefix}.{self.process_id}!{suffix}"
+
+    def _local_put(self, channel, message):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(
+                maxsize=self.get_capacity(channel))
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    async def send(self, channel, message):
+        """Sends a message onto a (general or specific) channel."""
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+
+        process = channel_process(channel)
+        if process == self.process_id:
+            self._local_put(channel, deepcopy(message))
+            return
+        await self._run(self._insert, [(process, channel,
+                                        time.time() + self.expiry,
+                                        encode(message))])
+        if process:
+            await self._wake_processes({process})
+
+    async def _wake_processes(self, processes):
+        gone = self._wake(processes)
+        for process in gone:
+            await self._run(self._forget_process, process)
+
+    async def receive(self, channel):
+        """Receives the first message that arrives on channel."""
+        assert self.valid_channel_name(channel)
+        if channel_process(channel) != self.process_id:
+            return await self._receive_general(channel)
+
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(
+                maxsize=self.get_capacity(channel))
+        self._receivers += 1
+        self._ensure_poller()
+        try:
+            return await queue.get()
+        finally:
+            self._receivers -= 1
+            if queue.empty() and self._queues.get(channel) is queue:
+                del self._queues[channel]
+
+    async def _receive_general(self, channel):
+        delay = self.poll_interval
+        while True:
+            body = await self._run(self._take_general, channel)
+            if body is not None:
+                return decode(body)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    def _ensure_poller(self):
+        loop = asyncio.get_running_loop()
+        if self._poller is None or self._poller.done() \
+                or self._poller.get_loop() is not loop:
+            self._poller = loop.create_task(self._poll())
+
+    async def _poll(self):
+        """Moves this process's mail onto the local queues."""
+        loop = asyncio.get_running_loop()
+        delay = self.poll_interval
+        while self._receivers > 0:
+            rows = await self._run(self._take_mail)
+            now = time.time()
+            for _, channel, expires, body in rows:
+                if expires >= now:
+                    try:
+                        self._local_put(channel, decode(body))
+                    except ChannelFull:
+                        pass
+            if now - self._last_cleanup > CLEANUP_INTERVAL:
+                self._last_cleanup = now
+                await self._run(self._cleanup)
+
+            delay = self.poll_interval if rows \
+                else min(delay * 2, self.max_poll_interval)
+            await self._wait_for_mail(loop, delay)
+
+    async def _wait_for_mail(self, loop, delay):
+        if self._wake_socket is None:
+            await asyncio.sleep(delay)
+            return
+        try:
+            # Without a poke, still check now and then in case one was
+            # lost, e.g. because this process's socket buffer was full
+            await asyncio.wait_for(
+                loop.sock_recv(self._wake_socket, 512),
+                timeout=self.max_poll_interval)
+            # Drains any other pokes that arrived meanwhile
+            while True:
+                self._wake_socket.recv(512)
+        except (asyncio.TimeoutError, BlockingIOError):
+            pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """Adds the channel to a group."""
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self._run(self._execute,
+                        "INSERT OR REPLACE INTO channel_groups "
+                        "(group_name, channel, process, expires) "
+                        "VALUES (?, ?, ?, ?)",
+                        (group, channel, channel_process(channel),
+                         time.time() + self.group_expiry))
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        await self._run(self._execute,
+                        "DELETE FROM channel_groups "
+                        "WHERE group_name = ? AND channel = ?",
+                        (group, channel))
+
+    def _execute(self, sql, params=()):
+        self._connection().execute(sql, params)
+
+    async def group_send(self, group, message):
+        """
+        Sends message to every channel in group: straight onto the queues
+        of channels in this process, and with one write for the rest.
+        """
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        members = await self._run(self._group_members, group)
+
+        rows = []
+        remote = set()
+        body = None
+        expires = time.time() + self.expiry
+        for channel, process in members:
+            if process == self.process_id:
+                try:
+                    self._local_put(channel, deepcopy(message))
+                except ChannelFull:
+                    pass
+            else:
+                if body is None:
+                    body = encode(message)
+                rows.append((process, channel, expires, body))
+                if process:
+                    remote.add(process)
+        if rows:
+            await self._run(self._insert, rows)
+        if remote:
+            await self._wake_processes(remote)
+
+    # Flush extension
+
+    async def flush(self):
+        await self._run(self._flush)
+        self._queues = {}
+
+    def _flush(self):
+        db = self._connection()
+        db.execute("DELETE FROM mailbox")
+        db.execute("DELETE FROM channel_groups")
+
+    async def close(self):
+        """Leaves all groups and removes this process's wake-up socket."""
+        await self._run(self._forget_process, self.process_id)
+        self._remove_wake_socket()
+
+    def _remove_wake_socket(self):
+        if self._wake_socket is not None:
+            self._wake_socket.close()
+            self._wake_socket = None
+            try:
+                os.unlink(self._socket_path(self.process_id))
+            except FileNotFoundError:
+                pass
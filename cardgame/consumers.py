@@ -1,9 +1,18 @@
+import asyncio
 import json
 import random
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.db import transaction
 # from django.contrib.auth.models import User
 from .models import Battle, BattleDeck, UserProfile, Card
+from .battle_protocol import EventBatcher, decode, negotiate
+from .battle_state import (BattleError, battle_card, battle_states,
+                           card_dict)
+from .instrumentation import database_sync_to_async, instrumented
+from .points import award_battle
+from .matchmaking import matchmaking_queue, points_gap, widen_after
+from .trade_notifications import group_name as trade_group_name
 
 
 class BattleConsumer(AsyncWebsocketConsumer):
@@ -18,32 +27,31 @@ class BattleConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        # Agree on an encoding for the events (see battle_protocol)
+        self.codec = negotiate(self.scope.get('subprotocols'))
+        self.events = EventBatcher(self, self.codec)
+        await self.accept(subprotocol=self.codec.subprotocol)
 
         # Set up the battle or join existing one
         if self.user.is_authenticated:
             result = await self.setup_battle()
 
             # Send response to the connecting client
-            await self.send(text_data=json.dumps(result))
+            self.events.emit({k: v for k, v in result.items()
+                              if k != 'notify_room'})
 
             # If this is player 2 joining, notify the room
             if result.get('notify_room'):
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'battle_message',
-                        'message': {
-                            'event': 'user_connected',
-                            'username': result.get('username')
-                        }
-                    }
-                )
+                await self.notify_room({
+                    'event': 'user_connected',
+                    'username': result.get('username')
+                })
         else:
-            await self.send(text_data=json.dumps({
+            self.events.emit({
                 'event': 'error',
                 'message': 'You must be logged in to join a battle.'
-            }))
+            })
+            await self.events.drain()
             await self.close()
 
     async def disconnect(self, close_code):
@@ -57,6 +65,7 @@ class BattleConsumer(AsyncWebsocketConsumer):
         if self.user.is_authenticated:
             await self.handle_disconnect()
 
+    @instrumented("setup_battle")
     @database_sync_to_async
     def setup_battle(self):
         try:
@@ -157,14 +166,15 @@ class BattleConsumer(AsyncWebsocketConsumer):
                     battle.status = 'completed'
 
                 battle.save()
+                battle_states.discard(self.room_id)
                 return {'event': 'player_left', 'username': self.user.username}
 
         except Exception as e:
             return {'event': 'error', 'message': str(e)}
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = decode(self.codec, text_data, bytes_data)
         event = data.get('event', '')
 
         if event == 'request_state':
@@ -193,24 +203,35 @@ class BattleConsumer(AsyncWebsocketConsumer):
             result = {'event': 'error', 'message':
                       f'Unknown event type: {event}'}
 
-        # Send response to the requesting client
-        await self.send(text_data=json.dumps(result))
-
-        # If the event should be broadcast, send to the room
-        if result.get('notify_room'):
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'battle_message',
-                    'message': {k: v for k, v in result.items()
-                                if k != 'notify_room'}
-                }
-            )
+        # Handlers can return several events, e.g. the last round's
+        # result and the end of the battle
+        results = result if isinstance(result, list) else [result]
+        for result in results:
+            message = {k: v for k, v in result.items() if k != 'notify_room'}
+            # Send response to the requesting client
+            self.events.emit(message)
+
+            # If the event should be broadcast, send to the room
+            if result.get('notify_room'):
+                await self.notify_room(message)
 
+    async def notify_room(self, message):
+        """Sends message to everyone else in the room."""
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'battle_message',
+                'message': message,
+                # This consumer has already sent it to its own client
+                'sender': self.channel_name,
+            }
+        )
+
+    @instrumented("handle_select_cards")
     @database_sync_to_async
     def handle_select_cards(self, data):
         try:
-            card_ids = data.get('card_ids', [])
+            card_ids = set(data.get('card_ids', []))
             if len(card_ids) != 4:
                 return {'event': 'error', 'message':
                         'You must select exactly 4 cards'}
@@ -218,40 +239,49 @@ class BattleConsumer(AsyncWebsocketConsumer):
             user_profile = UserProfile.objects.get(user=self.user)
             battle = Battle.objects.get(room_id=self.room_id)
 
-            # Check if player has these cards
-            cards = Card.objects.filter(card_name__in=card_ids)
-            if cards.count() != 4:
+            # The selected cards that are in the player's collection
+            cards = {card.card_name: card for card in Card.objects.filter(
+                card_name__in=card_ids, userprofile=user_profile)}
+            if len(cards) != 4:
                 return {'event': 'error', 'message':
-                        'One or more cards not found'}
-
-            # Create or update battle deck
-            deck, created = BattleDeck.objects.get_or_create(
-                battle=battle,
-                player=user_profile,
-                defaults={
-                    'current_card_index': 0,
-                    'shuffle_seed': random.randint(1, 1000000)
-                }
-            )
-
-            # Clear existing cards and add new ones
-            deck.cards.clear()
+                        'You can only select cards in your collection'}
+
+            with transaction.atomic():
+                deck, created = BattleDeck.objects.get_or_create(
+                    battle=battle,
+                    player=user_profile,
+                    defaults={
+                        'current_card_index': 0,
+                        'shuffle_seed': random.randint(1, 1000000)
+                    }
+                )
 
-            for card in cards:
-                deck.cards.add(card)
+                # Replaces the deck's cards with one DELETE and one INSERT
+                through = BattleDeck.cards.through
+                if not created:
+                    through.objects.filter(battledeck=deck).delete()
+                through.objects.bulk_create(
+                    through(battledeck=deck, card_id=name) for name in cards)
 
-            deck.current_card_index = 0
-            deck.save()
+                # Fixes the order the cards are played in once, here
+                deck.shuffle(cards)
+                deck.current_card_index = 0
+                deck.save(update_fields=['card_order', 'current_card_index'])
+            battle_states.discard(self.room_id)
 
             return {
                 'event': 'cards_selected',
                 'username': self.user.username,
-                'message': f'{self.user.username} has selected their cards'
+                'message': f'{self.user.username} has selected their cards',
+                # The deck in playing order, so it needn't be fetched again
+                'deck': [card_dict(battle_card(cards[name]))
+                         for name in deck.card_order],
             }
 
         except Exception as e:
             return {'event': 'error', 'message': str(e)}
 
+    @instrumented("handle_player_ready")
     @database_sync_to_async
     def handle_player_ready(self):
         """
@@ -277,6 +307,10 @@ class BattleConsumer(AsyncWebsocketConsumer):
 
             battle.save()
 
+            # The battle's state is kept in memory from now on
+            if both_ready and battle.status == 'in_progress':
+                battle_states.start(self.room_id)
+
             return {
                 'event': 'player_ready',
                 'notify_room': True,
@@ -290,189 +324,82 @@ class BattleConsumer(AsyncWebsocketConsumer):
             return {'event': 'error', 'message': str(e)}
 
     @database_sync_to_async
-    def handle_request_current_cards(self):
-        try:
-            battle = Battle.objects.get(room_id=self.room_id)
-            is_player1 = battle.player1.user == self.user
+    def load_state(self):
+        return battle_states.get(self.room_id)
 
-            # Get current decks for both players
-            p1_deck = BattleDeck.objects.get(battle=battle,
-                                             player=battle.player1)
-            p2_deck = BattleDeck.objects.get(battle=battle,
-                                             player=battle.player2)
+    async def battle_state(self):
+        """Returns this room's BattleState, loading it on first use."""
+        return battle_states.cached(self.room_id) or await self.load_state()
 
-            p1_cards = list(p1_deck.cards.all())
-            p2_cards = list(p2_deck.cards.all())
-
-            # Use the stored seeds to shuffle consistently but differently
-            random.Random(p1_deck.shuffle_seed).shuffle(p1_cards)
-            random.Random(p2_deck.shuffle_seed).shuffle(p2_cards)
+    @instrumented("handle_request_current_cards")
+    async def handle_request_current_cards(self):
+        try:
+            state = await self.battle_state()
+            player = state.player(self.user)
+            if player is None:
+                return {'event': 'error',
+                        'message': 'You are not in this battle'}
 
             # Check if we've reached the end of the cards
-            if p1_deck.current_card_index >= len(p1_cards)\
-                    or p2_deck.current_card_index >= len(p2_cards):
-                return self.end_battle(battle)
-
-            # Get the current card for each player
-            p1_card = p1_cards[p1_deck.current_card_index]\
-                if p1_deck.current_card_index < len(p1_cards) else None
-
-            p2_card = p2_cards[p2_deck.current_card_index]\
-                if p2_deck.current_card_index < len(p2_cards) else None
-
-            # If either card is None, we can't continue
-            if not p1_card or not p2_card:
-                return {'event': 'error', 'message': 'Cards not available'}
-
-            # Create the result with common data for both players
-            result = {
-                'event': 'current_cards',
-                'current_turn': battle.current_turn,
-                'player1_score': battle.player1_score,
-                'player2_score': battle.player2_score,
-                'cards_remaining':
-                min(len(p1_cards) - p1_deck.current_card_index,
-                    len(p2_cards) - p2_deck.current_card_index)
-            }
-
-            if is_player1:
-                result['player_card'] = self.card_to_dict(p1_card)
-                result['opponent_card'] = {
-                    'name': p2_card.card_name,
-                    'image': p2_card.card_image_link.url
-                    if p2_card.card_image_link else None
-                }
-                result['is_my_turn'] = battle.current_turn == 1
-            else:
-                result['player_card'] = self.card_to_dict(p2_card)
-                result['opponent_card'] = {
-                    'name': p1_card.card_name,
-                    'image': p1_card.card_image_link.url
-                    if p1_card.card_image_link else None
-                }
-                result['is_my_turn'] = battle.current_turn == 2
+            if state.finished:
+                return await self.finish_battle(state)
 
-            return result
+            return state.current_cards(player)
 
+        except BattleError as e:
+            return {'event': 'error', 'message': str(e)}
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {'event': 'error', 'message': str(e)}
 
-    @database_sync_to_async
-    def handle_select_stat(self, data):
+    @instrumented("handle_select_stat")
+    async def handle_select_stat(self, data):
         try:
-            stat = data.get('stat')
-            if stat not in ['environmental_friendliness', 'beauty', 'cost']:
-                return {'event': 'error', 'message': 'Invalid stat selected'}
-
-            battle = Battle.objects.get(room_id=self.room_id)
-            is_player1 = battle.player1.user == self.user
-
-            # Verify it's this player's turn
-            if (is_player1 and battle.current_turn != 1)\
-                    or (not is_player1 and battle.current_turn != 2):
-                return {'event': 'error', 'message': 'Not your turn'}
-
-            # Get current decks and cards
-            p1_deck = BattleDeck.objects.get(battle=battle,
-                                             player=battle.player1)
-            p2_deck = BattleDeck.objects.get(battle=battle,
-                                             player=battle.player2)
-
-            p1_cards = list(p1_deck.cards.all())
-            p2_cards = list(p2_deck.cards.all())
-
-            # Use the stored seeds to shuffle consistently - THIS IS THE FIX
-            random.Random(p1_deck.shuffle_seed).shuffle(p1_cards)
-            random.Random(p2_deck.shuffle_seed).shuffle(p2_cards)
-
-            # Check if we've reached the end of the battle
-            if p1_deck.current_card_index >= len(p1_cards)\
-                    or p2_deck.current_card_index >= len(p2_cards):
-                return self.end_battle(battle)
-
-            # Get current cards
-            p1_card = p1_cards[p1_deck.current_card_index]
-            p2_card = p2_cards[p2_deck.current_card_index]
-
-            # Compare stats and determine winner
-            p1_value = getattr(p1_card, stat)
-            p2_value = getattr(p2_card, stat)
-
-            # For cost, lower is better
-            if stat == 'cost':
-                p1_wins = p1_value < p2_value
-                tie = p1_value == p2_value
-            else:
-                # For other stats, higher is better
-                p1_wins = p1_value > p2_value
-                tie = p1_value == p2_value
-
-            # Simple scoring system
-            if tie:
-                result = "tie"
-                # No points awarded for ties
-            elif p1_wins:
-                battle.player1_score += 1
-                result = "player1"
-            else:
-                battle.player2_score += 1
-                result = "player2"
-
-            # Move to next cards
-            p1_deck.current_card_index += 1
-            p2_deck.current_card_index += 1
-            p1_deck.save()
-            p2_deck.save()
-
-            # Switch turns
-            battle.current_turn = 2 if battle.current_turn == 1 else 1
-            battle.save()
+            state = await self.battle_state()
+            if state.finished:
+                return await self.finish_battle(state)
 
-            # Create full response with all card
-            # details visible to both players
-            response = {
-                'event': 'round_result',
-                'notify_room': True,  # Send to both players
-                'stat': stat,
-                'p1_card': self.card_to_dict(p1_card, p1_value),
-                'p2_card': self.card_to_dict(p2_card, p2_value),
-                'result': result,
-                'player1_score': battle.player1_score,
-                'player2_score': battle.player2_score,
-                'next_turn': battle.current_turn,
-                'cards_remaining':
-                min(len(p1_cards) - p1_deck.current_card_index,
-                    len(p2_cards) - p2_deck.current_card_index)
-            }
+            # Plays the round in memory, then checkpoints its result
+            response = state.play(state.player(self.user), data.get('stat'))
+            await database_sync_to_async(state.checkpoint)()
 
-            # If this was the last card, end the battle
+            # If this was the last card, end the battle. Both events go
+            # out together.
             if response['cards_remaining'] <= 0:
-                end_result = self.end_battle(battle)
-                if end_result:
-                    return end_result
+                end_result = await self.finish_battle(state)
+                if end_result['event'] == 'battle_completed':
+                    return [response, end_result]
 
             return response
 
+        except BattleError as e:
+            return {'event': 'error', 'message': str(e)}
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {'event': 'error', 'message': str(e)}
 
-    def card_to_dict(self, card, value=None):
-        """Helper method to convert a card to a dictionary"""
-        result = {
-            'name': card.card_name,
-            'image': card.card_image_link.url
-            if card.card_image_link else None,
-            'environmental_friendliness': card.environmental_friendliness,
-            'beauty': card.beauty,
-            'cost': card.cost
-        }
-        if value is not None:
-            result['value'] = value
-        return result
+    @database_sync_to_async
+    def finish_battle(self, state):
+        """
+        Completes the battle with the scores from state. Only the call
+        that marks the battle completed ends it and awards the points;
+        any other, e.g. for a replayed select_stat, gets an error.
+        """
+        battle_states.discard(self.room_id)
+        with transaction.atomic():
+            if not Battle.objects.filter(pk=state.battle_id)\
+                    .exclude(status='completed')\
+                    .update(status='completed'):
+                return {'event': 'error', 'message': 'This battle has ended'}
+            battle = Battle.objects.select_related(
+                'player1__user', 'player2__user').get(pk=state.battle_id)
+            battle.player1_score, battle.player2_score = state.scores
+            battle.current_turn = state.current_turn
+            BattleDeck.objects.filter(battle=battle).update(
+                current_card_index=state.index)
+            return self.end_battle(battle)
 
     def end_battle(self, battle):
         """Helper method to end the battle and award points"""
@@ -486,25 +413,8 @@ class BattleConsumer(AsyncWebsocketConsumer):
         battle.status = 'completed'
         battle.save()
 
-        # Award points to users
-        if battle.winner:
-            if battle.winner == battle.player1:
-                # Winner gets 10 points
-                battle.player1.user_profile_points += 10
-                # Loser gets 2 points
-                battle.player2.user_profile_points += 2
-            else:
-                battle.player2.user_profile_points += 10
-                battle.player1.user_profile_points += 2
-
-            battle.player1.save()
-            battle.player2.save()
-        else:
-            # In case of a tie, both get 5 points
-            battle.player1.user_profile_points += 5
-            battle.player2.user_profile_points += 5
-            battle.player1.save()
-            battle.player2.save()
+        # Winner gets 10 points and loser 2, or 5 each for a tie
+        award_battle(battle)
 
         return {
             'event': 'battle_completed',
@@ -517,6 +427,7 @@ class BattleConsumer(AsyncWebsocketConsumer):
             'player2_name': battle.player2.user.username
         }
 
+    @instrumented("get_current_state")
     @database_sync_to_async
     def get_current_state(self):
         try:
@@ -551,4 +462,115 @@ class BattleConsumer(AsyncWebsocketConsumer):
     # Send message to WebSocket
     async def battle_message(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps(message))
+        # The round may have been played by a consumer in another process
+        battle_states.observe(self.room_id, message)
+        if event.get('sender') != self.channel_name:
+            self.events.emit(message)
+
+
+class MatchmakingConsumer(AsyncWebsocketConsumer):
+    """
+    Puts the player in the matchmaking queue and, once they're paired,
+    tells both players which room their battle is in.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.widening = None
+        await self.accept()
+        if not self.user.is_authenticated:
+            await self.send_event({
+                'event': 'error',
+                'message': 'You must be logged in to find a battle.'
+            })
+            await self.close()
+            return
+
+        self.profile = await self.get_profile()
+        opponent = matchmaking_queue.join(self.channel_name,
+                                          self.profile.pk,
+                                          self.user.username,
+                                          self.profile.user_profile_points,
+                                          max_gap=points_gap())
+        if opponent is None:
+            await self.send_event({'event': 'queued',
+                                   'waiting': len(matchmaking_queue)})
+            self.widening = asyncio.get_running_loop().create_task(
+                self.widen())
+            return
+        await self.start_battle(opponent)
+
+    async def disconnect(self, close_code):
+        matchmaking_queue.leave(self.channel_name)
+        if self.widening is not None:
+            self.widening.cancel()
+
+    async def widen(self):
+        """Stops insisting on a close opponent after a while."""
+        await asyncio.sleep(widen_after())
+        opponent = matchmaking_queue.rematch(self.channel_name)
+        if opponent is not None:
+            await self.start_battle(opponent)
+
+    async def start_battle(self, opponent):
+        # The player who waited is player 1 of a battle created for both
+        room_id = await self.create_battle(opponent.profile_id, self.profile)
+        await self.channel_layer.send(opponent.channel_name, {
+            'type': 'match_found',
+            'room_id': room_id,
+            'opponent_name': self.user.username,
+        })
+        await self.send_event({'event': 'match_found', 'room_id': room_id,
+                               'opponent_name': opponent.username})
+
+    async def send_event(self, event):
+        await self.send(text_data=json.dumps(event))
+
+    @database_sync_to_async
+    def get_profile(self):
+        return UserProfile.objects.get(user=self.user)
+
+    @database_sync_to_async
+    def create_battle(self, player1_id, player2):
+        battle = Battle.objects.create(room_id=uuid.uuid4().hex,
+                                       player1_id=player1_id,
+                                       player2=player2,
+                                       status='selecting')
+        return battle.room_id
+
+    async def match_found(self, event):
+        await self.send_event({'event': 'match_found',
+                               'room_id': event['room_id'],
+                               'opponent_name': event['opponent_name']})
+
+
+class TradeNotificationConsumer(AsyncWebsocketConsumer):
+    """
+    Tells a player about trades made to them, and about their trades
+    being accepted or cancelled, as it happens (see
+    trade_notifications).
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.group_name = None
+        await self.accept()
+        if not self.user.is_authenticated:
+            await self.send(text_data=json.dumps({
+                'event': 'error',
+                'message': 'You must be logged in to see your trades.'
+            }))
+            await self.close()
+            return
+        self.group_name = trade_group_name(self.user.pk)
+        await self.channel_layer.group_add(self.group_name,
+                                           self.channel_name)
+
+    async def disconnect(self, close_code):
+        if self.group_name is not None:
+            await self.channel_layer.group_discard(self.group_name,
+                                                   self.channel_name)
+
+    async def trade_event(self, event):
+        await self.send(text_data=json.dumps({'event': event['event'],
+                                              'trade': event['trade']}))
@@ -0,0 +1,170 @@
+"""
+Timing and query counts for the BattleConsumer handlers.
+
+Handlers decorated with @instrumented("name") record, for every call:
+
+- wall_ms: how long the handler took
+- sync_ms: how much of that was spent in database_sync_to_async calls,
+  including waiting for the thread they run in
+- queries: how many SQL queries those calls made
+
+and errors, how many calls returned (or raised) an error. Each is kept
+as a Histogram in metrics, which the metrics view serves as JSON. Like
+everything else kept in memory, the figures are per process.
+
+For sync_ms and queries to be recorded, the consumer must use the
+database_sync_to_async from this module instead of the one in
+channels.db. It is a drop-in replacement that does nothing extra when
+no instrumented handler is running.
+"""
+
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+from channels.db import database_sync_to_async as channels_sync_to_async
+from django.db import connection
+
+# Upper bounds of the histogram buckets, in ms for times
+TIME_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Counts of observed values by bucket, with their sum."""
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last count is for values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        buckets = {str(bound): count
+                   for bound, count in zip(self.bounds, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class Metrics:
+    """The histograms of every instrumented handler."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, wall, measurement, error):
+        with self._lock:
+            handler = self._handlers.get(name)
+            if handler is None:
+                handler = self._handlers[name] = {
+                    "wall_ms": Histogram(TIME_BUCKETS),
+                    "sync_ms": Histogram(TIME_BUCKETS),
+                    "queries": Histogram(QUERY_BUCKETS),
+                    "errors": 0,
+                }
+            handler["wall_ms"].observe(wall * 1000)
+            handler["sync_ms"].observe(measurement.sync_seconds * 1000)
+            handler["queries"].observe(measurement.queries)
+            handler["errors"] += error
+
+    def as_dict(self):
+        with self._lock:
+            return {name: {key: value if key == "errors"
+                           else value.as_dict()
+                           for key, value in handler.items()}
+                    for name, handler in sorted(self._handlers.items())}
+
+    def clear(self):
+        with self._lock:
+            self._handlers.clear()
+
+
+metrics = Metrics()
+
+
+class Measurement:
+    """What one handler call has spent so far."""
+
+    __slots__ = ("sync_seconds", "queries")
+
+    def __init__(self):
+        self.sync_seconds = 0
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installed with connection.execute_wrapper to count queries
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+# asgiref copies the context into the thread database_sync_to_async
+# calls run in, so the measurement is visible there too
+_measurement = contextvars.ContextVar("measurement", default=None)
+
+
+def is_error(result):
+    results = result if isinstance(result, list) else [result]
+    return any(isinstance(r, dict) and r.get("event") == "error"
+               for r in results)
+
+
+def instrumented(name):
+    """Records the time, sync time and queries of an async handler."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            measurement = Measurement()
+            token = _measurement.set(measurement)
+            start = time.perf_counter()
+            error = True
+            try:
+                result = await handler(*args, **kwargs)
+                error = is_error(result)
+                return result
+            finally:
+                _measurement.reset(token)
+                metrics.observe(name, time.perf_counter() - start,
+                                measurement, error)
+        return wrapper
+    return decorator
+
+
+def database_sync_to_async(func):
+    """
+    channels.db.database_sync_to_async, also adding the call's time and
+    queries to the measurement of the instrumented handler making it.
+    """
+    @functools.wraps(func)
+    def counted(*args, **kwargs):
+        measurement = _measurement.get()
+        if measurement is None:
+            return func(*args, **kwargs)
+        # Connecting first, as wrappers added when the connection is
+        # created (see connection_created) would be popped in its place
+        connection.ensure_connection()
+        with connection.execute_wrapper(measurement):
+            return func(*args, **kwargs)
+
+    hop = channels_sync_to_async(counted)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        measurement = _measurement.get()
+        if measurement is None:
+            return await hop(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await hop(*args, **kwargs)
+        finally:
+            measurement.sync_seconds += time.perf_counter() - start
+    return wrapper
@@ -0,0 +1,162 @@
+"""
+In-process leaderboard of every profile ranked by points.
+
+The ranking is kept in a sorted list, so the top players are a slice
+and a player's rank is a binary search, instead of sorting the whole
+UserProfile table on every poll. Code that changes a profile's points
+calls record(profile), which moves that one entry to its committed
+points once the transaction commits. The list is loaded from the
+database on first use and reloaded every LEADERBOARD_TTL seconds
+(default 30), so changes made by other processes show up too.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from bisect import bisect_left, insort
+from django.conf import settings
+from django.db import transaction
+from .models import UserProfile
+
+TOP_SIZE = 5
+
+
+class Leaderboard:
+    """
+    Profiles sorted by points, highest first.
+
+    Entries are (-points, profile id) tuples, so that ties are broken the
+    same way every time and a profile's entry can be found by bisection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._profiles = {}  # profile id -> (points, username)
+        self._loaded_at = None
+        self._top_json = None
+
+    def _ttl(self):
+        return getattr(settings, "LEADERBOARD_TTL", 30)
+
+    def _ensure_loaded(self):
+        # Called with the lock held
+        if self._loaded_at is not None \
+                and time.monotonic() - self._loaded_at < self._ttl():
+            return
+        rows = UserProfile.objects.values_list(
+            "pk", "user_profile_points", "user__username")
+        self._profiles = {pk: (points, name) for pk, points, name in rows}
+        self._keys = sorted((-points, pk)
+                            for pk, (points, _) in self._profiles.items())
+        self._loaded_at = time.monotonic()
+        self._top_json = None
+
+    def update(self, profile_id, points, username):
+        """Moves one profile to its place for points, in O(log n) search."""
+        with self._lock:
+            if self._loaded_at is None:
+                # Nothing to keep in step yet; the first read loads it all
+                return
+            self._move(profile_id, points, username)
+
+    def refresh(self, profile_id, username):
+        """
+        Moves one profile to its place for its committed points. The
+        points are read with the lock held, so when changes commit close
+        together the last one applied is always the latest.
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            points = UserProfile.objects.filter(pk=profile_id)\
+                .values_list("user_profile_points", flat=True).first()
+            if points is not None:
+                self._move(profile_id, points, username)
+
+    def _move(self, profile_id, points, username):
+        # Called with the lock held
+        old = self._profiles.get(profile_id)
+        if old is not None:
+            i = bisect_left(self._keys, (-old[0], profile_id))
+            if i < len(self._keys) \
+                    and self._keys[i] == (-old[0], profile_id):
+                del self._keys[i]
+        insort(self._keys, (-points, profile_id))
+        self._profiles[profile_id] = (points, username)
+        self._top_json = None
+
+    def remove(self, profile_id):
+        with self._lock:
+            old = self._profiles.pop(profile_id, None)
+            if old is not None:
+                i = bisect_left(self._keys, (-old[0], profile_id))
+                if i < len(self._keys) \
+                        and self._keys[i] == (-old[0], profile_id):
+                    del self._keys[i]
+                self._top_json = None
+
+    def top(self, n=TOP_SIZE):
+        """Returns the n best players as username/points dicts."""
+        with self._lock:
+            self._ensure_loaded()
+            return [{"username": self._profiles[pk][1], "points": -neg}
+                    for neg, pk in self._keys[:n]]
+
+    def top_json(self):
+        """
+        Returns the encoded top players and an ETag for them. Both are
+        cached until the top of the board changes.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._top_json is None:
+                body = json.dumps(
+                    [{"username": self._profiles[pk][1], "points": -neg}
+                     for neg, pk in self._keys[:TOP_SIZE]]).encode()
+                self._top_json = (body, hashlib.sha1(body).hexdigest())
+            return self._top_json
+
+    def rank(self, profile):
+        """
+        Returns profile's 1-based rank, with tied players sharing a rank.
+        Falls back to counting in the database for profiles the board
+        doesn't know about yet.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            known = self._profiles.get(profile.pk)
+            if known is not None:
+                return bisect_left(self._keys, (-known[0],)) + 1
+        return UserProfile.objects.filter(
+            user_profile_points__gt=profile.user_profile_points).count() + 1
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._keys)
+
+    def clear(self):
+        """Forgets everything; the next read reloads from the database."""
+        with self._lock:
+            self._keys = []
+            self._profiles = {}
+            self._loaded_at = None
+            self._top_json = None
+
+
+leaderboard = Leaderboard()
+
+
+def record(profile):
+    """
+    Updates profile's place on the leaderboard once the current
+    transaction commits. Call it after saving a change to its points.
+    The points are read again then, as other changes may have committed
+    first.
+    """
+    profile_id = profile.pk
+    username = profile.user.username
+    transaction.on_commit(
+        lambda: leaderboard.refresh(profile_id, username))
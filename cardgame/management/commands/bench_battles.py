@@ -0,0 +1,296 @@
+"""
+Load-tests the battle websocket protocol, e.g.
+    python manage.py bench_battles --pairs 50 --output report.json
+
+Synthetic pairs of players drive BattleConsumer end to end through
+channels.testing.WebsocketCommunicator, in this process and against a
+throwaway test database: they connect, select 4 cards, ready up and play
+every round. Three runs are made:
+
+- latency: --pairs battles at once, timing every request from sending
+  it to receiving its reply (p50/p95/p99 per event)
+- memory: the same with tracemalloc on, measuring how much memory is
+  held per room once every battle has started (this includes the test
+  clients' side of each connection)
+- queries: a single battle, counting the database queries made for each
+  event, which concurrent battles would make impossible to attribute
+
+The report is written as JSON so runs can be compared over time.
+"""
+
+import asyncio
+import gc
+import json
+import platform
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from cardgame.models import Card, UserProfile
+from cardgame.routing import websocket_urlpatterns
+
+STATS = ("environmental_friendliness", "beauty", "cost")
+ROUNDS = 4
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the sorted list values."""
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class QueryCounter:
+    """Counts the queries made on every database connection."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Timings:
+    """Latencies, in seconds, and query counts by event."""
+
+    def __init__(self, counter=None):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.counter = counter
+
+    def latency_report(self):
+        report = {}
+        for event, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            report[event] = {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return report
+
+    def query_report(self):
+        # The most queries any one request made, e.g. the select_stat
+        # that ends the battle
+        return {event: max(counts)
+                for event, counts in sorted(self.queries.items())}
+
+
+class Player:
+    """One synthetic player's connection to a battle room."""
+
+    def __init__(self, user, room_id, timings, timeout):
+        self.communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/battle/{room_id}/",
+            subprotocols=["battle.orjson", "battle.json"])
+        self.communicator.scope["user"] = user
+        self.timings = timings
+        self.timeout = timeout
+        self.received = []
+        self.read = 0
+
+    async def receive(self, event, **match):
+        """Returns the next event of the given type, unpacking batches."""
+        start = self.read
+        while True:
+            for i in range(start, len(self.received)):
+                message = self.received[i]
+                if message["event"] == "error":
+                    raise RuntimeError(message["message"])
+                if message["event"] == event and all(
+                        message.get(k) == v for k, v in match.items()):
+                    self.read = i + 1
+                    return message
+            start = len(self.received)
+            frame = json.loads(
+                await self.communicator.receive_from(timeout=self.timeout))
+            self.received.extend(frame["events"]
+                                 if frame["event"] == "batch" else [frame])
+
+    async def request(self, name, send, reply, **match):
+        """Sends a request and times how long its reply takes."""
+        counter = self.timings.counter
+        queries = counter.count if counter else 0
+        start = time.perf_counter()
+        await send()
+        message = await self.receive(reply, **match)
+        self.timings.latencies[name].append(time.perf_counter() - start)
+        if counter:
+            self.timings.queries[name].append(counter.count - queries)
+        return message
+
+    async def connect(self, reply):
+        async def send():
+            await self.communicator.connect(timeout=self.timeout)
+        return await self.request("connect", send, reply)
+
+    async def send(self, event, reply, match=None, **data):
+        async def send():
+            await self.communicator.send_json_to({"event": event, **data})
+        return await self.request(event, send, reply, **(match or {}))
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+async def play_battle(room_id, users, decks, timings, timeout,
+                      started=None, go=None):
+    """
+    Plays one battle between users with decks. If started and go are
+    given, waits on started once the battle has begun and then on go.
+    """
+    p1, p2 = (Player(user, room_id, timings, timeout) for user in users)
+    await p1.connect("battle_created")
+    await p2.connect("battle_joined")
+    for player, deck in ((p1, decks[0]), (p2, decks[1])):
+        await player.send("select_cards", "cards_selected", card_ids=deck)
+    for player in (p1, p2):
+        await player.send("ready", "player_ready")
+    if started is not None:
+        await started.wait()
+        await go.wait()
+
+    for round_number in range(ROUNDS):
+        cards = await p1.send("request_current_cards", "current_cards")
+        player, other = (p1, p2) if cards["is_my_turn"] else (p2, p1)
+        remaining = ROUNDS - 1 - round_number
+        await player.send("select_stat", "round_result",
+                          stat=random.choice(STATS),
+                          match={"cards_remaining": remaining})
+        await other.receive("round_result", cards_remaining=remaining)
+    await p1.receive("battle_completed")
+    await p2.receive("battle_completed")
+    await p1.disconnect()
+    await p2.disconnect()
+
+
+class Command(BaseCommand):
+    help = "Measures how many battles the websocket protocol sustains"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pairs", type=int, default=20,
+                            help="battles to play at the same time")
+        parser.add_argument("--timeout", type=float, default=30,
+                            help="seconds to wait for any reply")
+        parser.add_argument("--output", help="file for the JSON report "
+                            "(default: stdout)")
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = self.run(options["pairs"], options["timeout"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        data = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(data + "\n")
+        else:
+            self.stdout.write(data)
+
+    def make_players(self, pairs):
+        now = timezone.now()
+        User.objects.bulk_create(
+            User(username=f"bench{i}", password="!") for i in range(2 * pairs))
+        users = list(User.objects.filter(username__startswith="bench")
+                     .order_by("pk"))
+        UserProfile.objects.bulk_create(
+            UserProfile(user=user, user_signup_date=now) for user in users)
+        names = []
+        for i in range(2 * ROUNDS):
+            card = Card.objects.create(
+                card_name=f"Bench{i}", card_subtitle="Bench",
+                card_description="Bench", environmental_friendliness=i,
+                beauty=(i * 3) % 8, cost=(i * 5) % 8)
+            names.append(card.card_name)
+        # Players can only select cards in their collection
+        through = UserProfile.user_profile_collected_cards.through
+        through.objects.bulk_create(
+            through(userprofile_id=user.pk, card_id=name)
+            for user in users for name in names)
+        return ([(users[2 * i], users[2 * i + 1]) for i in range(pairs)],
+                (names[:ROUNDS], names[ROUNDS:]))
+
+    def run(self, pairs, timeout):
+        # Installed before anything runs, so that it is on the connection
+        # of whichever thread the consumers' queries run in
+        counter = QueryCounter()
+        for conn in connections.all(initialized_only=True):
+            counter.install(conn)
+        connection_created.connect(counter.install)
+        try:
+            return self.run_battles(pairs, timeout, counter)
+        finally:
+            connection_created.disconnect(counter.install)
+
+    def run_battles(self, pairs, timeout, counter):
+        players, decks = self.make_players(pairs)
+
+        async def latency():
+            timings = Timings()
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                play_battle(f"latency{i}", users, decks, timings, timeout)
+                for i, users in enumerate(players)))
+            return timings, time.perf_counter() - start
+
+        async def memory():
+            started = asyncio.Barrier(pairs + 1)
+            go = asyncio.Event()
+
+            async def measure():
+                await started.wait()
+                gc.collect()
+                used = tracemalloc.get_traced_memory()[0]
+                go.set()
+                return used
+
+            gc.collect()
+            tracemalloc.start()
+            try:
+                baseline = tracemalloc.get_traced_memory()[0]
+                results = await asyncio.gather(measure(), *(
+                    play_battle(f"memory{i}", users, decks, Timings(),
+                                timeout, started, go)
+                    for i, users in enumerate(players)))
+            finally:
+                tracemalloc.stop()
+            return (results[0] - baseline) / pairs
+
+        async def queries():
+            timings = Timings(counter)
+            await play_battle("queries", players[0], decks, timings,
+                              timeout)
+            return timings
+
+        timings, elapsed = asyncio.run(latency())
+        memory_per_room = asyncio.run(memory())
+        query_timings = asyncio.run(queries())
+
+        return {
+            "pairs": pairs,
+            "rounds": ROUNDS,
+            "python": platform.python_version(),
+            "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+            "elapsed_s": elapsed,
+            "battles_per_s": pairs / elapsed,
+            "latency": timings.latency_report(),
+            "queries_per_event": query_timings.query_report(),
+            "memory_per_room_bytes": round(memory_per_room),
+        }
@@ -0,0 +1,135 @@
+"""
+Measures how fast group_send delivers messages through the in-memory
+channel layer and through SQLiteChannelLayer, e.g.
+    python manage.py bench_channel_layer --processes 4 --messages 2000
+
+Each run puts --members channels per process in one group and sends
+--messages group messages to it. The SQLite layer is measured both with
+every channel in the sending process and with the channels spread over
+--processes separate receiving processes.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from cardgame.channel_layers import SQLiteChannelLayer
+
+GROUP = "bench"
+
+
+async def join(layer, members):
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    return channels
+
+
+async def drain(layer, channels, messages):
+    async def receive(channel):
+        for _ in range(messages):
+            await layer.receive(channel)
+    await asyncio.gather(*(receive(channel) for channel in channels))
+
+
+async def send(layer, messages):
+    for n in range(messages):
+        await layer.group_send(GROUP, {"type": "bench.message", "n": n})
+
+
+def bench_in_process(make_layer, members, messages):
+    """Returns the seconds taken to send and deliver every message."""
+    async def run():
+        layer = make_layer()
+        channels = await join(layer, members)
+        start = time.perf_counter()
+        await asyncio.gather(send(layer, messages),
+                             drain(layer, channels, messages))
+        elapsed = time.perf_counter() - start
+        await layer.close()
+        return elapsed
+    return asyncio.run(run())
+
+
+def receiver(path, members, messages, ready, done):
+    """Joins the group from a separate process and receives everything."""
+    async def run():
+        layer = SQLiteChannelLayer(path=path, capacity=messages + 1)
+        channels = await join(layer, members)
+        ready.put(True)
+        await drain(layer, channels, messages)
+        await layer.close()
+    asyncio.run(run())
+    done.put(time.time())
+
+
+def bench_processes(path, processes, members, messages):
+    """
+    Returns the seconds taken to send every message from this process and
+    to deliver them to all receiving processes.
+    """
+    context = multiprocessing.get_context("spawn")
+    ready, done = context.Queue(), context.Queue()
+    workers = [context.Process(target=receiver,
+                               args=(path, members, messages, ready, done))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready.get(timeout=60)
+
+    async def run():
+        layer = SQLiteChannelLayer(path=path)
+        await send(layer, messages)
+        await layer.close()
+
+    start = time.time()
+    asyncio.run(run())
+    finished = max(done.get(timeout=300) for _ in workers)
+    for worker in workers:
+        worker.join()
+    return finished - start
+
+
+class Command(BaseCommand):
+    help = "Compares group_send throughput of the channel layers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=2,
+                            help="receiving processes for the SQLite layer")
+        parser.add_argument("--members", type=int, default=2,
+                            help="channels in the group per process")
+        parser.add_argument("--messages", type=int, default=1000,
+                            help="group messages to send")
+
+    def handle(self, *args, **options):
+        processes = options["processes"]
+        members = options["members"]
+        messages = options["messages"]
+        channels = processes * members
+        capacity = messages + 1
+
+        with tempfile.TemporaryDirectory() as tmp:
+            runs = [
+                ("in-memory, 1 process", bench_in_process(
+                    lambda: InMemoryChannelLayer(capacity=capacity),
+                    channels, messages)),
+                ("sqlite, 1 process", bench_in_process(
+                    lambda: SQLiteChannelLayer(
+                        path=os.path.join(tmp, "local.sqlite3"),
+                        capacity=capacity),
+                    channels, messages)),
+                (f"sqlite, {processes} processes", bench_processes(
+                    os.path.join(tmp, "shared.sqlite3"), processes,
+                    members, messages)),
+            ]
+
+        self.stdout.write(f"{messages} group sends to {channels} channels")
+        for name, seconds in runs:
+            self.stdout.write(
+                f"{name:<24} {seconds:8.3f}s "
+                f"{messages / seconds:10.0f} sends/s "
+                f"{messages * channels / seconds:10.0f} deliveries/s")
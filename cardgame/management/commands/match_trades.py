@@ -0,0 +1,17 @@
+"""
+Matches the open public trades with each other, oldest first, e.g.
+    python manage.py match_trades
+New trades are matched as they are submitted; run this once after
+upgrading to match those submitted before, or after a bulk import.
+"""
+
+from django.core.management.base import BaseCommand
+from cardgame.trade_matching import match_all
+
+
+class Command(BaseCommand):
+    help = "Settles the open public trades that complete each other"
+
+    def handle(self, *args, **options):
+        settled = match_all()
+        self.stdout.write(f"Settled {settled} trades")
@@ -0,0 +1,32 @@
+"""
+Archives completed battles and deletes abandoned ones in its own process,
+e.g.
+    python manage.py reap_battles
+See cardgame.battle_reaper for what is reaped and when.
+"""
+
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from cardgame.battle_reaper import BATCH_SIZE, POLL_SECONDS, reap
+
+
+class Command(BaseCommand):
+    help = "Archives completed battles and expires idle ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="reap once and exit")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help="battles to reap per query")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            archived, expired = reap(batch_size=options["batch_size"])
+            if archived or expired:
+                self.stdout.write(f"Archived {archived} battles, "
+                                  f"expired {expired}")
+            if options["once"]:
+                return
+            time.sleep(POLL_SECONDS)
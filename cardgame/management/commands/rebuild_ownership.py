@@ -0,0 +1,23 @@
+"""
+Numbers cards that don't have a card_index yet and rebuilds every
+profile's collection bitmap from its collection, e.g.
+    python manage.py rebuild_ownership
+Run it once after upgrading, or whenever the bitmaps may be out of step.
+"""
+
+from django.core.management.base import BaseCommand
+from cardgame.models import UserProfile
+from cardgame.ownership import index_cards, rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the collection bitmaps used for ownership checks"
+
+    def handle(self, *args, **options):
+        indexed = index_cards()
+        profiles = 0
+        for profile_id in UserProfile.objects.values_list("pk", flat=True):
+            rebuild(profile_id)
+            profiles += 1
+        self.stdout.write(f"Indexed {indexed} cards, "
+                          f"rebuilt {profiles} bitmaps")
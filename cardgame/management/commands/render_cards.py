@@ -0,0 +1,106 @@
+"""
+Management command that regenerates card images in bulk.
+
+Run this after changing the card template, e.g.
+    python manage.py render_cards --workers 4
+"""
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from image_gen import render_cards
+from cardgame.models import Card
+from cardgame.rendering import (DEFAULT_IMAGE, RENDER_DIR, card_spec,
+                                delete_render, ensure_derivatives,
+                                image_formats, read_source, render_key,
+                                render_name, store_render)
+
+
+class Command(BaseCommand):
+    help = "Re-renders card images on a process pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument("card_names", nargs="*",
+                            help="only render these cards (default: all)")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="number of render processes "
+                                 "(default: one per CPU)")
+        parser.add_argument("--force", action="store_true",
+                            help="render even if an identical render "
+                                 "is already stored")
+
+    def handle(self, *args, **options):
+        cards = Card.objects.exclude(card_image_link=DEFAULT_IMAGE)
+        if options["card_names"]:
+            cards = cards.filter(card_name__in=options["card_names"])
+        cards = {c.card_name: c for c in cards}
+        if not cards:
+            raise CommandError("No cards to render.")
+
+        keys = {}
+        updated = []
+        rendered = failed = 0
+        total = 0.0
+        # card_image_link is the previous render, so it is never used as
+        # the picture; cards without their original picture are skipped
+        sourced = [c for c in cards.values() if c.card_source_image]
+        previous = {c.card_name: (c.card_image_link.name, c.card_render_key)
+                    for c in sourced}
+        skipped = len(cards) - len(sourced)
+        for card in cards.values():
+            if not card.card_source_image:
+                self.stderr.write(f"{card.card_name}: no source picture, "
+                                  "skipped")
+        specs = self.specs(sourced, keys, updated, options["force"])
+        for result in render_cards(specs, workers=options["workers"],
+                                   formats=image_formats()):
+            total += result.seconds
+            if result.error:
+                failed += 1
+                self.stderr.write(f"{result.key}: {result.error}")
+                continue
+            card = cards[result.key]
+            card.card_image_link = store_render(keys[result.key],
+                                                result.png,
+                                                result.derivatives,
+                                                overwrite=options["force"])
+            card.card_render_key = keys[result.key]
+            updated.append(card)
+            rendered += 1
+            self.stdout.write(f"{result.key}: "
+                              f"{result.seconds * 1000:.0f} ms")
+
+        # Card.save() would check every render a second time,
+        # so the new file names are written in one bulk update instead.
+        Card.objects.bulk_update(updated, ["card_image_link",
+                                           "card_source_image",
+                                           "card_render_key"],
+                                 batch_size=500)
+        # Saving would also have deleted the renders the cards moved off
+        for card in updated:
+            name, key = previous[card.card_name]
+            if name != card.card_image_link.name \
+                    and name.startswith(RENDER_DIR + "/"):
+                delete_render(name, key)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {rendered} cards, "
+            f"{len(updated) - rendered} already up to date, "
+            f"{failed} failed, {skipped} skipped without a source picture, "
+            f"{total:.2f}s of render time"))
+
+    def specs(self, cards, keys, updated, force):
+        for card in cards:
+            try:
+                source = read_source(card)
+            except (FileNotFoundError, ValueError) as e:
+                self.stderr.write(f"{card.card_name}: {e}")
+                continue
+            key = render_key(source, card)
+            keys[card.card_name] = key
+            if not force and default_storage.exists(render_name(key)):
+                # identical render already stored, no need to redo it
+                ensure_derivatives(key)
+                card.card_image_link = render_name(key)
+                card.card_render_key = key
+                updated.append(card)
+                continue
+            yield card_spec(card, source)
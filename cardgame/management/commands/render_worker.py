@@ -0,0 +1,28 @@
+"""
+Runs the card render queue in its own process, e.g.
+    python manage.py render_worker
+"""
+
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from cardgame.render_queue import POLL_SECONDS, process_pending
+
+
+class Command(BaseCommand):
+    help = "Renders queued card images"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            ran = process_pending()
+            if ran:
+                self.stdout.write(f"Rendered {ran} cards")
+            elif options["once"]:
+                return
+            else:
+                time.sleep(POLL_SECONDS)
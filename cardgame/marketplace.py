@@ -0,0 +1,95 @@
+"""
+Searching the public trades.
+
+search_trades() returns one page of the public trades a user could take
+up, newest first, with their sender and cards loaded by the same query.
+Pages are keyset paginated: instead of an offset, each page ends with a
+cursor naming the last trade on it, and the next page starts after that
+trade. Every page therefore costs the same however deep it is, and
+trades created meanwhile don't shift the pages.
+
+The filters match the composite indexes on Trade, which start with
+recipient (None for public trades), then the cards, then created_date.
+"""
+
+import datetime
+from django.db.models import Exists, OuterRef, Q
+from .models import Trade, UserProfile
+
+PAGE_SIZE = 20
+
+# Only what the results show is read for the trades' users and cards
+CARD_FIELDS = ("card_name", "card_image_link", "card_render_key")
+TRADE_FIELDS = (("id", "created_date", "sender__username")
+                + tuple(f"offered_card__{f}" for f in CARD_FIELDS)
+                + tuple(f"requested_card__{f}" for f in CARD_FIELDS))
+
+
+def make_cursor(trade):
+    return f"{trade.created_date.isoformat()}.{trade.pk}"
+
+
+def parse_cursor(cursor):
+    """Returns the (created_date, id) of a cursor, or raises ValueError."""
+    date, _, pk = cursor.partition(".")
+    return datetime.date.fromisoformat(date), int(pk)
+
+
+def owns(user_ref, card_ref):
+    """An EXISTS subquery for whether a user owns a card."""
+    collection = UserProfile.user_profile_collected_cards.through
+    return Exists(collection.objects.filter(userprofile_id=user_ref,
+                                            card_id=card_ref))
+
+
+def fulfillable_by(trades, user):
+    """
+    Narrows trades to those user could accept right now: user has the
+    requested card and not the offered one, and the sender still has
+    the offered card and not the requested one.
+    """
+    sender, offered, requested = (OuterRef("sender_id"),
+                                  OuterRef("offered_card_id"),
+                                  OuterRef("requested_card_id"))
+    return trades.filter(owns(user.pk, requested), ~owns(user.pk, offered),
+                         owns(sender, offered), ~owns(sender, requested))
+
+
+def search_trades(user, offered=None, requested=None, fulfillable=False,
+                  after=None, limit=PAGE_SIZE):
+    """
+    Returns a page of the public trades other users have made.
+
+    Args:
+        user (User): who is searching; their own trades are left out
+        offered (str): only trades offering this card
+        requested (str): only trades asking for this card
+        fulfillable (bool): only trades user could accept right now
+        after (str): the cursor of the previous page, if any
+        limit (int): trades per page
+
+    Returns:
+        (trades, cursor): the page of trades, and the cursor of the next
+        page or None if this is the last
+    """
+    trades = Trade.objects.filter(recipient=None)\
+        .exclude(sender=user)\
+        .select_related("sender", "offered_card", "requested_card")\
+        .only(*TRADE_FIELDS)\
+        .order_by("-created_date", "-id")
+    if offered:
+        trades = trades.filter(offered_card_id=offered)
+    if requested:
+        trades = trades.filter(requested_card_id=requested)
+    if fulfillable:
+        trades = fulfillable_by(trades, user)
+    if after:
+        date, pk = parse_cursor(after)
+        trades = trades.filter(Q(created_date__lt=date)
+                               | Q(created_date=date, id__lt=pk))
+
+    # One more than a page, to know whether there is a next page
+    page = list(trades[:limit + 1])
+    if len(page) > limit:
+        return page[:limit], make_cursor(page[limit - 1])
+    return page, None
@@ -0,0 +1,140 @@
+"""
+Matchmaking queue for battles.
+
+Players who ask for a battle wait in a MatchmakingQueue, a list of
+(points, ticket, channel_name) entries sorted by points. When another
+player arrives, the waiting player with the closest points is found by
+bisecting that list, so pairing takes O(log n) comparisons however many
+players are waiting, and nothing is polled or stored in the database
+until a pair is found.
+
+A player is only paired with someone whose points are within
+MATCHMAKING_POINTS_GAP (default 100) of theirs. Players who have waited
+MATCHMAKING_WIDEN_AFTER seconds (default 10) without a close opponent are
+offered the closest player waiting, whatever their points.
+
+Each process has its own queue (matchmaking_queue), so with several
+worker processes players are only matched with those waiting in the same
+process. The SQLite channel layer doesn't change that: matchmaking needs
+the site to run a single worker (WORKERS=1 in run.sh, the default).
+"""
+
+import itertools
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+from django.conf import settings
+
+# ticket orders players with the same points by arrival, so the one who
+# has waited longest is picked first
+Waiting = namedtuple("Waiting", ["points", "ticket", "channel_name",
+                                 "profile_id", "username"])
+
+
+def points_gap():
+    return getattr(settings, "MATCHMAKING_POINTS_GAP", 100)
+
+
+def widen_after():
+    return getattr(settings, "MATCHMAKING_WIDEN_AFTER", 10)
+
+
+class MatchmakingQueue:
+    """Players waiting for an opponent, sorted by points."""
+
+    def __init__(self):
+        self._waiting = []
+        self._by_channel = {}
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+
+    def join(self, channel_name, profile_id, username, points,
+             max_gap=None):
+        """
+        Returns the waiting player with the closest points to pair with,
+        removing them from the queue, or queues this player and returns
+        None if nobody is waiting within max_gap points (None for any).
+        """
+        with self._lock:
+            opponent = self._closest(points, profile_id, max_gap)
+            if opponent is not None:
+                self._remove(opponent)
+                return opponent
+            player = Waiting(points, next(self._tickets), channel_name,
+                             profile_id, username)
+            insort(self._waiting, player)
+            self._by_channel[channel_name] = player
+            return None
+
+    def rematch(self, channel_name, max_gap=None):
+        """
+        Looks again for an opponent for a player who is already waiting,
+        e.g. with a wider max_gap. Returns the opponent, having taken both
+        players out of the queue, or None if there is still no one (or
+        the player has left).
+        """
+        with self._lock:
+            player = self._by_channel.get(channel_name)
+            if player is None:
+                return None
+            self._remove(player)
+            opponent = self._closest(player.points, player.profile_id,
+                                     max_gap)
+            if opponent is None:
+                insort(self._waiting, player)
+                self._by_channel[channel_name] = player
+                return None
+            self._remove(opponent)
+            return opponent
+
+    def leave(self, channel_name):
+        """Takes a player out of the queue, e.g. when they disconnect."""
+        with self._lock:
+            player = self._by_channel.get(channel_name)
+            if player is not None:
+                self._remove(player)
+
+    def _closest(self, points, profile_id, max_gap):
+        i = bisect_left(self._waiting, (points,))
+        # the closest player is right below or at/above the insertion
+        # point; a player can't be matched with themselves (e.g. a
+        # second tab), so step past their own entries
+        below, above = i - 1, i
+        while below >= 0 and self._waiting[below].profile_id == profile_id:
+            below -= 1
+        while above < len(self._waiting) and \
+                self._waiting[above].profile_id == profile_id:
+            above += 1
+        candidates = []
+        if below >= 0:
+            candidates.append(self._waiting[below])
+        if above < len(self._waiting):
+            candidates.append(self._waiting[above])
+        if not candidates:
+            return None
+        closest = min(candidates,
+                      key=lambda w: (abs(w.points - points), w.ticket))
+        if max_gap is not None and abs(closest.points - points) > max_gap:
+            return None
+        return closest
+
+    def _remove(self, player):
+        i = bisect_left(self._waiting, player)
+        del self._waiting[i]
+        del self._by_channel[player.channel_name]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def __contains__(self, channel_name):
+        with self._lock:
+            return channel_name in self._by_channel
+
+    def clear(self):
+        with self._lock:
+            self._waiting.clear()
+            self._by_channel.clear()
+
+
+matchmaking_queue = MatchmakingQueue()
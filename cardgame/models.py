@@ -5,14 +5,24 @@ user profiles, challenges, and quiz components.
 
 """
 
-import sys
 import datetime
-from io import BytesIO
+import random
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.forms import ValidationError
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from image_gen import make_image
+from image_gen import CARD_SIZE, DERIVATIVE_SIZES
+from .rendering import (MIME_TYPES, derivative_name, image_formats,
+                        refresh_card_image)
+
+
+# How many times a new card tries to claim the next card_index
+CARD_INDEX_ATTEMPTS = 5
+
+
+def next_card_index():
+    """The card_index after the highest one taken."""
+    last = Card.objects.aggregate(last=models.Max("card_index"))["last"]
+    return 0 if last is None else last + 1
 
 
 class Card(models.Model):
@@ -24,6 +34,11 @@ class Card(models.Model):
         card_subtitle (str): Secondary descriptive text
         card_description (str): Detailed card information
         card_image_link (ImageField): Visual representation
+        card_source_image (ImageField): The picture the card image is
+            rendered from
+        card_render_key (str): Hash of the inputs of the current render
+        card_index (int): Dense number used as the card's bit in
+            collection bitmaps (see cardgame.ownership)
         environmental_friendliness (int): Battle stat for environmental impact
         beauty (int): Battle stat for aesthetic appeal
         cost (int): Battle stat for resource cost
@@ -42,6 +57,12 @@ class Card(models.Model):
         upload_to="static/card_images",
         default="static/card_images/do_not_remove.png",
     )
+    card_source_image = models.ImageField(
+        upload_to="static/card_images/sources", blank=True)
+    card_render_key = models.CharField(max_length=64, blank=True,
+                                       editable=False)
+    card_index = models.PositiveIntegerField(unique=True, null=True,
+                                             blank=True, editable=False)
 
     # Battle stats
     environmental_friendliness = models.IntegerField(default=0)
@@ -51,32 +72,96 @@ class Card(models.Model):
     def __str__(self):
         return str(self.card_name)
 
+    def image_url(self, size=None, fmt=None):
+        """
+        Returns the URL of the card image scaled down to size ("thumb" or
+        "medium"). Falls back to the full size image if size is None or
+        the card has no scaled copies.
+        """
+        if size is None or not self.card_render_key:
+            return self.card_image_link.url
+        return self.card_image_link.storage.url(derivative_name(
+            self.card_render_key, size, fmt or image_formats()[-1]))
+
+    def image_srcset(self, fmt=None, full=True):
+        """
+        Returns a srcset attribute value listing every size of the card
+        image, so the browser can download the smallest one that fits.
+        With full=False only the scaled copies in fmt are listed, leaving
+        out the full size PNG.
+        """
+        if not self.card_render_key:
+            return self.card_image_link.url
+        srcset = [f"{self.image_url(size, fmt)} {width}w"
+                  for size, (width, _) in DERIVATIVE_SIZES.items()]
+        if full:
+            srcset.append(f"{self.card_image_link.url} {CARD_SIZE[0]}w")
+        return ", ".join(srcset)
+
+    def image_sources(self):
+        """
+        Returns (mime type, srcset) pairs for the <source> elements of a
+        <picture>, best format first. Each lists only files of its type;
+        the full size PNG is left to the <img> fallback.
+        """
+        if not self.card_render_key:
+            return []
+        return [(MIME_TYPES[fmt], self.image_srcset(fmt, full=False))
+                for fmt in image_formats()]
+
     def save(self, *args, **kwargs):
-        print(self.card_image_link)
-        if (self.card_image_link != "static/card_images/do_not_remove.png"):
-            c = make_image(
-                "static/card_gen/back.png",
-                self.card_name,
-                self.card_description,
-                self.card_image_link,
-                self.environmental_friendliness,
-                self.beauty,
-                self.cost,
-            )
+        # Only renders the card image if no identical render is stored
+        refresh_card_image(self)
+        if self.card_index is not None:
+            super(Card, self).save(*args, **kwargs)
+            return
+        # Cards saved at the same time can pick the same next index; the
+        # unique constraint turns that into an IntegrityError, and the
+        # loser tries again with the next free index.
+        for attempt in range(CARD_INDEX_ATTEMPTS):
+            self.card_index = next_card_index()
+            try:
+                with transaction.atomic():
+                    super(Card, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                taken = Card.objects.filter(card_index=self.card_index)\
+                    .exclude(pk=self.pk).exists()
+                if not taken or attempt == CARD_INDEX_ATTEMPTS - 1:
+                    self.card_index = None
+                    raise
+
+
+class RenderJob(models.Model):
+    """
+    A card image waiting to be rendered by the render queue
+    (see cardgame.render_queue).
 
-            c_io = BytesIO()
-            c.save(c_io, format="PNG")
-            # We have to convert from a PIL image to a DJANGO image
-            django_file = InMemoryUploadedFile(
-                c_io,
-                None,
-                str(self.card_name).replace(" ", "_") + ".png",
-                "image/png",
-                sys.getsizeof(c_io),
-                None,
-            )
-            self.card_image_link = django_file
-        super(Card, self).save(*args, **kwargs)
+    Attributes:
+        card (Card): The card to render from its card_source_image
+        status (str): Where the job is in the queue
+        error (str): Why the render failed, if it did
+        started_at (datetime): When a worker claimed the job, so jobs
+            left running by a worker that died can be retried
+    """
+
+    card = models.ForeignKey(Card, on_delete=models.CASCADE,
+                             related_name="render_jobs")
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default="pending", db_index=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Render of {self.card_id} ({self.status})"
 
 
 class UserProfile(models.Model):
@@ -116,6 +201,27 @@ class UserProfile(models.Model):
         return up
 
 
+class CollectionBitmap(models.Model):
+    """
+    A compact copy of a UserProfile's collected cards: one bit per card,
+    set at the card's card_index. Kept in sync with
+    user_profile_collected_cards by signals, so views can check
+    ownership without querying the collection (see cardgame.ownership).
+
+    Attributes:
+        profile (UserProfile): Whose collection this is
+        bits (bytes): The bitmap, least significant bit first
+    """
+
+    profile = models.OneToOneField(UserProfile, on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name="collection_bitmap")
+    bits = models.BinaryField(default=b"")
+
+    def __str__(self):
+        return f"Collection bitmap for {self.profile_id}"
+
+
 class Question(models.Model):
     """
     Faciliates the multiple-choice questions associated with a challenge
@@ -258,6 +364,8 @@ class Battle(models.Model):
         status (str): Current state of the battle
         winner (UserProfile): The winner of the battle (if completed)
         created_at (DateTimeField): When the battle was created
+        updated_at (DateTimeField): When the battle last changed, used to
+            find idle and finished battles to reap
 
     Author: Samuel
     """
@@ -291,6 +399,10 @@ class Battle(models.Model):
     player2_score = models.IntegerField(default=0)
 
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "updated_at"])]
 
     def __str__(self):
         return f"Battle {self.room_id}: {self.player1.user.username}\
@@ -300,6 +412,54 @@ class Battle(models.Model):
         return self.player1_ready and self.player2_ready
 
 
+class BattleSummary(models.Model):
+    """
+    What is kept of a completed battle once it has been archived by the
+    battle reaper (see cardgame.battle_reaper).
+
+    Attributes:
+        room_id (str): The room the battle was played in
+        player1/player2 (UserProfile): The two participants
+        player1_score/player2_score (int): The final scores
+        winner (UserProfile): The winner, if there was one
+        started_at (DateTimeField): When the battle was created
+        finished_at (DateTimeField): When the battle was last played
+    """
+
+    room_id = models.CharField(max_length=100)
+    player1 = models.ForeignKey(UserProfile, on_delete=models.CASCADE,
+                                related_name="summaries_as_player1")
+    player2 = models.ForeignKey(UserProfile, on_delete=models.CASCADE,
+                                related_name="summaries_as_player2",
+                                null=True, blank=True)
+    player1_score = models.IntegerField(default=0)
+    player2_score = models.IntegerField(default=0)
+    winner = models.ForeignKey(UserProfile, on_delete=models.SET_NULL,
+                               related_name="summaries_won",
+                               null=True, blank=True)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+
+    class Meta:
+        # A player's history is read newest first from either column
+        indexes = [models.Index(fields=["player1", "-finished_at"]),
+                   models.Index(fields=["player2", "-finished_at"])]
+
+    def __str__(self):
+        return f"Summary of battle {self.room_id}"
+
+    @property
+    def duration(self):
+        return self.finished_at - self.started_at
+
+    @classmethod
+    def history(cls, profile):
+        """Returns profile's archived battles, most recent first."""
+        return cls.objects.filter(
+            models.Q(player1=profile) | models.Q(player2=profile))\
+            .order_by("-finished_at")
+
+
 class BattleDeck(models.Model):
     """
     Represents cards selected by a player for a battle.
@@ -310,6 +470,8 @@ class BattleDeck(models.Model):
         cards (ManyToManyField): Selected cards for the battle
         current_card_index (int): Index of the current card in play
         shuffle_seed (int): Seed for shuffling the deck
+        card_order (list): Names of the cards in the order they are
+            played, fixed when the cards are selected
 
     Author: Samuel
     """
@@ -321,11 +483,29 @@ class BattleDeck(models.Model):
     cards = models.ManyToManyField(Card, related_name="battle_decks")
     current_card_index = models.IntegerField(default=0)
     shuffle_seed = models.IntegerField(default=0)
+    card_order = models.JSONField(default=list, blank=True)
 
     def __str__(self):
         return f"Deck for {self.player.user.username}\
             in battle {self.battle.room_id}"
 
+    def shuffle(self, card_names):
+        """
+        Sets card_order to card_names shuffled with shuffle_seed. The
+        names are sorted first, so the same seed always gives the same
+        order. Doesn't save the deck.
+        """
+        order = sorted(card_names)
+        random.Random(self.shuffle_seed).shuffle(order)
+        self.card_order = order
+
+    def play_order(self):
+        """Returns the names of the deck's cards in playing order."""
+        if not self.card_order:
+            # Decks saved before card_order existed
+            self.shuffle(self.cards.values_list("card_name", flat=True))
+        return list(self.card_order)
+
 
 class Trade(models.Model):
 
@@ -345,3 +525,14 @@ class Trade(models.Model):
                                on_delete=models.CASCADE)
     created_date = models.DateField()
     actioned_date = models.DateField(blank=True, null=True)
+
+    class Meta:
+        # Public trades (recipient None) are searched by the card offered,
+        # the card requested or neither, newest first (see marketplace)
+        indexes = [
+            models.Index(fields=["recipient", "offered_card",
+                                 "requested_card", "created_date"]),
+            models.Index(fields=["recipient", "requested_card",
+                                 "created_date"]),
+            models.Index(fields=["recipient", "created_date"]),
+        ]
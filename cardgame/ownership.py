@@ -0,0 +1,141 @@
+"""
+Per-profile collection bitmaps for fast ownership checks.
+
+Every card has a dense card_index, and every profile has a
+CollectionBitmap with that bit set for each card it has collected. Checking
+whether a profile owns a card is then a bit test on bytes loaded together
+with the profile, rather than a query against the collection. The
+collection (user_profile_collected_cards) stays the source of truth: the
+signals in cardgame.signals rebuild a profile's bitmap whenever its
+collection changes, and ``manage.py rebuild_ownership`` rebuilds them all.
+"""
+
+from django.db.models import Max
+from .models import Card, CollectionBitmap, UserProfile
+
+
+class OwnershipBitmap:
+    """
+    A set of card indexes stored as a little-endian bitmap.
+
+    Args:
+        data: the stored bitmap bytes, or None for an empty set
+    """
+
+    __slots__ = ("_bits",)
+
+    def __init__(self, data=None):
+        self._bits = bytearray(data or b"")
+
+    @classmethod
+    def from_indexes(cls, indexes):
+        bitmap = cls()
+        for index in indexes:
+            bitmap.add(index)
+        return bitmap
+
+    def add(self, index):
+        byte = index >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 - len(self._bits)))
+        self._bits[byte] |= 1 << (index & 7)
+
+    def discard(self, index):
+        byte = index >> 3
+        if byte < len(self._bits):
+            self._bits[byte] &= ~(1 << (index & 7)) & 0xFF
+
+    def __contains__(self, index):
+        if index is None:
+            return False
+        byte = index >> 3
+        return byte < len(self._bits) and bool(
+            self._bits[byte] >> (index & 7) & 1)
+
+    def __len__(self):
+        return self._as_int().bit_count()
+
+    def __iter__(self):
+        for byte, value in enumerate(self._bits):
+            while value:
+                low = value & -value
+                yield byte * 8 + low.bit_length() - 1
+                value ^= low
+
+    def __and__(self, other):
+        return self._from_int(self._as_int() & other._as_int())
+
+    def __or__(self, other):
+        return self._from_int(self._as_int() | other._as_int())
+
+    def __sub__(self, other):
+        return self._from_int(self._as_int() & ~other._as_int())
+
+    def __eq__(self, other):
+        if not isinstance(other, OwnershipBitmap):
+            return NotImplemented
+        return self._as_int() == other._as_int()
+
+    def to_bytes(self):
+        return bytes(self._bits.rstrip(b"\0"))
+
+    def _as_int(self):
+        return int.from_bytes(self._bits, "little")
+
+    @classmethod
+    def _from_int(cls, value):
+        return cls(value.to_bytes((value.bit_length() + 7) // 8, "little"))
+
+
+def rebuild(profile_id):
+    """
+    Recomputes and stores the bitmap of one profile from its collection.
+    Returns the new OwnershipBitmap.
+    """
+    through = UserProfile.user_profile_collected_cards.through
+    bitmap = OwnershipBitmap.from_indexes(
+        through.objects.filter(userprofile_id=profile_id,
+                               card__card_index__isnull=False)
+        .values_list("card__card_index", flat=True))
+    CollectionBitmap.objects.update_or_create(
+        profile_id=profile_id, defaults={"bits": bitmap.to_bytes()})
+    return bitmap
+
+
+def bitmap_for(profile):
+    """
+    Returns the OwnershipBitmap of profile. Load profiles with
+    select_related("collection_bitmap") to avoid a query here; profiles
+    without a stored bitmap get one built.
+    """
+    try:
+        return OwnershipBitmap(profile.collection_bitmap.bits)
+    except CollectionBitmap.DoesNotExist:
+        return rebuild(profile.pk)
+
+
+def owns(profile, card, bitmap=None):
+    """
+    Returns whether profile has collected card. Pass bitmap when checking
+    several cards against the same profile.
+    """
+    if card.card_index is None:
+        # Only cards created before bitmaps existed, until
+        # rebuild_ownership has been run.
+        return profile.user_profile_collected_cards.filter(
+            pk=card.pk).exists()
+    if bitmap is None:
+        bitmap = bitmap_for(profile)
+    return card.card_index in bitmap
+
+
+def index_cards():
+    """Gives every card without a card_index one. Returns how many."""
+    cards = list(Card.objects.filter(card_index__isnull=True)
+                 .order_by("card_name").only("pk"))
+    last = Card.objects.aggregate(last=Max("card_index"))["last"]
+    start = 0 if last is None else last + 1
+    for i, card in enumerate(cards):
+        card.card_index = start + i
+    Card.objects.bulk_update(cards, ["card_index"])
+    return len(cards)
@@ -0,0 +1,60 @@
+"""
+Awarding points to players.
+
+Points are only ever added in the database, with an UPDATE that adds to
+the stored value (F("user_profile_points") + points), never by saving a
+total computed in Python. Battles ending and challenges being completed
+at the same time for the same player therefore can't overwrite each
+other's points, and only the columns being changed are written.
+"""
+
+from django.db import transaction
+from django.db.models import F
+from .leaderboard import record
+from .models import UserProfile
+
+# Points for the outcome of a battle
+BATTLE_WIN = 10
+BATTLE_LOSS = 2
+BATTLE_TIE = 5
+
+
+def award_points(profile, points, **fields):
+    """
+    Adds points to profile's user_profile_points, setting any other
+    fields given in the same UPDATE. profile is refreshed with the new
+    total and its place on the leaderboard updated.
+
+    Args:
+        profile (UserProfile): who gets the points
+        points (int): how many points to add
+        **fields: other UserProfile columns to set at the same time
+
+    Returns:
+        int: profile's new total
+    """
+    rows = UserProfile.objects.filter(pk=profile.pk)
+    with transaction.atomic():
+        rows.update(user_profile_points=F("user_profile_points") + points,
+                    **fields)
+        # Read back inside the transaction, so the total includes this
+        # award even if other awards commit in between
+        profile.user_profile_points = rows.values_list(
+            "user_profile_points", flat=True).get()
+        for name, value in fields.items():
+            setattr(profile, name, value)
+        record(profile)
+    return profile.user_profile_points
+
+
+def award_battle(battle):
+    """Awards both players of a completed battle their points."""
+    if battle.winner_id is None:
+        award_points(battle.player1, BATTLE_TIE)
+        award_points(battle.player2, BATTLE_TIE)
+    elif battle.winner_id == battle.player1_id:
+        award_points(battle.player1, BATTLE_WIN)
+        award_points(battle.player2, BATTLE_LOSS)
+    else:
+        award_points(battle.player2, BATTLE_WIN)
+        award_points(battle.player1, BATTLE_LOSS)
@@ -0,0 +1,144 @@
+"""
+Background queue for rendering card images.
+
+Jobs are RenderJob rows, so the queue needs no broker and survives
+restarts: every time a worker drains the queue it first puts jobs that
+have been running for longer than CARD_RENDER_STALE_AFTER seconds
+(default 600) back in the queue, as the worker running them must have
+died.
+
+Each web process starts a local worker thread when it boots (see
+cards/asgi.py and cards/wsgi.py), which drains whatever was queued
+before, and wakes it up whenever a job is queued. `python manage.py
+render_worker` runs the same loop in its own process instead. Set
+CARD_RENDER_WORKER = False in settings to keep the web process from
+starting its own worker; render_worker must then always be running.
+"""
+
+import datetime
+import threading
+import traceback
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Card, RenderJob
+from .rendering import render_from_source
+
+# How long an idle worker sleeps before checking the table again,
+# in case a job was queued by another process.
+POLL_SECONDS = 5.0
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def enqueue(card):
+    """
+    Queues card to be rendered from its card_source_image. The local
+    worker is woken up once the surrounding transaction commits.
+    """
+    job = RenderJob.objects.create(card=card)
+    transaction.on_commit(wake_worker)
+    return job
+
+
+def stale_after():
+    """Seconds after which a running job is assumed to be abandoned."""
+    return getattr(settings, "CARD_RENDER_STALE_AFTER", 600)
+
+
+def requeue_stale(now=None):
+    """
+    Puts running jobs claimed more than stale_after() seconds ago back
+    in the queue. Returns how many there were.
+    """
+    cutoff = (now or timezone.now()) - datetime.timedelta(
+        seconds=stale_after())
+    return RenderJob.objects.filter(status="running")\
+        .filter(Q(started_at__lt=cutoff) | Q(started_at=None))\
+        .update(status="pending", started_at=None)
+
+
+def claim_next():
+    """
+    Marks the oldest pending job as running and returns it, or returns
+    None if there is nothing to do. The conditional update means two
+    workers can never claim the same job.
+    """
+    for job_id in RenderJob.objects.filter(status="pending")\
+            .order_by("created_at", "id").values_list("id", flat=True)[:10]:
+        if RenderJob.objects.filter(id=job_id, status="pending")\
+                .update(status="running", started_at=timezone.now()):
+            return RenderJob.objects.select_related("card").get(id=job_id)
+    return None
+
+
+def run_job(job):
+    """Renders the card of a claimed job and records the outcome."""
+    try:
+        card = job.card
+        render_from_source(card)
+        # update() rather than save(), as Card.save would check the
+        # render all over again.
+        Card.objects.filter(pk=card.pk).update(
+            card_image_link=card.card_image_link.name,
+            card_source_image=card.card_source_image.name,
+            card_render_key=card.card_render_key)
+        job.status = "done"
+    except Exception as e:
+        traceback.print_exc()
+        job.status = "failed"
+        job.error = str(e)
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "finished_at"])
+    return job
+
+
+def process_pending(limit=None):
+    """
+    Runs queued jobs in this thread until the queue is empty, or until
+    limit jobs have been run, after requeueing abandoned ones. Returns
+    the number of jobs run.
+    """
+    requeue_stale()
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+class RenderWorker(threading.Thread):
+    """A thread that runs queued jobs as they come in."""
+
+    def __init__(self):
+        super().__init__(name="card-render-worker", daemon=True)
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while True:
+            close_old_connections()
+            try:
+                ran = process_pending()
+            except Exception:
+                traceback.print_exc()
+                ran = 0
+            if not ran:
+                self.wakeup.wait(POLL_SECONDS)
+                self.wakeup.clear()
+
+
+def wake_worker():
+    """Starts this process's worker thread if needed and wakes it up."""
+    global _worker
+    if not getattr(settings, "CARD_RENDER_WORKER", True):
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = RenderWorker()
+            _worker.start()
+    _worker.wakeup.set()
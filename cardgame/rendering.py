@@ -0,0 +1,199 @@
+"""
+Content-addressed cache for rendered card images.
+
+A rendered card is stored under a name derived from a hash of everything
+that affects how it looks: the source picture, the card's name,
+description and stats, and image_gen.TEMPLATE_VERSION. Saving a card
+whose render inputs haven't changed reuses the stored file instead of
+re-rendering it and uploading another copy.
+
+Every render also gets smaller WebP copies (see
+image_gen.DERIVATIVE_SIZES) for pages that only show the card as a tile.
+Set CARD_IMAGE_FORMATS in settings to e.g. ["avif", "webp"] to also
+produce AVIF copies.
+"""
+
+import hashlib
+import json
+import os
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from image_gen import (BACKGROUND, DERIVATIVE_SIZES, TEMPLATE_VERSION,
+                       CardSpec, encode_derivatives, render_png)
+
+DEFAULT_IMAGE = "static/card_images/do_not_remove.png"
+RENDER_DIR = "static/card_images/rendered"
+SOURCE_DIR = "static/card_images/sources"
+
+MIME_TYPES = {"webp": "image/webp", "avif": "image/avif"}
+
+
+def image_formats():
+    """The derivative formats to produce, best first."""
+    return list(getattr(settings, "CARD_IMAGE_FORMATS", ["webp"]))
+
+
+def render_key(source, card):
+    """
+    Returns the hex digest identifying the render of card from the
+    source image bytes.
+    """
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(source).digest())
+    h.update(json.dumps([TEMPLATE_VERSION, card.card_name,
+                         card.card_description,
+                         card.environmental_friendliness,
+                         card.beauty, card.cost]).encode())
+    return h.hexdigest()
+
+
+def render_name(key):
+    return f"{RENDER_DIR}/{key}.png"
+
+
+def derivative_name(key, size, fmt):
+    return f"{RENDER_DIR}/{key}_{size}.{fmt}"
+
+
+def store_render(key, png, derivatives=None, overwrite=False):
+    """
+    Writes png and its derivatives to storage under the names for key,
+    skipping files that already exist. derivatives are encoded here if
+    they aren't passed in. Returns the storage name of the png.
+    """
+    if derivatives is None:
+        derivatives = encode_derivatives(png, image_formats())
+    files = {render_name(key): png}
+    for (size, fmt), data in derivatives.items():
+        files[derivative_name(key, size, fmt)] = data
+    for name, data in files.items():
+        if overwrite:
+            default_storage.delete(name)
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(data))
+    return render_name(key)
+
+
+def delete_render(name, key):
+    """
+    Deletes the image stored as name and, if key is set, every
+    derivative of the render with that key.
+    """
+    default_storage.delete(name)
+    if not key:
+        return
+    for size in DERIVATIVE_SIZES:
+        for fmt in MIME_TYPES:
+            default_storage.delete(derivative_name(key, size, fmt))
+
+
+def ensure_derivatives(key):
+    """Encodes any missing derivatives of an already stored render."""
+    formats = [fmt for fmt in image_formats()
+               if any(not default_storage.exists(derivative_name(key, s, fmt))
+                      for s in DERIVATIVE_SIZES)]
+    if formats:
+        with default_storage.open(render_name(key)) as f:
+            png = f.read()
+        for (size, fmt), data in encode_derivatives(png, formats).items():
+            name = derivative_name(key, size, fmt)
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(data))
+
+
+def store_upload(upload):
+    """
+    Stores an uploaded source picture under a name derived from its
+    content hash, so uploading the same picture twice only stores it once.
+    Returns a (storage name, bytes) tuple.
+    """
+    upload.seek(0)
+    data = upload.read()
+    ext = os.path.splitext(upload.name or "")[1].lower() or ".png"
+    name = f"{SOURCE_DIR}/{hashlib.sha256(data).hexdigest()}{ext}"
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name, data
+
+
+def store_source(card):
+    """
+    Moves a freshly uploaded card_image_link over to card_source_image.
+    Returns the source bytes.
+    """
+    card.card_source_image, data = store_upload(card.card_image_link.file)
+    return data
+
+
+def read_source(card):
+    """
+    Returns the bytes of the card's source picture. Raises ValueError
+    for cards saved before sources were kept: their card_image_link is
+    the finished card, which must never be used as the picture.
+    """
+    if not card.card_source_image:
+        raise ValueError("no source picture")
+    with card.card_source_image.open("rb") as f:
+        return f.read()
+
+
+def card_spec(card, source):
+    return CardSpec(card.card_name, card.card_name, card.card_description,
+                    source, card.environmental_friendliness,
+                    card.beauty, card.cost)
+
+
+def _render(card, source, key):
+    name = render_name(key)
+    if default_storage.exists(name):
+        ensure_derivatives(key)
+    else:
+        store_render(key, render_png(BACKGROUND, card_spec(card, source)))
+    # Assigning the name (rather than a File) stops Django from uploading
+    # the source picture again when the model is saved.
+    card.card_image_link = name
+    card.card_render_key = key
+
+
+def refresh_card_image(card):
+    """
+    Makes sure card.card_image_link points at an up to date render,
+    rendering it only if no identical render is stored yet.
+    Does nothing for cards using the default image, or for cards
+    rendered before source pictures were kept, which keep their image.
+    """
+    if card.card_image_link == DEFAULT_IMAGE:
+        return
+    if card.card_image_link._committed:
+        if not card.card_source_image:
+            return
+        source = read_source(card)
+    else:
+        source = store_source(card)
+
+    key = render_key(source, card)
+    name = render_name(key)
+    if key == card.card_render_key and card.card_image_link.name == name \
+            and default_storage.exists(name):
+        ensure_derivatives(key)
+        return
+
+    previous = card.card_image_link.name
+    previous_key = card.card_render_key
+    _render(card, source, key)
+
+    # The old render can only belong to this card, as the card name is
+    # part of the key.
+    if previous != name and previous.startswith(RENDER_DIR + "/"):
+        delete_render(previous, previous_key)
+
+
+def render_from_source(card):
+    """
+    Renders card from its card_source_image and points card_image_link at
+    the result, without saving the card. Used by the render queue for
+    cards that are still showing the placeholder image.
+    """
+    source = read_source(card)
+    _render(card, source, render_key(source, card))
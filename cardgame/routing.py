@@ -4,4 +4,6 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'ws/battle/(?P<room_id>\w+)/$',
             consumers.BattleConsumer.as_asgi()),
+    re_path(r'ws/matchmaking/$', consumers.MatchmakingConsumer.as_asgi()),
+    re_path(r'ws/trades/$', consumers.TradeNotificationConsumer.as_asgi()),
 ]
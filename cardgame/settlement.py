@@ -0,0 +1,140 @@
+"""
+Settling trades: moving cards between collections.
+
+Every settlement runs in one transaction that:
+
+1. locks the trades being settled and the profiles of everyone in them
+   with SELECT ... FOR UPDATE, trades first and profiles in primary key
+   order, so that concurrent settlements touching the same trade or
+   player wait for each other instead of both going through
+2. checks every giver still has their card and every taker doesn't
+   already have it, with one query on the collection table
+3. moves each card with one UPDATE of its collection row, handing the
+   row from the giver to the taker
+4. deletes the trades, and tells the players about it once the
+   transaction commits (see cardgame.trade_notifications)
+
+Moving the rows directly bypasses the m2m_changed signals, so the
+collection bitmaps of the profiles involved are rebuilt here (see
+cardgame.ownership).
+
+Anything that stops a settlement raises SettlementError, with a message
+for the player, and leaves every collection as it was.
+"""
+
+from django.db import transaction
+from django.db.models import Q
+from .models import Trade, UserProfile
+from .ownership import rebuild
+from .trade_notifications import ACCEPTED, MATCHED, notify
+
+Collection = UserProfile.user_profile_collected_cards.through
+
+
+class SettlementError(Exception):
+    """A trade can't be settled; the message says why."""
+
+
+def lock_trades(ids):
+    """Locks and returns the trades with the given ids, in that order."""
+    trades = Trade.objects.select_for_update(of=("self",))\
+        .select_related("sender", "recipient", "offered_card",
+                        "requested_card")\
+        .in_bulk(ids)
+    if len(trades) != len(set(ids)):
+        raise SettlementError("This trade has already been completed "
+                              "or cancelled!")
+    return [trades[pk] for pk in ids]
+
+
+def lock_profiles(user_ids):
+    """Locks the profiles of the given users, returning them by user id."""
+    profiles = {profile.user_id: profile
+                for profile in UserProfile.objects.select_for_update()
+                .filter(user_id__in=user_ids).order_by("pk")}
+    if len(profiles) != len(set(user_ids)):
+        raise SettlementError("One of the players no longer exists!")
+    return profiles
+
+
+def check_moves(moves):
+    """
+    Raises SettlementError unless, for every (giver, taker, card) in
+    moves, giver has card and taker doesn't. Makes one query.
+    """
+    wanted = Q()
+    for giver, taker, card in moves:
+        wanted |= Q(userprofile_id__in=(giver.pk, taker.pk), card_id=card.pk)
+    owned = set(Collection.objects.filter(wanted)
+                .values_list("userprofile_id", "card_id"))
+    for giver, taker, card in moves:
+        if (giver.pk, card.pk) not in owned:
+            raise SettlementError("You can't make this trade, as either "
+                                  "you or the sender doesn't have the "
+                                  "right card!")
+        if (taker.pk, card.pk) in owned:
+            raise SettlementError("You can't make this trade, as either "
+                                  "you or the sender already has the card!")
+
+
+def apply_moves(moves):
+    """Hands each card's collection row from its giver to its taker."""
+    for giver, taker, card in moves:
+        Collection.objects.filter(userprofile_id=giver.pk,
+                                  card_id=card.pk)\
+            .update(userprofile_id=taker.pk)
+    for profile_id in sorted({profile.pk for giver, taker, _ in moves
+                              for profile in (giver, taker)}):
+        rebuild(profile_id)
+
+
+@transaction.atomic
+def accept_trade(trade_id, user):
+    """
+    Settles a trade accepted by user: the sender's offered card goes to
+    user, and user's copy of the requested card to the sender.
+
+    Returns:
+        Trade: the trade, which has been deleted
+    """
+    trade, = lock_trades([trade_id])
+    if trade.recipient_id is not None and trade.recipient_id != user.pk:
+        raise SettlementError("You can't make this trade!")
+    if trade.sender_id == user.pk:
+        raise SettlementError("You can't accept your own trade!")
+    profiles = lock_profiles([trade.sender_id, user.pk])
+    sender, recipient = profiles[trade.sender_id], profiles[user.pk]
+    moves = [(sender, recipient, trade.offered_card),
+             (recipient, sender, trade.requested_card)]
+    check_moves(moves)
+    apply_moves(moves)
+    Trade.objects.filter(pk=trade.pk).delete()
+    notify(ACCEPTED, trade, actor=user)
+    return trade
+
+
+@transaction.atomic
+def settle_cycle(trade_ids):
+    """
+    Settles a cycle of public trades, in which each trade offers the
+    card the one before it asks for (and the first offers what the last
+    asks for). Every sender gets the card they asked for.
+
+    Returns:
+        list: the trades, which have been deleted
+    """
+    cycle = lock_trades(trade_ids)
+    if any(trade.recipient_id is not None for trade in cycle):
+        raise SettlementError("Only public trades can be matched!")
+    profiles = lock_profiles([trade.sender_id for trade in cycle])
+    # Each trade's sender gives their card to the sender of the trade
+    # before it, who asked for it
+    moves = [(profiles[trade.sender_id], profiles[before.sender_id],
+              trade.offered_card)
+             for before, trade in zip(cycle[-1:] + cycle[:-1], cycle)]
+    check_moves(moves)
+    apply_moves(moves)
+    Trade.objects.filter(pk__in=trade_ids).delete()
+    for trade in cycle:
+        notify(MATCHED, trade)
+    return cycle
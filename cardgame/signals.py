@@ -1,9 +1,12 @@
-import os
 import datetime
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import (post_save, pre_delete, post_delete,
+                                      m2m_changed)
 from django.contrib.auth.models import User
-from .models import UserProfile, Card
+from .models import UserProfile, Card, CollectionBitmap
+from .leaderboard import leaderboard, record
+from .ownership import rebuild
+from .rendering import DEFAULT_IMAGE, delete_render
 
 
 # We ran into an issue where if a superuser was created with the command line,
@@ -24,9 +27,70 @@ def make_admin_user_profile(sender, instance, created, **kwargs):
 @receiver(post_delete, sender=Card)
 def remove_card_image_after_deletion(sender, instance,
                                      using, **kwargs):
+    # Every card without its own picture shares the default image
+    if str(instance.card_image_link) == DEFAULT_IMAGE:
+        return
     try:
         print(str(instance.card_image_link))
-        os.remove(str(instance.card_image_link))
+        # along with the smaller copies of a render
+        delete_render(instance.card_image_link.name,
+                      instance.card_render_key)
     except Exception as e:
         print(e)
         pass
+
+
+# Keeps the collection bitmaps used for ownership checks in step with
+# user_profile_collected_cards (see cardgame.ownership).
+@receiver(m2m_changed, sender=UserProfile.user_profile_collected_cards.through)
+def update_collection_bitmap(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    if reverse and action == "pre_clear":
+        # Clearing a card's owners doesn't say who they were afterwards
+        instance._bitmap_owners = _owners(instance)
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        bitmap = rebuild(instance.pk)
+        # Keep the instance's cached bitmap current for the caller
+        if "collection_bitmap" in instance._state.fields_cache:
+            instance.collection_bitmap = CollectionBitmap(
+                profile=instance, bits=bitmap.to_bytes())
+        return
+    if action == "post_clear":
+        pk_set = instance.__dict__.pop("_bitmap_owners", ())
+    for profile_id in pk_set or ():
+        rebuild(profile_id)
+
+
+# Deleting a card removes it from collections without m2m_changed, and
+# its card_index may be handed out again.
+@receiver(pre_delete, sender=Card)
+def remember_card_owners(sender, instance, **kwargs):
+    instance._bitmap_owners = _owners(instance)
+
+
+@receiver(post_delete, sender=Card)
+def update_owner_bitmaps(sender, instance, **kwargs):
+    for profile_id in instance.__dict__.pop("_bitmap_owners", ()):
+        rebuild(profile_id)
+
+
+def _owners(card):
+    return list(UserProfile.user_profile_collected_cards.through.objects
+                .filter(card_id=card.pk)
+                .values_list("userprofile_id", flat=True))
+
+
+# New players join the leaderboard straight away; the code that changes
+# points moves existing ones (see cardgame.leaderboard).
+@receiver(post_save, sender=UserProfile)
+def add_to_leaderboard(sender, instance, created, **kwargs):
+    if created:
+        record(instance)
+
+
+@receiver(post_delete, sender=UserProfile)
+def remove_from_leaderboard(sender, instance, **kwargs):
+    leaderboard.remove(instance.pk)
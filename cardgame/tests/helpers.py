@@ -0,0 +1,14 @@
+"""
+Helpers shared by the test modules.
+"""
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+from cardgame.models import UserProfile
+
+
+def make_player(name):
+    user = User.objects.create_user(username=name, password="secret")
+    profile = UserProfile.objects.create(user=user, user_profile_points=0,
+                                         user_signup_date=timezone.now())
+    return user, profile
@@ -0,0 +1,440 @@
+"""
+Tests for battles: the in-memory BattleState and the BattleConsumer
+playing a game over websockets.
+"""
+
+import json
+from datetime import timedelta
+from unittest.mock import patch
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from cardgame.battle_protocol import CODECS, negotiate
+from cardgame.battle_reaper import reap
+from cardgame.battle_state import BattleError, BattleState, battle_states
+from cardgame.consumers import BattleConsumer
+from cardgame.instrumentation import Histogram, metrics
+from cardgame.leaderboard import leaderboard
+from cardgame.models import Battle, BattleDeck, BattleSummary, Card
+from cardgame.routing import websocket_urlpatterns
+from cardgame.tests.helpers import make_player
+
+
+class BattleTestMixin:
+
+    def setUp(self):
+        battle_states.discard("room1")
+        leaderboard.clear()
+        self.user1, self.profile1 = make_player("alice")
+        self.user2, self.profile2 = make_player("bob")
+        self.cards = [
+            Card.objects.create(card_name=f"Card{i}", card_subtitle="Sub",
+                                card_description="Desc",
+                                environmental_friendliness=i, beauty=i,
+                                cost=i)
+            for i in range(8)
+        ]
+        self.profile1.user_profile_collected_cards.set(self.cards[:4])
+        self.profile2.user_profile_collected_cards.set(self.cards[4:])
+
+    def tearDown(self):
+        battle_states.discard("room1")
+        leaderboard.clear()
+
+    def start_battle(self, room_id="room1"):
+        battle = Battle.objects.create(room_id=room_id,
+                                       player1=self.profile1,
+                                       player2=self.profile2,
+                                       status="in_progress")
+        for profile, cards, seed in ((self.profile1, self.cards[:4], 1),
+                                     (self.profile2, self.cards[4:], 2)):
+            deck = BattleDeck.objects.create(battle=battle, player=profile,
+                                             shuffle_seed=seed)
+            deck.cards.set(cards)
+        return battle
+
+
+class BattleStateTestCase(BattleTestMixin, TransactionTestCase):
+
+    def test_rounds_are_played_in_memory(self):
+        self.start_battle()
+        state = BattleState.load("room1")
+        with self.assertNumQueries(0):
+            cards = state.current_cards(1)
+            result = state.play(1, "beauty")
+        self.assertEqual(cards["cards_remaining"], 4)
+        self.assertTrue(cards["is_my_turn"])
+        # player 2 holds the cards with the higher stats
+        self.assertEqual(result["result"], "player2")
+        self.assertEqual(result["next_turn"], 2)
+        self.assertEqual(state.scores, [0, 1])
+
+    def test_moves_are_checked(self):
+        self.start_battle()
+        state = BattleState.load("room1")
+        with self.assertRaises(BattleError):
+            state.play(2, "beauty")
+        with self.assertRaises(BattleError):
+            state.play(1, "strength")
+
+    def test_checkpoint_is_reloaded(self):
+        self.start_battle()
+        state = BattleState.load("room1")
+        state.play(1, "cost")
+        state.play(2, "beauty")
+        state.checkpoint()
+        reloaded = BattleState.load("room1")
+        self.assertEqual(reloaded.index, 2)
+        self.assertEqual(reloaded.scores, state.scores)
+        self.assertEqual(reloaded.current_turn, 1)
+        self.assertEqual(reloaded.decks, state.decks)
+
+    def test_stored_order_is_played(self):
+        battle = self.start_battle()
+        for deck in BattleDeck.objects.filter(battle=battle):
+            deck.shuffle(deck.cards.values_list("card_name", flat=True))
+            deck.save()
+        p1_deck = BattleDeck.objects.get(battle=battle,
+                                         player=self.profile1)
+        # battle, decks and the cards of both decks
+        with self.assertNumQueries(3):
+            state = BattleState.load("room1")
+        self.assertEqual([card.name for card in state.decks[0]],
+                         p1_deck.card_order)
+
+    def test_order_does_not_depend_on_row_order(self):
+        deck = BattleDeck(shuffle_seed=42)
+        deck.shuffle(["a", "b", "c", "d"])
+        order = deck.card_order
+        deck.shuffle(["d", "c", "b", "a"])
+        self.assertEqual(deck.card_order, order)
+        self.assertEqual(sorted(order), ["a", "b", "c", "d"])
+
+    def test_round_played_elsewhere_is_observed(self):
+        self.start_battle()
+        battle_states.start("room1")
+        played = BattleState.load("room1")
+        result = played.play(1, "beauty")
+        battle_states.observe("room1", result)
+        state = battle_states.cached("room1")
+        self.assertEqual((state.index, state.scores, state.current_turn),
+                         (1, [0, 1], 2))
+        # the echo of the same round changes nothing
+        battle_states.observe("room1", result)
+        self.assertEqual(state.index, 1)
+        battle_states.observe("room1", {"event": "battle_completed"})
+        self.assertIsNone(battle_states.cached("room1"))
+
+    def test_state_needs_both_decks(self):
+        Battle.objects.create(room_id="room1", player1=self.profile1,
+                              player2=self.profile2, status="in_progress")
+        with self.assertRaises(BattleError):
+            BattleState.load("room1")
+
+    def test_completed_battle_is_not_loaded(self):
+        self.start_battle()
+        Battle.objects.filter(room_id="room1").update(status="completed")
+        with self.assertRaisesMessage(BattleError, "This battle has ended"):
+            BattleState.load("room1")
+
+    def test_battle_is_only_finished_once(self):
+        self.start_battle()
+        state = BattleState.load("room1")
+        while not state.finished:
+            state.play(state.current_turn, "beauty")
+        consumer = BattleConsumer()
+        consumer.room_id = "room1"
+        first = async_to_sync(consumer.finish_battle)(state)
+        # e.g. a replayed select_stat for the last round
+        second = async_to_sync(consumer.finish_battle)(state)
+        self.assertEqual(first["event"], "battle_completed")
+        self.assertEqual(second, {"event": "error",
+                                  "message": "This battle has ended"})
+        self.profile2.refresh_from_db()
+        self.assertEqual(self.profile2.user_profile_points, 10)
+
+
+class BattleConsumerTestCase(BattleTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.received = {}
+        metrics.clear()
+
+    def connect(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             "/ws/battle/room1/",
+                                             subprotocols=subprotocols)
+        communicator.scope["user"] = user
+        self.received[communicator] = []
+        return communicator
+
+    async def receive_event(self, communicator, event, **match):
+        """
+        Returns the next event of the given type, unpacking batches.
+        Every event received is kept in self.received.
+        """
+        received = self.received[communicator]
+        start = getattr(communicator, "read", 0)
+        while True:
+            for i in range(start, len(received)):
+                message = received[i]
+                if message["event"] == event and all(
+                        message.get(k) == v for k, v in match.items()):
+                    communicator.read = i + 1
+                    return message
+            start = len(received)
+            frame = json.loads(await communicator.receive_from(timeout=5))
+            received.extend(frame["events"] if frame["event"] == "batch"
+                            else [frame])
+
+    def test_full_battle(self):
+        with patch.object(BattleState, "load",
+                          wraps=BattleState.load) as load:
+            async_to_sync(self.play_battle)()
+        # loaded once when both players were ready, not on every move
+        self.assertEqual(load.call_count, 1)
+        battle = Battle.objects.get(room_id="room1")
+        self.assertEqual(battle.status, "completed")
+        self.assertEqual((battle.player1_score, battle.player2_score),
+                         (0, 4))
+        self.assertEqual(battle.winner, self.profile2)
+        self.assertEqual(
+            set(BattleDeck.objects.values_list("current_card_index",
+                                               flat=True)), {4})
+        self.assertEqual(len(battle_states), 0)
+        for deck in BattleDeck.objects.all():
+            self.assertEqual(sorted(deck.card_order),
+                             sorted(deck.cards.values_list("card_name",
+                                                           flat=True)))
+        self.profile2.refresh_from_db()
+        self.assertEqual(self.profile2.user_profile_points, 10)
+
+        handlers = metrics.as_dict()
+        self.assertEqual(handlers["setup_battle"]["wall_ms"]["count"], 2)
+        self.assertEqual(handlers["handle_select_cards"]["errors"], 0)
+        self.assertGreater(handlers["handle_select_cards"]["queries"]["sum"],
+                           0)
+        # rounds are played in memory, only checkpoints hit the database
+        cards = handlers["handle_request_current_cards"]
+        self.assertEqual(cards["wall_ms"]["count"], 4)
+        self.assertEqual(cards["queries"]["sum"], 0)
+        self.assertEqual(cards["sync_ms"]["sum"], 0)
+        stats = handlers["handle_select_stat"]
+        self.assertEqual(stats["queries"]["count"], 4)
+        self.assertGreater(stats["sync_ms"]["sum"], 0)
+        self.assertLessEqual(stats["sync_ms"]["sum"], stats["wall_ms"]["sum"])
+
+    async def play_battle(self):
+        alice, bob = self.connect(self.user1), self.connect(self.user2)
+        await alice.connect()
+        await self.receive_event(alice, "battle_created")
+        await bob.connect()
+        await self.receive_event(bob, "battle_joined")
+        for player, cards in ((alice, self.cards[:4]),
+                              (bob, self.cards[4:])):
+            await player.send_json_to({
+                "event": "select_cards",
+                "card_ids": [c.card_name for c in cards]})
+            selected = await self.receive_event(player, "cards_selected")
+            self.assertEqual(sorted(card["name"]
+                                    for card in selected["deck"]),
+                             [c.card_name for c in cards])
+        for player in (alice, bob):
+            await player.send_json_to({"event": "ready"})
+            await self.receive_event(player, "player_ready")
+
+        # round results are also echoed to the room, so the turn is taken
+        # from current_cards, which only goes to whoever asked
+        for round_number in range(4):
+            await alice.send_json_to({"event": "request_current_cards"})
+            cards = await self.receive_event(alice, "current_cards")
+            player = alice if cards["is_my_turn"] else bob
+            await player.send_json_to({"event": "select_stat",
+                                       "stat": "beauty"})
+            if round_number < 3:
+                await self.receive_event(alice, "round_result",
+                                         cards_remaining=3 - round_number)
+        result = await self.receive_event(player, "battle_completed")
+        self.assertEqual(result["winner"], "bob")
+        # the last round's result comes in the same frame
+        self.assertEqual(
+            self.received[player][-2]["cards_remaining"], 0)
+        await self.receive_event(alice, "battle_completed")
+        # every round reached each player exactly once
+        for communicator in (alice, bob):
+            rounds = [m["cards_remaining"]
+                      for m in self.received[communicator]
+                      if m["event"] == "round_result"]
+            self.assertEqual(rounds, [3, 2, 1, 0])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    def test_only_owned_cards_can_be_selected(self):
+        async def run():
+            alice = self.connect(self.user1)
+            await alice.connect()
+            await self.receive_event(alice, "battle_created")
+            await alice.send_json_to({
+                "event": "select_cards",
+                "card_ids": [c.card_name for c in self.cards[2:6]]})
+            error = await self.receive_event(alice, "error")
+            await alice.disconnect()
+            return error
+
+        error = async_to_sync(run)()
+        self.assertIn("collection", error["message"])
+        self.assertFalse(BattleDeck.objects.exists())
+
+    def test_deck_is_written_in_bulk(self):
+        async def run():
+            alice = self.connect(self.user1)
+            await alice.connect()
+            await self.receive_event(alice, "battle_created")
+            queries = []
+            for cards in (self.cards[:4], self.cards[4:]):
+                await alice.send_json_to({
+                    "event": "select_cards",
+                    "card_ids": [c.card_name for c in cards]})
+                await self.receive_event(alice, "cards_selected")
+                queries.append(metrics.as_dict()["handle_select_cards"]
+                               ["queries"]["sum"])
+            await alice.disconnect()
+            return queries
+
+        self.profile1.user_profile_collected_cards.set(self.cards)
+        first, total = async_to_sync(run)()
+        # Reselecting: profile, battle, owned cards, BEGIN, deck, then
+        # one DELETE and one INSERT of the deck's cards, and the deck
+        self.assertEqual(total - first, 8)
+        deck = BattleDeck.objects.get()
+        self.assertEqual(sorted(deck.cards.values_list("card_name",
+                                                       flat=True)),
+                         [c.card_name for c in self.cards[4:]])
+
+    def test_encoding_is_negotiated(self):
+        async def run():
+            alice = self.connect(self.user1, ["unknown", "battle.json"])
+            connected, subprotocol = await alice.connect()
+            self.assertEqual(subprotocol, "battle.json")
+            frame = await alice.receive_from(timeout=5)
+            self.assertIsInstance(frame, str)
+            await alice.disconnect()
+        async_to_sync(run)()
+
+    def test_binary_encoding(self):
+        if "battle.orjson" not in CODECS:
+            self.skipTest("orjson is not installed")
+
+        async def run():
+            alice = self.connect(self.user1, ["battle.orjson"])
+            connected, subprotocol = await alice.connect()
+            self.assertEqual(subprotocol, "battle.orjson")
+            frame = await alice.receive_from(timeout=5)
+            self.assertIsInstance(frame, bytes)
+            self.assertEqual(json.loads(frame)["event"], "battle_created")
+            await alice.disconnect()
+        async_to_sync(run)()
+
+    def test_no_subprotocol_gets_json(self):
+        self.assertIsNone(negotiate([]).subprotocol)
+        self.assertIsNone(negotiate(["foo"]).subprotocol)
+        self.assertFalse(negotiate(["foo"]).binary)
+
+    def test_unknown_subprotocol_is_not_accepted(self):
+        async def run():
+            alice = self.connect(self.user1, ["foo"])
+            connected, subprotocol = await alice.connect()
+            self.assertTrue(connected)
+            self.assertIsNone(subprotocol)
+            frame = await alice.receive_from(timeout=5)
+            self.assertEqual(json.loads(frame)["event"], "battle_created")
+            await alice.disconnect()
+        async_to_sync(run)()
+
+
+class HistogramTestCase(SimpleTestCase):
+
+    def test_values_are_counted_by_bucket(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 3, 10, 11, 500):
+            histogram.observe(value)
+        self.assertEqual(histogram.as_dict(), {
+            "count": 6, "sum": 525.5,
+            "buckets": {"1": 2, "10": 2, "+Inf": 2}})
+
+
+class BattleReaperTestCase(BattleTestMixin, TestCase):
+
+    def age(self, battle, seconds):
+        """Makes battle look untouched for seconds, after a 1 min game."""
+        now = timezone.now()
+        Battle.objects.filter(pk=battle.pk).update(
+            created_at=now - timedelta(seconds=seconds + 60),
+            updated_at=now - timedelta(seconds=seconds))
+
+    def test_completed_battles_are_archived(self):
+        battles = [self.start_battle(f"room{i}") for i in range(3)]
+        for battle in battles:
+            battle.status = "completed"
+            battle.player2_score = 4
+            battle.winner = self.profile2
+            battle.save()
+            self.age(battle, 600)
+        recent = self.start_battle("recent")
+        recent.status = "completed"
+        recent.save()
+
+        # batches of 2: two batches plus the empty read that ends them
+        self.assertEqual(reap(batch_size=2), (3, 0))
+        self.assertEqual(list(Battle.objects.values_list("room_id",
+                                                         flat=True)),
+                         ["recent"])
+        self.assertEqual(BattleDeck.objects.count(), 2)
+        self.assertEqual(BattleDeck.cards.through.objects.count(), 8)
+        summaries = BattleSummary.history(self.profile1)
+        self.assertEqual(len(summaries), 3)
+        self.assertEqual((summaries[0].player2_score, summaries[0].winner),
+                         (4, self.profile2))
+        self.assertEqual(summaries[0].duration.seconds, 60)
+        self.assertEqual(BattleSummary.history(self.profile2).count(), 3)
+
+    def test_idle_battles_expire(self):
+        idle = self.start_battle("idle")
+        idle.status = "selecting"
+        idle.save()
+        self.age(idle, 7200)
+        active = self.start_battle("active")
+        self.age(active, 60)
+
+        self.assertEqual(reap(), (0, 1))
+        self.assertEqual(list(Battle.objects.values_list("room_id",
+                                                         flat=True)),
+                         ["active"])
+        self.assertEqual(BattleSummary.objects.count(), 0)
+
+    def test_query_count_does_not_grow_with_battles(self):
+        counts = []
+        for battles in (1, 6):
+            for i in range(battles):
+                battle = self.start_battle(f"room{battles}_{i}")
+                battle.status = "completed"
+                battle.save()
+                self.age(battle, 600)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(reap(), (battles, 0))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_command(self):
+        battle = self.start_battle()
+        battle.status = "completed"
+        battle.save()
+        self.age(battle, 600)
+        call_command("reap_battles", "--once", stdout=open("/dev/null", "w"))
+        self.assertEqual(BattleSummary.objects.count(), 1)
@@ -0,0 +1,74 @@
+"""
+Tests for the SQLite channel layer, using two layer instances on the same
+file to stand in for two worker processes.
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+from cardgame.channel_layers import SQLiteChannelLayer, channel_process
+
+
+class SQLiteChannelLayerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        path = os.path.join(self.tmp, "channels.sqlite3")
+        self.first = SQLiteChannelLayer(path=path, socket_dir=self.tmp)
+        self.second = SQLiteChannelLayer(path=path, socket_dir=self.tmp)
+
+    def tearDown(self):
+        async_to_sync(self.first.close)()
+        async_to_sync(self.second.close)()
+        shutil.rmtree(self.tmp)
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), timeout=5)
+
+    def test_group_send_reaches_both_processes(self):
+        async def run():
+            here = await self.first.new_channel()
+            there = await self.second.new_channel()
+            await self.first.group_add("room", here)
+            await self.second.group_add("room", there)
+            await self.first.group_send("room", {"type": "hello",
+                                                 "data": b"\x00\x01"})
+            return (await self.receive(self.first, here),
+                    await self.receive(self.second, there))
+        local, remote = async_to_sync(run)()
+        self.assertEqual(local, {"type": "hello", "data": b"\x00\x01"})
+        self.assertEqual(remote, local)
+
+    def test_group_discard(self):
+        async def run():
+            there = await self.second.new_channel()
+            await self.second.group_add("room", there)
+            await self.second.group_discard("room", there)
+            await self.first.group_send("room", {"type": "hello"})
+            await self.second.send(there, {"type": "direct"})
+            return await self.receive(self.second, there)
+        self.assertEqual(async_to_sync(run)(), {"type": "direct"})
+
+    def test_general_channel(self):
+        async def run():
+            await self.first.send("worker", {"type": "job", "n": 1})
+            return await self.receive(self.second, "worker")
+        self.assertEqual(async_to_sync(run)(), {"type": "job", "n": 1})
+
+    def test_exited_process_is_forgotten(self):
+        async def run():
+            there = await self.second.new_channel()
+            await self.second.group_add("room", there)
+            # the second process exits without leaving its groups
+            self.second._remove_wake_socket()
+            await self.first.group_send("room", {"type": "hello"})
+            return await self.first._run(self.first._group_members, "room")
+        self.assertEqual(async_to_sync(run)(), [])
+
+    def test_channel_names_carry_process(self):
+        name = async_to_sync(self.first.new_channel)()
+        self.assertEqual(channel_process(name), self.first.process_id)
+        self.assertEqual(channel_process("worker"), "")
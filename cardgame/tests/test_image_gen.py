@@ -0,0 +1,363 @@
+"""
+Tests for the card image generation helpers in image_gen.
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from io import BytesIO, StringIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from image_gen import (AssetCache, CardSpec, make_image, render_cards,
+                       asset_cache, DERIVATIVE_SIZES, DESC_BOX, DESC_FONT,
+                       DESC_SIZE, TEMPLATE_VERSION)
+from text_layout import fit_text, line_height, wrap_text
+from cardgame.models import Card, RenderJob
+from cardgame.rendering import RENDER_DIR, derivative_name, read_source
+from cardgame.render_queue import claim_next, enqueue, process_pending
+
+
+class AssetCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.back = os.path.join(self.tmp, "back.png")
+        Image.new("RGB", (100, 100), color="blue").save(self.back)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_background_is_cached_and_copied(self):
+        cache = AssetCache()
+        first = cache.background(self.back)
+        second = cache.background(self.back)
+        self.assertEqual(first.size, (1200, 1600))
+        self.assertIsNot(first, second)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_replaced_background_is_reloaded(self):
+        cache = AssetCache()
+        cache.background(self.back)
+        Image.new("RGB", (100, 100), color="red").save(self.back)
+        # make sure the mtime changes even on coarse filesystems
+        stat = os.stat(self.back)
+        os.utime(self.back, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 1_000_000_000))
+        back = cache.background(self.back)
+        self.assertEqual(back.getpixel((0, 0)), (255, 0, 0))
+        self.assertEqual(cache.stats()["misses"], 2)
+        self.assertEqual(cache.stats()["entries"], 1)
+
+    def test_make_image_reuses_fonts(self):
+        front = os.path.join(self.tmp, "front.png")
+        Image.new("RGB", (50, 50), color="green").save(front)
+        asset_cache.clear()
+        make_image(self.back, "Title", "a short description", front, 1, 2, 3)
+        misses = asset_cache.stats()["misses"]
+        make_image(self.back, "Title", "a short description", front, 1, 2, 3)
+        self.assertEqual(asset_cache.stats()["misses"], misses)
+        self.assertGreater(asset_cache.stats()["hits"], 0)
+
+
+class RenderCardsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.back = os.path.join(self.tmp, "back.png")
+        Image.new("RGB", (100, 100), color="blue").save(self.back)
+        front = BytesIO()
+        Image.new("RGB", (50, 50), color="green").save(front, format="PNG")
+        self.front = front.getvalue()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def spec(self, key):
+        return CardSpec(key, key, "desc", self.front, 1, 2, 3)
+
+    def test_render_cards_in_process_pool(self):
+        results = list(render_cards([self.spec("a"), self.spec("b"),
+                                     self.spec("c")],
+                                    workers=2, background=self.back))
+        self.assertEqual(sorted(r.key for r in results), ["a", "b", "c"])
+        for r in results:
+            self.assertIsNone(r.error)
+            self.assertEqual(Image.open(BytesIO(r.png)).size, (1200, 1600))
+
+    def test_failed_card_does_not_stop_batch(self):
+        results = list(render_cards([self.spec("ok"),
+                                     self.spec("broken")._replace(
+                                         image="/no/such/file.png")],
+                                    workers=1, background=self.back))
+        errors = {r.key: r.error for r in results}
+        self.assertIsNone(errors["ok"])
+        self.assertIsNotNone(errors["broken"])
+
+    def test_render_cards_command(self):
+        with override_settings(MEDIA_ROOT=self.tmp):
+            card = Card.objects.create(card_name="Stoat",
+                                       card_subtitle="Subtitle",
+                                       card_description="Desc")
+            name = default_storage.save("static/card_images/stoat.png",
+                                        ContentFile(self.front))
+            Card.objects.filter(pk=card.pk).update(card_source_image=name,
+                                                   card_image_link=name)
+            out = StringIO()
+            call_command("render_cards", "--workers", "1", stdout=out)
+            card.refresh_from_db()
+            self.assertIn("Stoat:", out.getvalue())
+            self.assertNotEqual(card.card_image_link.name, name)
+            self.assertEqual(card.card_source_image.name, name)
+            with default_storage.open(card.card_image_link.name) as f:
+                self.assertEqual(Image.open(f).size, (1200, 1600))
+
+            # Rendering again starts from the picture, not the last render
+            rendered = card.card_image_link.name
+            call_command("render_cards", "--workers", "1", "--force",
+                         stdout=StringIO())
+            card.refresh_from_db()
+            self.assertEqual(card.card_image_link.name, rendered)
+
+    def test_template_change_replaces_old_render(self):
+        with override_settings(MEDIA_ROOT=self.tmp):
+            card = Card.objects.create(card_name="Stoat",
+                                       card_subtitle="Subtitle",
+                                       card_description="Desc")
+            name = default_storage.save("static/card_images/stoat.png",
+                                        ContentFile(self.front))
+            Card.objects.filter(pk=card.pk).update(card_source_image=name,
+                                                   card_image_link=name)
+            rendered = os.path.join(self.tmp, RENDER_DIR)
+            call_command("render_cards", "--workers", "1",
+                         stdout=StringIO())
+            before = sorted(os.listdir(rendered))
+            self.assertEqual(len(before), 1 + len(DERIVATIVE_SIZES))
+
+            with patch("cardgame.rendering.TEMPLATE_VERSION",
+                       TEMPLATE_VERSION + 1):
+                call_command("render_cards", "--workers", "1",
+                             stdout=StringIO())
+            after = sorted(os.listdir(rendered))
+            self.assertEqual(len(after), len(before))
+            self.assertFalse(set(before) & set(after))
+
+    def test_cards_without_source_are_skipped(self):
+        with override_settings(MEDIA_ROOT=self.tmp):
+            card = Card.objects.create(card_name="Stoat",
+                                       card_subtitle="Subtitle",
+                                       card_description="Desc")
+            # a card rendered before source pictures were kept
+            name = default_storage.save("static/card_images/stoat.png",
+                                        ContentFile(self.front))
+            Card.objects.filter(pk=card.pk).update(card_image_link=name)
+            out, err = StringIO(), StringIO()
+            call_command("render_cards", "--workers", "1", stdout=out,
+                         stderr=err)
+            card.refresh_from_db()
+            self.assertIn("Stoat: no source picture, skipped", err.getvalue())
+            self.assertIn("1 skipped", out.getvalue())
+            self.assertEqual(card.card_image_link.name, name)
+            self.assertFalse(card.card_source_image)
+
+
+class RenderCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.tmp)
+        self.settings.enable()
+        front = BytesIO()
+        Image.new("RGB", (50, 50), color="green").save(front, format="PNG")
+        self.card = Card.objects.create(
+            card_name="Professor Solomon Oyelere",
+            card_subtitle="Subtitle",
+            card_description="Desc",
+            card_image_link=SimpleUploadedFile("prof.png",
+                                               front.getvalue()),
+        )
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.tmp)
+
+    def test_render_is_content_addressed(self):
+        name = self.card.card_image_link.name
+        self.assertTrue(name.startswith("static/card_images/rendered/"))
+        self.assertTrue(self.card.card_source_image.name.startswith(
+            "static/card_images/sources/"))
+        self.assertTrue(default_storage.exists(name))
+
+    def test_unrelated_change_skips_render(self):
+        name = self.card.card_image_link.name
+        card = Card.objects.get(pk=self.card.pk)
+        card.card_subtitle = "Another subtitle"
+        with patch("cardgame.rendering.render_png") as render:
+            card.save()
+            render.assert_not_called()
+        self.assertEqual(card.card_image_link.name, name)
+        self.assertEqual(
+            len([f for f in os.listdir(os.path.join(
+                self.tmp, "static", "card_images", "rendered"))
+                if f.endswith(".png")]), 1)
+
+    def test_changed_stat_renders_again(self):
+        old = self.card.card_image_link.name
+        card = Card.objects.get(pk=self.card.pk)
+        card.beauty = 7
+        card.save()
+        self.assertNotEqual(card.card_image_link.name, old)
+        self.assertTrue(default_storage.exists(card.card_image_link.name))
+        self.assertFalse(default_storage.exists(old))
+
+    def test_derivatives_are_stored(self):
+        key = self.card.card_render_key
+        for size, dims in DERIVATIVE_SIZES.items():
+            name = derivative_name(key, size, "webp")
+            with default_storage.open(name) as f:
+                self.assertEqual(Image.open(f).size, dims)
+        self.assertTrue(self.card.image_url("thumb").endswith(
+            f"{key}_thumb.webp"))
+        self.assertEqual(len(self.card.image_srcset().split(", ")), 3)
+        (mime, srcset), = self.card.image_sources()
+        self.assertEqual(mime, "image/webp")
+        # the PNG is only offered by the <img> fallback
+        urls = [entry.split()[0] for entry in srcset.split(", ")]
+        self.assertEqual(len(urls), len(DERIVATIVE_SIZES))
+        self.assertTrue(all(url.endswith(".webp") for url in urls))
+
+    def test_deleting_card_removes_render_and_derivatives(self):
+        rendered = os.path.join(self.tmp, RENDER_DIR)
+        self.assertTrue(os.listdir(rendered))
+        self.card.delete()
+        self.assertEqual(os.listdir(rendered), [])
+
+    def test_card_without_render_uses_full_image(self):
+        card = Card.objects.create(card_name="Plain",
+                                   card_subtitle="Subtitle",
+                                   card_description="Desc")
+        self.assertEqual(card.image_url("thumb"), card.card_image_link.url)
+        self.assertEqual(card.image_sources(), [])
+
+
+class LegacyCardTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.tmp)
+        self.settings.enable()
+        # Cards saved before source pictures were kept only have the
+        # finished card image
+        rendered = BytesIO()
+        Image.new("RGB", (1200, 1600), color="red").save(
+            rendered, format="PNG")
+        self.name = default_storage.save("static/card_images/Comida.png",
+                                         ContentFile(rendered.getvalue()))
+        card = Card.objects.create(card_name="Comida",
+                                   card_subtitle="Subtitle",
+                                   card_description="Desc")
+        Card.objects.filter(pk=card.pk).update(card_image_link=self.name)
+        self.card = Card.objects.get(pk=card.pk)
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.tmp)
+
+    def test_saving_keeps_the_rendered_image(self):
+        self.card.card_description = "New description"
+        self.card.save()
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.card_image_link.name, self.name)
+        self.assertFalse(self.card.card_source_image)
+        self.assertFalse(default_storage.exists("static/card_images/rendered"))
+
+    def test_rendered_image_is_not_a_source(self):
+        with self.assertRaises(ValueError):
+            read_source(self.card)
+        self.assertFalse(self.card.card_source_image)
+
+
+class TextLayoutTestCase(TestCase):
+
+    def setUp(self):
+        self.font = asset_cache.font(DESC_FONT, DESC_SIZE)
+
+    def test_lines_fit_width(self):
+        text = "the quick brown fox jumps over the lazy dog " * 10
+        lines = wrap_text(text, self.font, 500)
+        self.assertGreater(len(lines), 1)
+        for line in lines:
+            self.assertLessEqual(self.font.getlength(line), 500)
+        self.assertEqual(" ".join(lines).split(), text.split())
+
+    def test_long_word_is_broken(self):
+        lines = wrap_text("a " + "x" * 100 + " b", self.font, 300)
+        self.assertEqual("".join(lines).replace(" ", ""),
+                         "a" + "x" * 100 + "b")
+        for line in lines:
+            self.assertLessEqual(self.font.getlength(line), 300)
+
+    def test_layout_is_memoized(self):
+        wrap_text("memoized text", self.font, 400)
+        hits = wrap_text.cache_info().hits
+        wrap_text("memoized text", self.font, 400)
+        self.assertEqual(wrap_text.cache_info().hits, hits + 1)
+
+    def test_long_description_fits_box(self):
+        text = "word " * 80  # the longest description a card can have
+        font, lines = fit_text(text,
+                               lambda size: asset_cache.font(DESC_FONT, size),
+                               DESC_BOX[2], DESC_BOX[3], DESC_SIZE)
+        self.assertLess(font.size, DESC_SIZE)
+        self.assertLessEqual(len(lines) * line_height(font), DESC_BOX[3])
+
+
+class RenderQueueTestCase(TestCase):
+
+    def test_missing_source_fails_job(self):
+        card = Card.objects.create(card_name="Ghost",
+                                   card_subtitle="Subtitle",
+                                   card_description="Desc",
+                                   card_source_image="no/such/file.png")
+        job = enqueue(card)
+        self.assertEqual(process_pending(), 1)
+        job.refresh_from_db()
+        card.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertTrue(job.error)
+        self.assertEqual(card.card_image_link.name,
+                         "static/card_images/do_not_remove.png")
+
+    def test_abandoned_job_is_run_again(self):
+        card = Card.objects.create(card_name="Ghost",
+                                   card_subtitle="Subtitle",
+                                   card_description="Desc",
+                                   card_source_image="no/such/file.png")
+        stale = enqueue(card)
+        busy = enqueue(card)
+        # Both claimed, and then the worker died; only stale was claimed
+        # long enough ago to be given up on
+        claim_next()
+        claim_next()
+        RenderJob.objects.filter(pk=stale.pk).update(
+            started_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(process_pending(), 1)
+        stale.refresh_from_db()
+        busy.refresh_from_db()
+        self.assertEqual(stale.status, "failed")
+        self.assertEqual(busy.status, "running")
+
+    def test_job_is_only_claimed_once(self):
+        card = Card.objects.create(card_name="Once",
+                                   card_subtitle="Subtitle",
+                                   card_description="Desc")
+        enqueue(card)
+        self.assertIsNotNone(claim_next())
+        self.assertIsNone(claim_next())
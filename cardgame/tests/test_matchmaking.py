@@ -0,0 +1,137 @@
+"""
+Tests for the matchmaking queue and the MatchmakingConsumer.
+"""
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import (SimpleTestCase, TransactionTestCase,
+                         override_settings)
+from cardgame.matchmaking import MatchmakingQueue, matchmaking_queue
+from cardgame.models import Battle
+from cardgame.routing import websocket_urlpatterns
+from cardgame.tests.helpers import make_player
+
+
+class MatchmakingQueueTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.queue = MatchmakingQueue()
+
+    def test_first_player_waits(self):
+        self.assertIsNone(self.queue.join("c1", 1, "alice", 50))
+        self.assertEqual(len(self.queue), 1)
+        self.assertIn("c1", self.queue)
+
+    def test_closest_points_are_paired(self):
+        for channel, profile_id, points in (("c1", 1, 10), ("c2", 2, 100),
+                                            ("c3", 3, 60)):
+            self.assertIsNone(self.queue.join(channel, profile_id,
+                                              f"p{profile_id}", points,
+                                              max_gap=5))
+        opponent = self.queue.join("c4", 4, "p4", 90, max_gap=20)
+        self.assertEqual(opponent.channel_name, "c2")
+        opponent = self.queue.join("c5", 5, "p5", 40, max_gap=20)
+        self.assertEqual(opponent.channel_name, "c3")
+        self.assertEqual(len(self.queue), 1)
+
+    def test_gap_can_be_widened(self):
+        self.queue.join("c1", 1, "p1", 0, max_gap=10)
+        self.queue.join("c2", 2, "p2", 500, max_gap=10)
+        self.assertIsNone(self.queue.rematch("c1", max_gap=10))
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.rematch("c1").channel_name, "c2")
+        self.assertEqual(len(self.queue), 0)
+        self.assertIsNone(self.queue.rematch("c1"))
+
+    def test_longest_waiting_wins_ties(self):
+        self.queue.join("c1", 1, "p1", 50)
+        self.queue.join("c2", 2, "p2", 50, max_gap=-1)
+        self.assertEqual(self.queue.join("c3", 3, "p3", 50).channel_name,
+                         "c1")
+
+    def test_player_is_not_paired_with_themselves(self):
+        self.queue.join("c1", 1, "alice", 50)
+        self.assertIsNone(self.queue.join("c2", 1, "alice", 50))
+        self.queue.join("c3", 2, "bob", 0, max_gap=10)
+        self.assertEqual(self.queue.join("c4", 1, "alice", 50).channel_name,
+                         "c3")
+
+    def test_leave(self):
+        self.queue.join("c1", 1, "alice", 50)
+        self.queue.leave("c1")
+        self.queue.leave("c1")
+        self.assertEqual(len(self.queue), 0)
+        self.assertIsNone(self.queue.join("c2", 2, "bob", 50))
+
+
+class MatchmakingConsumerTestCase(TransactionTestCase):
+
+    def setUp(self):
+        matchmaking_queue.clear()
+        self.user1, self.profile1 = make_player("alice")
+        self.user2, self.profile2 = make_player("bob")
+
+    def tearDown(self):
+        matchmaking_queue.clear()
+
+    def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             "/ws/matchmaking/")
+        communicator.scope["user"] = user
+        return communicator
+
+    def test_players_are_matched_into_a_battle(self):
+        async def run():
+            alice, bob = self.connect(self.user1), self.connect(self.user2)
+            await alice.connect()
+            queued = await alice.receive_json_from(timeout=5)
+            self.assertEqual(queued, {"event": "queued", "waiting": 1})
+            await bob.connect()
+            bob_match = await bob.receive_json_from(timeout=5)
+            alice_match = await alice.receive_json_from(timeout=5)
+            await alice.disconnect()
+            await bob.disconnect()
+            return alice_match, bob_match
+
+        alice_match, bob_match = async_to_sync(run)()
+        self.assertEqual(alice_match["event"], "match_found")
+        self.assertEqual(alice_match["room_id"], bob_match["room_id"])
+        self.assertEqual(alice_match["opponent_name"], "bob")
+        self.assertEqual(bob_match["opponent_name"], "alice")
+        battle = Battle.objects.get(room_id=alice_match["room_id"])
+        self.assertEqual((battle.player1, battle.player2, battle.status),
+                         (self.profile1, self.profile2, "selecting"))
+        self.assertEqual(len(matchmaking_queue), 0)
+
+    @override_settings(MATCHMAKING_POINTS_GAP=10,
+                       MATCHMAKING_WIDEN_AFTER=0.1)
+    def test_distant_players_are_matched_after_waiting(self):
+        self.profile2.user_profile_points = 1000
+        self.profile2.save()
+
+        async def run():
+            alice, bob = self.connect(self.user1), self.connect(self.user2)
+            await alice.connect()
+            await alice.receive_json_from(timeout=5)
+            await bob.connect()
+            queued = await bob.receive_json_from(timeout=5)
+            self.assertEqual(queued, {"event": "queued", "waiting": 2})
+            matches = [await alice.receive_json_from(timeout=5),
+                       await bob.receive_json_from(timeout=5)]
+            await alice.disconnect()
+            await bob.disconnect()
+            return matches
+
+        alice_match, bob_match = async_to_sync(run)()
+        self.assertEqual(alice_match["room_id"], bob_match["room_id"])
+
+    def test_disconnecting_leaves_the_queue(self):
+        async def run():
+            alice = self.connect(self.user1)
+            await alice.connect()
+            await alice.receive_json_from(timeout=5)
+            await alice.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(len(matchmaking_queue), 0)
@@ -5,11 +5,18 @@ attribute storage, and relationship management.
 """
 
 from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.core.management import call_command
+from django.db import IntegrityError
 from django.forms import ValidationError
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.utils import timezone
-from cardgame.models import Card, UserProfile, Question, Challenge
+from cardgame.models import (Card, CollectionBitmap, UserProfile, Question,
+                             Challenge)
+from cardgame import models
+from cardgame.ownership import OwnershipBitmap, bitmap_for, owns
 
 
 class CardModelTests(TestCase):
@@ -466,3 +473,97 @@ class CardModelTests(TestCase):
             Challenge.objects.all()[0].clean()
 
         # TODO implement tests for validate answers
+
+
+class OwnershipBitmapTests(TestCase):
+    """
+    Checks that collection bitmaps follow changes to a profile's
+    collection, whichever side of the relation they are made from.
+    """
+
+    def setUp(self):
+        user = User.objects.create_user(username="owner", password="pw")
+        self.profile = UserProfile.objects.create(
+            user=user, user_profile_points=0,
+            user_signup_date=timezone.now())
+        self.cards = [
+            Card.objects.create(card_name=f"Card {i}",
+                                card_subtitle="Subtitle",
+                                card_description="Desc")
+            for i in range(10)
+        ]
+
+    def owned(self):
+        return bitmap_for(UserProfile.objects.select_related(
+            "collection_bitmap").get(pk=self.profile.pk))
+
+    def test_cards_get_dense_indexes(self):
+        self.assertEqual([c.card_index for c in self.cards], list(range(10)))
+
+    def test_bitmap_follows_collection(self):
+        self.profile.user_profile_collected_cards.add(self.cards[0],
+                                                      self.cards[9])
+        self.assertEqual(set(self.owned()), {0, 9})
+        self.profile.user_profile_collected_cards.remove(self.cards[0])
+        self.cards[3].userprofile_set.add(self.profile)
+        self.assertEqual(set(self.owned()), {3, 9})
+        self.cards[3].userprofile_set.clear()
+        self.assertEqual(set(self.owned()), {9})
+        self.profile.user_profile_collected_cards.clear()
+        self.assertEqual(len(self.owned()), 0)
+
+    def test_owns_does_not_query(self):
+        self.profile.user_profile_collected_cards.add(self.cards[2])
+        profile = UserProfile.objects.select_related(
+            "collection_bitmap").get(pk=self.profile.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(owns(profile, self.cards[2]))
+            self.assertFalse(owns(profile, self.cards[3]))
+
+    def test_deleted_card_index_is_not_owned(self):
+        last = self.cards[-1]
+        self.profile.user_profile_collected_cards.add(last)
+        last.delete()
+        new = Card.objects.create(card_name="New", card_subtitle="Subtitle",
+                                  card_description="Desc")
+        self.assertEqual(new.card_index, 9)
+        self.assertFalse(owns(self.profile, new, self.owned()))
+
+    def test_index_taken_meanwhile_is_retried(self):
+        stale = [9]
+
+        def next_index():
+            # Another card claimed 9 between reading the max and inserting
+            return stale.pop() if stale else real_next_index()
+
+        real_next_index = models.next_card_index
+        with patch("cardgame.models.next_card_index", next_index):
+            new = Card.objects.create(card_name="New",
+                                      card_subtitle="Subtitle",
+                                      card_description="Desc")
+        self.assertEqual(new.card_index, 10)
+        self.assertEqual(Card.objects.get(pk="New").card_index, 10)
+
+    def test_other_conflicts_are_not_retried(self):
+        card = Card(card_name="Card 0", card_subtitle="Subtitle",
+                    card_description="Desc")
+        with self.assertRaises(IntegrityError):
+            card.save(force_insert=True)
+        self.assertIsNone(card.card_index)
+
+    def test_set_operations(self):
+        a = OwnershipBitmap.from_indexes([1, 5, 20])
+        b = OwnershipBitmap.from_indexes([5, 7])
+        self.assertEqual(set(a & b), {5})
+        self.assertEqual(set(a | b), {1, 5, 7, 20})
+        self.assertEqual(set(a - b), {1, 20})
+        self.assertEqual(OwnershipBitmap(a.to_bytes()), a)
+
+    def test_rebuild_command(self):
+        self.profile.user_profile_collected_cards.add(self.cards[4])
+        Card.objects.filter(pk=self.cards[4].pk).update(card_index=None)
+        CollectionBitmap.objects.all().delete()
+        call_command("rebuild_ownership", stdout=StringIO())
+        card = Card.objects.get(pk=self.cards[4].pk)
+        self.assertEqual(card.card_index, 10)
+        self.assertEqual(set(self.owned()), {10})
@@ -0,0 +1,108 @@
+"""
+Tests for awarding points (cardgame.points).
+"""
+
+import threading
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from cardgame.leaderboard import leaderboard
+from cardgame.models import Battle, UserProfile
+from cardgame.points import award_battle, award_points
+from cardgame.tests.helpers import make_player
+
+
+class AwardPointsTestCase(TestCase):
+
+    def setUp(self):
+        leaderboard.clear()
+        self.user, self.profile = make_player("alice")
+
+    def tearDown(self):
+        leaderboard.clear()
+
+    def test_points_are_added_to_the_stored_total(self):
+        stale = UserProfile.objects.get(pk=self.profile.pk)
+        award_points(self.profile, 5)
+        # stale still thinks it has 0 points
+        self.assertEqual(award_points(stale, 3), 8)
+        self.assertEqual(stale.user_profile_points, 8)
+
+    def test_other_fields_are_set_in_the_same_update(self):
+        # the update and reading the total back, inside a savepoint
+        with self.assertNumQueries(4):
+            award_points(self.profile, 5, user_most_recent_card="Fern")
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.user_profile_points,
+                          self.profile.user_most_recent_card), (5, "Fern"))
+
+    def test_leaderboard_gets_the_committed_points(self):
+        leaderboard.top()
+        with self.captureOnCommitCallbacks() as first:
+            award_points(self.profile, 5)
+        with self.captureOnCommitCallbacks() as second:
+            award_points(self.profile, 3)
+        # the callbacks of racing awards may run in either order
+        for callback in second + first:
+            callback()
+        self.assertEqual(leaderboard.top(),
+                         [{"username": "alice", "points": 8}])
+
+    def test_battle_points(self):
+        _, other = make_player("bob")
+        for winner, points in ((self.profile, (10, 2)),
+                               (other, (12, 12)), (None, (17, 17))):
+            battle = Battle(player1=self.profile, player2=other,
+                            winner=winner)
+            award_battle(battle)
+            self.assertEqual((self.profile.user_profile_points,
+                              other.user_profile_points), points)
+
+
+class ConcurrentAwardsTestCase(TransactionTestCase):
+
+    THREADS = 16
+    AWARDS = 25
+
+    def setUp(self):
+        leaderboard.clear()
+        self.user, self.profile = make_player("alice")
+
+    def tearDown(self):
+        leaderboard.clear()
+
+    def test_no_awards_are_lost(self):
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+
+        def award():
+            # Every thread starts from the same, soon stale, profile
+            profile = UserProfile.objects.get(pk=self.profile.pk)
+            barrier.wait()
+            awarded = 0
+            try:
+                while awarded < self.AWARDS:
+                    try:
+                        award_points(profile, 1)
+                        awarded += 1
+                    except OperationalError as e:
+                        # The in-memory SQLite test database reports lock
+                        # contention instead of waiting for it; the award
+                        # was rolled back, so it is simply retried
+                        if "locked" not in str(e):
+                            raise
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=award)
+                   for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.user_profile_points,
+                         self.THREADS * self.AWARDS)
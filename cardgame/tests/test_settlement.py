@@ -0,0 +1,173 @@
+"""
+Tests for settling trades (cardgame.settlement).
+"""
+
+import datetime
+import threading
+import time
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from cardgame.models import Card, Trade, UserProfile
+from cardgame.ownership import bitmap_for, owns
+from cardgame.settlement import (SettlementError, accept_trade,
+                                 check_moves, settle_cycle)
+
+
+class SettlementMixin:
+
+    def make_cards(self, *names):
+        return [Card.objects.create(card_name=name, card_subtitle="Sub",
+                                    card_description="Desc")
+                for name in names]
+
+    def make_profile(self, name, *cards):
+        user = User.objects.create_user(username=name, password="pw")
+        profile = UserProfile.objects.create(user=user,
+                                             user_signup_date=timezone.now())
+        profile.user_profile_collected_cards.add(*cards)
+        return profile
+
+    def offer(self, sender, offered, requested, recipient=None):
+        return Trade.objects.create(
+            sender=sender.user, offered_card=offered,
+            requested_card=requested,
+            recipient=recipient and recipient.user,
+            created_date=datetime.date.today())
+
+    def collection(self, profile):
+        return set(profile.user_profile_collected_cards
+                   .values_list("card_name", flat=True))
+
+
+class SettlementTestCase(SettlementMixin, TestCase):
+
+    def setUp(self):
+        self.stoat, self.marten, self.otter = self.make_cards(
+            "Stoat", "Marten", "Otter")
+        self.alice = self.make_profile("alice", self.stoat, self.otter)
+        self.bob = self.make_profile("bob", self.marten)
+
+    def assertBitmapMatches(self, profile):
+        profile = UserProfile.objects.select_related("collection_bitmap")\
+            .get(pk=profile.pk)
+        bitmap = bitmap_for(profile)
+        self.assertEqual({card.card_name for card in Card.objects.all()
+                          if owns(profile, card, bitmap)},
+                         self.collection(profile))
+
+    def test_accepting_swaps_the_cards(self):
+        trade = self.offer(self.alice, self.stoat, self.marten)
+        accept_trade(trade.pk, self.bob.user)
+        self.assertEqual(self.collection(self.alice), {"Marten", "Otter"})
+        self.assertEqual(self.collection(self.bob), {"Stoat"})
+        self.assertFalse(Trade.objects.exists())
+        # The rows were moved without m2m_changed, and the bitmaps kept up
+        self.assertBitmapMatches(self.alice)
+        self.assertBitmapMatches(self.bob)
+
+    def test_queries(self):
+        trade = self.offer(self.alice, self.stoat, self.marten)
+        # the trade, the profiles, ownership, the two moves, deleting the
+        # trade and the savepoint, and 5 to rebuild each bitmap
+        with self.assertNumQueries(18):
+            accept_trade(trade.pk, self.bob.user)
+
+    def test_ownership_is_checked_in_one_query(self):
+        moves = [(self.alice, self.bob, self.stoat),
+                 (self.bob, self.alice, self.marten)]
+        with self.assertNumQueries(1):
+            check_moves(moves)
+
+    def test_failed_settlements_change_nothing(self):
+        carol = self.make_profile("carol", self.marten)
+        cases = [
+            # bob doesn't have the otter
+            (self.offer(self.alice, self.stoat, self.otter), self.bob),
+            # bob already has a marten
+            (self.offer(carol, self.marten, self.stoat), self.bob),
+            # the trade is for carol
+            (self.offer(self.alice, self.stoat, self.marten, carol),
+             self.bob),
+            # alice's own trade
+            (self.offer(self.alice, self.stoat, self.marten), self.alice),
+        ]
+        for trade, profile in cases:
+            with self.subTest(trade=trade.pk):
+                with self.assertRaises(SettlementError):
+                    accept_trade(trade.pk, profile.user)
+                self.assertTrue(Trade.objects.filter(pk=trade.pk).exists())
+        self.assertEqual(self.collection(self.alice), {"Stoat", "Otter"})
+        self.assertEqual(self.collection(self.bob), {"Marten"})
+
+    def test_missing_trade(self):
+        with self.assertRaisesMessage(SettlementError, "already"):
+            accept_trade(1234, self.bob.user)
+
+    def test_cycle(self):
+        carol = self.make_profile("carol")
+        carol.user_profile_collected_cards.add(self.otter)
+        self.alice.user_profile_collected_cards.remove(self.otter)
+        cycle = [self.offer(self.alice, self.stoat, self.marten),
+                 self.offer(self.bob, self.marten, self.otter),
+                 self.offer(carol, self.otter, self.stoat)]
+        settle_cycle([trade.pk for trade in cycle])
+        self.assertEqual(self.collection(self.alice), {"Marten"})
+        self.assertEqual(self.collection(self.bob), {"Otter"})
+        self.assertEqual(self.collection(carol), {"Stoat"})
+        self.assertFalse(Trade.objects.exists())
+
+
+class ContendedSettlementTestCase(SettlementMixin, TransactionTestCase):
+
+    THREADS = 8
+
+    def test_a_public_trade_is_only_accepted_once(self):
+        stoat, marten = self.make_cards("Stoat", "Marten")
+        sender = self.make_profile("sender", stoat)
+        takers = [self.make_profile(f"taker{i}", marten)
+                  for i in range(self.THREADS)]
+        trade = self.offer(sender, stoat, marten)
+        barrier = threading.Barrier(self.THREADS)
+        accepted, refused, errors = [], [], []
+
+        def accept(taker):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        accept_trade(trade.pk, taker.user)
+                        accepted.append(taker)
+                        return
+                    except SettlementError:
+                        refused.append(taker)
+                        return
+                    except OperationalError as e:
+                        # The in-memory SQLite test database reports lock
+                        # contention instead of waiting for it; the
+                        # settlement was rolled back, so it is retried
+                        if "locked" not in str(e):
+                            raise
+                        time.sleep(0.01)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=(taker,))
+                   for taker in takers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual((len(accepted), len(refused)),
+                         (1, self.THREADS - 1))
+        winner, = accepted
+        self.assertEqual(self.collection(sender), {"Marten"})
+        self.assertEqual(self.collection(winner), {"Stoat"})
+        for taker in refused:
+            self.assertEqual(self.collection(taker), {"Marten"})
+        self.assertFalse(Trade.objects.exists())
@@ -0,0 +1,140 @@
+"""
+Tests for matching public trades (cardgame.trade_matching).
+"""
+
+import datetime
+import json
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from cardgame.models import Card, Trade, UserProfile
+from cardgame.trade_matching import match
+
+
+class TradeMatchingTestCase(TestCase):
+
+    def setUp(self):
+        self.cards = {name: Card.objects.create(card_name=name,
+                                                card_subtitle="Subtitle",
+                                                card_description="Desc")
+                      for name in ("Stoat", "Marten", "Wolverine", "Otter")}
+        self.profiles = {}
+        for name in ("alice", "bob", "carol", "dave"):
+            user = User.objects.create_user(username=name, password="pw")
+            self.profiles[name] = UserProfile.objects.create(
+                user=user, user_signup_date=timezone.now())
+
+    def give(self, name, *cards):
+        self.profiles[name].user_profile_collected_cards.add(
+            *(self.cards[card] for card in cards))
+
+    def collection(self, name):
+        return set(self.profiles[name].user_profile_collected_cards
+                   .values_list("card_name", flat=True))
+
+    def offer(self, name, offered, requested, recipient=None):
+        return Trade.objects.create(
+            sender=self.profiles[name].user,
+            offered_card=self.cards[offered],
+            requested_card=self.cards[requested],
+            recipient=recipient and self.profiles[recipient].user,
+            created_date=datetime.date.today())
+
+    def submit(self, name, offered, requested):
+        self.client.force_login(self.profiles[name].user)
+        return self.client.post(
+            reverse("submit"), content_type="application/json",
+            data=json.dumps({"card_name": offered,
+                             "requested_card": requested,
+                             "user_name": ""}))
+
+    def test_complementary_trades_are_settled(self):
+        self.give("alice", "Stoat")
+        self.give("bob", "Marten")
+        self.offer("bob", "Marten", "Stoat")
+        response = self.submit("alice", "Stoat", "Marten")
+        self.assertContains(response, "trade completed")
+        self.assertEqual(self.collection("alice"), {"Marten"})
+        self.assertEqual(self.collection("bob"), {"Stoat"})
+        self.assertFalse(Trade.objects.exists())
+
+    def test_cycle_of_three_is_settled(self):
+        self.give("alice", "Stoat")
+        self.give("bob", "Marten")
+        self.give("carol", "Wolverine")
+        self.offer("bob", "Marten", "Wolverine")
+        self.offer("carol", "Wolverine", "Stoat")
+        self.submit("alice", "Stoat", "Marten")
+        self.assertEqual(self.collection("alice"), {"Marten"})
+        self.assertEqual(self.collection("bob"), {"Wolverine"})
+        self.assertEqual(self.collection("carol"), {"Stoat"})
+        self.assertFalse(Trade.objects.exists())
+
+    def test_pairs_are_preferred_to_cycles(self):
+        self.give("alice", "Stoat")
+        self.give("bob", "Marten")
+        self.give("carol", "Wolverine")
+        self.give("dave", "Marten")
+        self.offer("bob", "Marten", "Wolverine")
+        self.offer("carol", "Wolverine", "Stoat")
+        self.offer("dave", "Marten", "Stoat")
+        settled = match(self.offer("alice", "Stoat", "Marten"))
+        self.assertEqual([trade.sender.username for trade in settled],
+                         ["alice", "dave"])
+        self.assertEqual(Trade.objects.count(), 2)
+
+    def test_oldest_match_is_settled_first(self):
+        self.give("alice", "Stoat")
+        self.give("bob", "Marten")
+        self.give("carol", "Marten")
+        self.offer("carol", "Marten", "Stoat")
+        Trade.objects.update(created_date=datetime.date(2020, 1, 1))
+        self.offer("bob", "Marten", "Stoat")
+        self.submit("alice", "Stoat", "Marten")
+        self.assertEqual(self.collection("carol"), {"Stoat"})
+        self.assertEqual(self.collection("bob"), {"Marten"})
+
+    def test_trades_that_cannot_go_through_are_skipped(self):
+        self.give("alice", "Stoat")
+        self.give("bob", "Marten", "Stoat")
+        self.give("carol", "Marten")
+        # bob already has the stoat he asks for
+        self.offer("bob", "Marten", "Stoat")
+        # dave doesn't have the marten he offers
+        self.offer("dave", "Marten", "Stoat")
+        # carol only offers it to bob
+        self.offer("carol", "Marten", "Stoat", recipient="bob")
+        response = self.submit("alice", "Stoat", "Marten")
+        self.assertEqual(response.content, b"200")
+        self.assertEqual(Trade.objects.count(), 4)
+        self.assertEqual(self.collection("alice"), {"Stoat"})
+
+    def test_own_trades_are_not_matched(self):
+        self.give("alice", "Stoat", "Marten")
+        self.offer("alice", "Marten", "Wolverine")
+        self.offer("alice", "Wolverine", "Stoat")
+        self.assertEqual(match(self.offer("alice", "Stoat", "Otter")), [])
+
+    def test_sender_who_cannot_trade_is_not_matched(self):
+        self.give("bob", "Marten")
+        self.offer("bob", "Marten", "Stoat")
+        # alice doesn't have the stoat she offers
+        self.submit("alice", "Stoat", "Marten")
+        self.assertEqual(Trade.objects.count(), 2)
+        self.assertEqual(self.collection("bob"), {"Marten"})
+
+    def test_match_trades_command(self):
+        self.give("alice", "Stoat")
+        self.give("bob", "Marten")
+        self.give("carol", "Wolverine")
+        self.offer("alice", "Stoat", "Marten")
+        self.offer("bob", "Marten", "Wolverine")
+        self.offer("carol", "Wolverine", "Stoat")
+        self.offer("dave", "Otter", "Stoat")
+        out = StringIO()
+        call_command("match_trades", stdout=out)
+        self.assertIn("Settled 3 trades", out.getvalue())
+        self.assertEqual(Trade.objects.count(), 1)
@@ -0,0 +1,138 @@
+"""
+Tests for the live trade updates (cardgame.trade_notifications and the
+TradeNotificationConsumer).
+"""
+
+import datetime
+import json
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.test import TransactionTestCase
+from django.urls import reverse
+from cardgame.models import Card, Trade
+from cardgame.routing import websocket_urlpatterns
+from cardgame.tests.helpers import make_player
+
+
+class TradeNotificationTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.stoat = Card.objects.create(card_name="Stoat",
+                                         card_subtitle="Sub",
+                                         card_description="Desc")
+        self.marten = Card.objects.create(card_name="Marten",
+                                          card_subtitle="Sub",
+                                          card_description="Desc")
+        self.alice, self.alice_profile = make_player("alice")
+        self.bob, self.bob_profile = make_player("bob")
+        self.alice_profile.user_profile_collected_cards.add(self.stoat)
+        self.bob_profile.user_profile_collected_cards.add(self.marten)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             "/ws/trades/")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def request(self, user, name, **kwargs):
+        self.client.force_login(user)
+        return self.client.get(reverse(name, kwargs=kwargs),
+                               HTTP_REFERER="/trades/personal")
+
+    def submit(self, user, recipient=""):
+        self.client.force_login(user)
+        return self.client.post(
+            reverse("submit"), content_type="application/json",
+            data=json.dumps({"card_name": "Stoat",
+                             "requested_card": "Marten",
+                             "user_name": recipient}))
+
+    def offer(self, recipient=None):
+        return Trade.objects.create(sender=self.alice,
+                                    offered_card=self.stoat,
+                                    requested_card=self.marten,
+                                    recipient=recipient,
+                                    created_date=datetime.date.today())
+
+    def test_recipient_is_told_about_new_trades(self):
+        async def run():
+            alice = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            await sync_to_async(self.submit)(self.alice, "bob")
+            event = await bob.receive_json_from(timeout=5)
+            self.assertEqual(event["event"], "trade_created")
+            self.assertEqual(
+                {k: event["trade"][k] for k in ("sender", "recipient",
+                                                "offered_card",
+                                                "requested_card")},
+                {"sender": "alice", "recipient": "bob",
+                 "offered_card": "Stoat", "requested_card": "Marten"})
+            # alice made it, so she isn't told
+            self.assertTrue(await alice.receive_nothing())
+            await alice.disconnect()
+            await bob.disconnect()
+        async_to_sync(run)()
+
+    def test_sender_is_told_when_their_trade_is_accepted(self):
+        trade = self.offer()
+
+        async def run():
+            alice = await self.connect(self.alice)
+            await sync_to_async(self.request)(self.bob, "accept",
+                                              t_id=trade.pk)
+            event = await alice.receive_json_from(timeout=5)
+            self.assertEqual((event["event"], event["trade"]["id"]),
+                             ("trade_accepted", trade.pk))
+            await alice.disconnect()
+        async_to_sync(run)()
+
+    def test_other_side_is_told_when_a_trade_is_cancelled(self):
+        trade = self.offer(recipient=self.bob)
+
+        async def run():
+            bob = await self.connect(self.bob)
+            await sync_to_async(self.request)(self.alice, "cancel",
+                                              t_id=trade.pk)
+            event = await bob.receive_json_from(timeout=5)
+            self.assertEqual((event["event"], event["trade"]["id"]),
+                             ("trade_cancelled", trade.pk))
+            await bob.disconnect()
+        async_to_sync(run)()
+
+    def test_matched_trades_are_announced(self):
+        Trade.objects.create(sender=self.bob, offered_card=self.marten,
+                             requested_card=self.stoat,
+                             created_date=datetime.date.today())
+
+        async def run():
+            bob = await self.connect(self.bob)
+            await sync_to_async(self.submit)(self.alice)
+            event = await bob.receive_json_from(timeout=5)
+            self.assertEqual((event["event"], event["trade"]["sender"]),
+                             ("trade_matched", "bob"))
+            await bob.disconnect()
+        async_to_sync(run)()
+
+    def test_failed_accept_is_not_announced(self):
+        trade = self.offer()
+        self.bob_profile.user_profile_collected_cards.clear()
+
+        async def run():
+            alice = await self.connect(self.alice)
+            await sync_to_async(self.request)(self.bob, "accept",
+                                              t_id=trade.pk)
+            self.assertTrue(await alice.receive_nothing())
+            await alice.disconnect()
+        async_to_sync(run)()
+
+    def test_must_be_logged_in(self):
+        async def run():
+            communicator = await self.connect(AnonymousUser())
+            event = await communicator.receive_json_from()
+            self.assertEqual(event["event"], "error")
+            await communicator.disconnect()
+        async_to_sync(run)()
@@ -331,3 +331,217 @@ class TradeTestCase(TestCase):
                         .user_profile_collected_cards.all())
         self.assertTrue(self.card1 in self.user_profile1
                         .user_profile_collected_cards.all())
+
+
+class MakeTradePageTestCase(TestCase):
+
+    def setUp(self):
+        self.card = Card.objects.create(card_name="Stoat",
+                                        card_subtitle="Subtitle",
+                                        card_description="Desc")
+        self.user = User.objects.create_user(username="martenfan",
+                                             password="ilikemarten")
+        profile = UserProfile.objects.create(user=self.user,
+                                             user_signup_date=timezone.now())
+        profile.user_profile_collected_cards.add(self.card)
+        self.client.force_login(self.user)
+        self.url = reverse("create", kwargs={"card_name": "Stoat"})
+
+    def add_owners(self, names):
+        for name in names:
+            user = User.objects.create(username=name)
+            UserProfile.objects.create(
+                user=user, user_signup_date=timezone.now())\
+                .user_profile_collected_cards.add(self.card)
+
+    def test_only_other_owners_are_listed(self):
+        self.add_owners(["stoatfan", "wolverinefan"])
+        User.objects.create(username="nocards")
+        response = self.client.get(self.url)
+        self.assertEqual(list(response.context["all_users"]),
+                         ["stoatfan", "wolverinefan"])
+        self.assertEqual(list(response.context["ownedCards"]), ["Stoat"])
+
+    def test_query_count_does_not_grow_with_players(self):
+        self.add_owners(["owner0"])
+        with self.assertNumQueries(6) as first:
+            self.client.get(self.url)
+        self.add_owners([f"owner{i}" for i in range(1, 30)])
+        with self.assertNumQueries(len(first.captured_queries)):
+            self.client.get(self.url)
+
+    def test_owners_are_searched_and_paginated(self):
+        self.add_owners([f"stoat{i:03}" for i in range(60)] +
+                        ["wolverinefan"])
+        response = self.client.get(self.url, {"q": "STOAT"})
+        page = response.context["page"]
+        self.assertEqual((page.paginator.count, len(page)), (60, 50))
+        self.assertTrue(response.context["show_users"])
+        response = self.client.get(self.url, {"q": "stoat", "page": 2})
+        self.assertEqual(list(response.context["all_users"]),
+                         [f"stoat{i:03}" for i in range(50, 60)])
+
+
+class MarketplaceTestCase(TestCase):
+
+    def setUp(self):
+        self.cards = [Card.objects.create(card_name=name,
+                                          card_subtitle="Subtitle",
+                                          card_description="Desc")
+                      for name in ("Stoat", "Marten", "Wolverine")]
+        self.users = []
+        for name in ("martenfan", "stoatfan", "wolverinefan"):
+            user = User.objects.create_user(username=name, password="pw")
+            UserProfile.objects.create(user=user,
+                                       user_signup_date=timezone.now())
+            self.users.append(user)
+        self.client.force_login(self.users[0])
+
+    def make_trade(self, sender, offered, requested, days_ago=0,
+                   recipient=None):
+        return Trade.objects.create(
+            sender=sender, offered_card=offered, requested_card=requested,
+            recipient=recipient,
+            created_date=datetime.date.today()
+            - datetime.timedelta(days=days_ago))
+
+    def search(self, **params):
+        return self.client.get(reverse("trade_search_api"), params).json()
+
+    def test_pages_follow_the_cursor(self):
+        stoat, marten, _ = self.cards
+        # several trades a day, so the cursor has to break ties by id
+        trades = [self.make_trade(self.users[1], stoat, marten, days_ago=d)
+                  for d in (0, 0, 0, 1, 1, 2, 3)]
+        self.make_trade(self.users[0], stoat, marten)
+        self.make_trade(self.users[1], stoat, marten,
+                        recipient=self.users[2])
+        seen, after = [], None
+        while True:
+            page = self.client.get(
+                reverse("trade_search_api"),
+                {"after": after} if after else {}).json()
+            seen += [trade["id"] for trade in page["trades"]]
+            after = page["next"]
+            if after is None:
+                break
+        expected = sorted(trades, key=lambda t: (t.created_date, t.id),
+                          reverse=True)
+        self.assertEqual(seen, [trade.id for trade in expected])
+
+    def test_page_size(self):
+        stoat, marten, _ = self.cards
+        for _ in range(25):
+            self.make_trade(self.users[1], stoat, marten)
+        page = self.search()
+        self.assertEqual(len(page["trades"]), 20)
+        page = self.search(after=page["next"])
+        self.assertEqual((len(page["trades"]), page["next"]), (5, None))
+
+    def test_card_filters(self):
+        stoat, marten, wolverine = self.cards
+        wanted = self.make_trade(self.users[1], stoat, marten)
+        self.make_trade(self.users[1], wolverine, marten)
+        self.make_trade(self.users[1], stoat, wolverine)
+        page = self.search(in_card="Stoat", out_card="Marten")
+        self.assertEqual([t["id"] for t in page["trades"]], [wanted.id])
+        self.assertEqual(page["trades"][0]["sender"], "stoatfan")
+        self.assertEqual(page["trades"][0]["offered_card"]["name"], "Stoat")
+
+    def test_fulfillable_trades(self):
+        stoat, marten, wolverine = self.cards
+        me, other, third = (UserProfile.objects.get(user=u)
+                            for u in self.users)
+        me.user_profile_collected_cards.add(marten)
+        other.user_profile_collected_cards.add(stoat)
+        third.user_profile_collected_cards.add(wolverine, marten)
+        good = self.make_trade(self.users[1], stoat, marten)
+        # I don't have the wolverine they want
+        self.make_trade(self.users[1], stoat, wolverine)
+        # they don't have the stoat they offer
+        self.make_trade(self.users[2], stoat, marten)
+        # they already have the marten they ask for
+        self.make_trade(self.users[2], wolverine, marten)
+        self.assertEqual(len(self.search()["trades"]), 4)
+        page = self.search(fulfillable="1")
+        self.assertEqual([t["id"] for t in page["trades"]], [good.id])
+
+    def test_query_count_does_not_grow_with_trades(self):
+        stoat, marten, _ = self.cards
+        self.make_trade(self.users[1], stoat, marten)
+        # session, user and the page of trades with their cards
+        with self.assertNumQueries(3):
+            self.search(fulfillable="1")
+        for _ in range(15):
+            self.make_trade(self.users[2], stoat, marten)
+        with self.assertNumQueries(3):
+            self.search()
+
+    def test_bad_cursor(self):
+        response = self.client.get(reverse("trade_search_api"),
+                                   {"after": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_results_page(self):
+        stoat, marten, _ = self.cards
+        for _ in range(21):
+            self.make_trade(self.users[1], stoat, marten)
+        response = self.client.get(reverse("search_results"),
+                                   {"in_card": "Stoat", "out_card": ""})
+        self.assertEqual(len(response.context["data"]), 20)
+        self.assertIn("after=", response.context["next_page"])
+        self.assertContains(response, "Offered:Stoat", count=20)
+        response = self.client.get(
+            reverse("search_results") + "?" + response.context["next_page"])
+        self.assertEqual(len(response.context["data"]), 1)
+        self.assertIsNone(response.context["next_page"])
+
+
+class PersonalTradesTestCase(TestCase):
+
+    def setUp(self):
+        self.cards = [Card.objects.create(card_name=name,
+                                          card_subtitle="Subtitle",
+                                          card_description="Desc")
+                      for name in ("Stoat", "Marten")]
+        self.users = []
+        for name in ("martenfan", "stoatfan"):
+            user = User.objects.create_user(username=name, password="pw")
+            UserProfile.objects.create(user=user,
+                                       user_signup_date=timezone.now())
+            self.users.append(user)
+        self.client.force_login(self.users[0])
+
+    def make_trades(self, sender, recipient, count):
+        Trade.objects.bulk_create(
+            Trade(sender=sender, recipient=recipient,
+                  offered_card=self.cards[0], requested_card=self.cards[1],
+                  created_date=datetime.date.today())
+            for _ in range(count))
+
+    def test_query_count_does_not_grow_with_trades(self):
+        me, other = self.users
+        self.make_trades(me, other, 1)
+        self.make_trades(other, me, 1)
+        # session, user, and a count and a page for each list
+        with self.assertNumQueries(6):
+            self.client.get(reverse("personal"))
+        self.make_trades(me, None, 10)
+        self.make_trades(other, me, 10)
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse("personal"))
+        self.assertContains(response, "Offered To: public", count=10)
+        self.assertContains(response, "Offered By: stoatfan", count=11)
+
+    def test_pages(self):
+        me, other = self.users
+        self.make_trades(other, me, 25)
+        self.make_trades(me, other, 3)
+        response = self.client.get(reverse("personal"))
+        incoming = response.context["incoming"]
+        self.assertEqual((len(incoming), incoming.paginator.count),
+                         (20, 25))
+        self.assertContains(response, "?incoming=2&outgoing=1")
+        response = self.client.get(reverse("personal"), {"incoming": 2})
+        self.assertEqual(len(response.context["incoming"]), 5)
+        self.assertEqual(len(response.context["outgoing"]), 3)
@@ -1,4 +1,7 @@
 import datetime
+import glob
+import json
+from asgiref.sync import async_to_sync
 from django.test import TestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
@@ -6,7 +9,11 @@ from django.core.files.uploadedfile import SimpleUploadedFile
 from django.utils import timezone
 
 
-from cardgame.models import Card, UserProfile, Challenge, Question
+from cardgame.models import (Card, UserProfile, Challenge, Question,
+                             RenderJob)
+from cardgame.instrumentation import instrumented, metrics
+from cardgame.render_queue import process_pending
+from cardgame.leaderboard import leaderboard, record
 
 
 class EmptyTestCase(TestCase):
@@ -108,6 +115,49 @@ class ViewsTestCase(TestCase):
         self.assertIn("cardshas", response.context)
         self.assertEqual(response.context["cardshas"][0]["title"], "TestCard")
 
+    def test_card_col_splits_owned_cards(self):
+        Card.objects.create(card_name="OtherCard", card_subtitle="Subtitle",
+                            card_description="Desc")
+        self.user_profile.user_profile_collected_cards.add(self.card)
+        url = reverse("cardcollection",
+                      kwargs={"user_name": self.user.username})
+        response = self.client.get(url)
+        self.assertEqual([c["title"] for c in response.context["cardshas"]],
+                         ["TestCard"])
+        self.assertEqual([c["title"] for c in response.context["cardsnot"]],
+                         ["OtherCard"])
+
+    def test_card_col_query_count_is_flat(self):
+        # the number of queries must not grow with the size of the catalogue
+        url = reverse("cardcollection",
+                      kwargs={"user_name": self.user.username})
+        with self.assertNumQueries(3):
+            self.client.get(url)
+        for i in range(20):
+            card = Card.objects.create(card_name=f"Card{i}",
+                                       card_subtitle="Subtitle",
+                                       card_description="Desc")
+            if i % 2:
+                self.user_profile.user_profile_collected_cards.add(card)
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+    def test_card_col_data(self):
+        self.user_profile.user_profile_collected_cards.add(self.card)
+        Card.objects.create(card_name="OtherCard", card_subtitle="Subtitle",
+                            card_description="Desc")
+        url = reverse("cardcollection_data",
+                      kwargs={"user_name": self.user.username})
+        response = self.client.get(url)
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([(c["name"], c["owned"]) for c in data["cards"]],
+                         [("TestCard", True), ("OtherCard", False)])
+        self.assertFalse(data["has_next"])
+
+        response = self.client.get(url, {"owned": "0"})
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([c["name"] for c in data["cards"]], ["OtherCard"])
+
     def test_card_col_404(self):
         # checks that accessing a nonexistent card collections returns a 404
         url = reverse("cardcollection",
@@ -183,33 +233,35 @@ class ViewsTestCase(TestCase):
             "card_subtitle": "NewSubtitle",
             "card_description": "New description",
         }
-        files_data = {"card_image": image_data}
-
-        from PIL import Image as PilImage
-        from unittest.mock import patch
-
-        # Create a dummy image to return from make_image
-        dummy_image = PilImage.new("RGB", (100, 100))
+        post_data["card_image"] = image_data
 
-        # Patch make_image to return a dummy PIL image (with a .save method)
-        with patch(
-            "cardgame.views.make_image", return_value=dummy_image
-        ) as mock_make_image:
-            response_post = self.client.post(
-                reverse("create_card"), data=post_data, files=files_data
-            )
-            mock_make_image.assert_called_once()
+        # The card is created straight away with the placeholder image,
+        # and its image is left to the render queue
+        response_post = self.client.post(reverse("create_card"),
+                                         data=post_data)
+        self.assertEqual(response_post.status_code, 202)
+        new_card = Card.objects.get(card_name="NewCard")
+        self.assertEqual(new_card.card_image_link.name,
+                         "static/card_images/do_not_remove.png")
+        self.assertEqual(
+            RenderJob.objects.filter(card=new_card, status="pending")
+            .count(), 1)
 
-        # Check response and database creation
-        self.assertEqual(response_post.status_code, 200)
-        self.assertTrue(Card.objects.filter(card_name="NewCard").exists())
+        self.assertEqual(process_pending(), 1)
+        new_card.refresh_from_db()
+        self.assertTrue(new_card.card_render_key)
+        self.assertEqual(RenderJob.objects.get(card=new_card).status, "done")
 
-        # Clean up: remove the image file created by the view
+        # Clean up: remove the image files created by the view
         # (if it’s not the default)
-        new_card = Card.objects.get(card_name="NewCard")
-        if new_card.card_image_link and hasattr(new_card.card_image_link,
-                                                "path"):
-            file_path = new_card.card_image_link.path
+        paths = [image.path for image in (new_card.card_image_link,
+                                          new_card.card_source_image)
+                 if image and hasattr(image, "path")]
+        if new_card.card_render_key:
+            paths += glob.glob(os.path.join(
+                os.path.dirname(new_card.card_image_link.path),
+                new_card.card_render_key + "_*"))
+        for file_path in paths:
             default_image_path = os.path.join(
                 settings.BASE_DIR, "static", "card_images", "do_not_remove.png"
             )
@@ -218,6 +270,19 @@ class ViewsTestCase(TestCase):
             ) != os.path.abspath(default_image_path):
                 os.remove(file_path)
 
+    def test_create_card_without_image(self):
+        User.objects.create_superuser(username="admin",
+                                      password="adminpass")
+        self.client.login(username="admin", password="adminpass")
+        response = self.client.post(reverse("create_card"), data={
+            "card_name": "Plain",
+            "card_subtitle": "Subtitle",
+            "card_description": "No picture",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "being rendered")
+        self.assertFalse(RenderJob.objects.filter(card="Plain").exists())
+
     def test_get_locations(self):
         self.client.login(username=self.user.username, password="secret")
         response = self.client.get(reverse("locations_data"))
@@ -229,6 +294,7 @@ class ViewsTestCase(TestCase):
                          self.card.card_name)
 
     def test_leaderboard_data(self):
+        leaderboard.clear()
         # Create additional users with points
         user2 = User.objects.create_user(username="user2", password="secret2")
         UserProfile.objects.create(
@@ -269,6 +335,29 @@ class ViewsTestCase(TestCase):
             chal = response.context["challenges"][0]
             self.assertEqual(chal["card_name"], self.card.card_name)
 
+    def test_challenges_query_count_is_flat(self):
+        # one query for the challenges, however many are running
+        self.client.login(username=self.user.username, password="secret")
+        now = timezone.now()
+        for i in range(20):
+            card = Card.objects.create(card_name=f"ChalCard{i}",
+                                       card_subtitle="Subtitle",
+                                       card_description="Desc")
+            Challenge.objects.create(
+                challenge_name=f"Challenge{i}", description="desc",
+                start_time=now - datetime.timedelta(hours=1),
+                end_time=now + datetime.timedelta(hours=1),
+                longitude=10.0, latitude=20.0, card=card,
+                points_reward=10, status="ongoing")
+            if i % 2:
+                self.user_profile.user_profile_collected_cards.add(card)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("challenges"))
+        names = [c["card_name"] for c in response.context["challenges"]]
+        self.assertEqual(len(names), 11)
+        self.assertNotIn("ChalCard1", names)
+        self.assertTrue(response.context["open_chals"])
+
     def test_challenge_view(self):
         self.client.login(username=self.user.username, password="secret")
         url = reverse("challenge", kwargs={"chal_id": self.challenge.id})
@@ -296,3 +385,103 @@ class ViewsTestCase(TestCase):
             self.user_profile.user_profile_collected_cards.count(),
             initial_cards + 1
         )
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        leaderboard.clear()
+        self.profiles = []
+        for i, points in enumerate([30, 80, 10, 80, 50, 0, 20]):
+            user = User.objects.create_user(username=f"player{i}",
+                                            password="secret")
+            self.profiles.append(UserProfile.objects.create(
+                user=user, user_profile_points=points,
+                user_signup_date=timezone.now()))
+
+    def tearDown(self):
+        leaderboard.clear()
+
+    def test_top_players(self):
+        response = self.client.get(reverse("leaderboard_data"))
+        self.assertEqual([p["points"] for p in response.json()],
+                         [80, 80, 50, 30, 20])
+
+    def test_unchanged_leaderboard_is_not_modified(self):
+        response = self.client.get(reverse("leaderboard_data"))
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("leaderboard_data"),
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_points_change_moves_player(self):
+        etag = self.client.get(reverse("leaderboard_data"))["ETag"]
+        profile = self.profiles[5]
+        profile.user_profile_points = 100
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+            record(profile)
+        response = self.client.get(reverse("leaderboard_data"),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0],
+                         {"username": "player5", "points": 100})
+        self.assertEqual(leaderboard.rank(profile), 1)
+
+    def test_rank_shares_ties(self):
+        self.assertEqual(leaderboard.rank(self.profiles[1]), 1)
+        self.assertEqual(leaderboard.rank(self.profiles[3]), 1)
+        self.assertEqual(leaderboard.rank(self.profiles[4]), 3)
+        self.assertEqual(leaderboard.rank(self.profiles[5]), 7)
+
+    def test_leaderboard_rank_view(self):
+        self.client.force_login(self.profiles[0].user)
+        data = self.client.get(reverse("leaderboard_rank")).json()
+        self.assertEqual(data, {"username": "player0", "points": 30,
+                                "rank": 4, "players": 7})
+
+    def test_add_card_updates_leaderboard(self):
+        profile = self.profiles[2]
+        card = Card.objects.create(card_name="Prize", card_subtitle="Sub",
+                                   card_description="Desc")
+        now = timezone.now()
+        chal = Challenge.objects.create(
+            challenge_name="Prize", description="desc",
+            start_time=now - datetime.timedelta(hours=1),
+            end_time=now + datetime.timedelta(hours=1),
+            longitude=1.0, latitude=2.0, card=card, points_reward=95,
+            status="ongoing")
+        self.assertEqual(leaderboard.rank(profile), 6)
+        self.client.force_login(profile.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("add-card", kwargs={"chal_id": chal.id}))
+        self.assertEqual(leaderboard.top(1),
+                         [{"username": "player2", "points": 105}])
+
+
+class BattleMetricsTestCase(TestCase):
+    def setUp(self):
+        metrics.clear()
+        self.user = User.objects.create_user(username="player",
+                                             password="secret")
+
+    def tearDown(self):
+        metrics.clear()
+
+    def test_only_staff_can_see_metrics(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("battle_metrics"))
+        self.assertEqual(response.status_code, 302)
+
+    def test_metrics(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        async_to_sync(instrumented("test_handler")(self.handler))()
+        data = self.client.get(reverse("battle_metrics")).json()
+        self.assertEqual(data["test_handler"]["errors"], 1)
+        self.assertEqual(data["test_handler"]["wall_ms"]["count"], 1)
+        self.assertEqual(data["test_handler"]["queries"]["sum"], 0)
+
+    async def handler(self):
+        return {"event": "error", "message": "nope"}
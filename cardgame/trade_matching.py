@@ -0,0 +1,124 @@
+"""
+Matching public trades with each other.
+
+A public trade (recipient None) offers one card for another. When a new
+one is submitted, match() looks among the open public trades for others
+that together with it make a cycle in which everyone gets the card they
+asked for:
+
+- a pair: someone else offers the card it asks for, and asks for the
+  card it offers
+- a cycle of three: A offers X for Y, B offers Y for Z and C offers Z
+  for X, so A's X goes to C, B's Y to A and C's Z to B
+
+Only trades whose sender still has the card they offer and doesn't
+already have the card they ask for are considered. The oldest candidates
+are tried first, and both searches are single queries on the
+(recipient, offered_card, requested_card, created_date) index on Trade,
+so matching costs the same however many trades are open.
+
+A match is settled by cardgame.settlement, which checks the trades are
+all still open and everyone still has the right cards before moving any.
+"""
+
+from django.db.models import Exists, OuterRef
+from .marketplace import owns
+from .models import Trade
+from .settlement import SettlementError, settle_cycle
+
+# How many candidate matches to try before leaving a trade open, in case
+# the first ones are settled by someone else in the meantime
+ATTEMPTS = 5
+
+
+def open_trades():
+    """Public trades whose sender could still go through with them."""
+    sender, offered, requested = (OuterRef("sender_id"),
+                                  OuterRef("offered_card_id"),
+                                  OuterRef("requested_card_id"))
+    return Trade.objects.filter(recipient=None)\
+        .filter(owns(sender, offered), ~owns(sender, requested))\
+        .select_related("offered_card", "requested_card")\
+        .order_by("created_date", "id")
+
+
+def find_pairs(trade):
+    """The open trades that give trade's sender what they asked for in
+    return for the card they offered."""
+    return open_trades()\
+        .filter(offered_card=trade.requested_card_id,
+                requested_card=trade.offered_card_id)\
+        .exclude(sender=trade.sender_id)
+
+
+def find_cycles(trade):
+    """
+    Yields (second, third) for the cycles of three trades starting with
+    trade: second offers what trade asks for, and third offers what
+    second asks for in return for what trade offers.
+    """
+    thirds = open_trades()\
+        .filter(requested_card=trade.offered_card_id)\
+        .exclude(sender=trade.sender_id)
+    seconds = open_trades()\
+        .filter(offered_card=trade.requested_card_id)\
+        .exclude(sender=trade.sender_id)\
+        .exclude(requested_card__in=(trade.offered_card_id,
+                                     trade.requested_card_id))\
+        .filter(Exists(thirds.filter(offered_card=OuterRef("requested_card"))
+                       .exclude(sender=OuterRef("sender"))))
+    for second in seconds[:ATTEMPTS]:
+        third = thirds.filter(offered_card=second.requested_card_id)\
+            .exclude(sender=second.sender_id).first()
+        if third is not None:
+            yield second, third
+
+
+def settle(cycle):
+    """
+    Settles a matched cycle of trades (see settlement.settle_cycle).
+    Returns whether it was; it isn't if any trade has gone, or anyone
+    no longer has the card they offer or already has the card they
+    asked for.
+    """
+    try:
+        settle_cycle([trade.pk for trade in cycle])
+    except SettlementError:
+        return False
+    return True
+
+
+def match(trade):
+    """
+    Looks for trades to complete a new public trade with, and settles
+    the first match that still holds.
+
+    Returns:
+        list: the trades settled, starting with trade, or [] if trade is
+        left open
+    """
+    if trade.recipient_id is not None:
+        return []
+    if not open_trades().filter(pk=trade.pk).exists():
+        # Its sender can't go through with it at the moment
+        return []
+    for other in find_pairs(trade)[:ATTEMPTS]:
+        if settle([trade, other]):
+            return [trade, other]
+    for second, third in find_cycles(trade):
+        if settle([trade, second, third]):
+            return [trade, second, third]
+    return []
+
+
+def match_all():
+    """
+    Matches every open public trade, oldest first, e.g. those submitted
+    before matching existed. Returns how many trades were settled.
+    """
+    settled = 0
+    for pk in list(open_trades().values_list("pk", flat=True)):
+        trade = Trade.objects.filter(pk=pk).first()
+        if trade is not None:
+            settled += len(match(trade))
+    return settled
@@ -0,0 +1,56 @@
+"""
+Live updates for the personal trades page.
+
+While a player has the page open, TradeNotificationConsumer keeps them in
+the channel layer group trades_user_<user id>. notify() tells the
+players on either side of a trade, other than the one who acted, that it
+was created, accepted, matched or cancelled. Messages are only sent once
+the surrounding transaction commits, so a change that is rolled back is
+never announced.
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+CREATED = "trade_created"
+ACCEPTED = "trade_accepted"
+MATCHED = "trade_matched"
+CANCELLED = "trade_cancelled"
+
+
+def group_name(user_id):
+    return f"trades_user_{user_id}"
+
+
+def trade_dict(trade):
+    """What the trades page needs to show or remove a trade."""
+    return {
+        "id": trade.pk,
+        "sender": trade.sender.username,
+        "recipient": trade.recipient.username if trade.recipient else None,
+        "offered_card": trade.offered_card_id,
+        "requested_card": trade.requested_card_id,
+        "date": trade.created_date.isoformat(),
+    }
+
+
+def notify(event, trade, actor=None):
+    """
+    Tells trade's sender and recipient, except actor, about event once
+    the current transaction commits.
+    """
+    user_ids = {trade.sender_id, trade.recipient_id} - {None}
+    if actor is not None:
+        user_ids.discard(actor.pk)
+    if not user_ids:
+        return
+    message = {"type": "trade_event", "event": event,
+               "trade": trade_dict(trade)}
+
+    def send():
+        layer = get_channel_layer()
+        for user_id in sorted(user_ids):
+            async_to_sync(layer.group_send)(group_name(user_id), message)
+
+    transaction.on_commit(send)
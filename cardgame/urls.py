@@ -15,6 +15,8 @@ urlpatterns = [
     path("home", views.home, name="home"),
     path("locations-data/", views.get_locations, name="locations_data"),
     path("user/<str:user_name>/cards", views.card_col, name="cardcollection"),
+    path("user/<str:user_name>/cards/data", views.card_col_data,
+         name="cardcollection_data"),
     path(
         "login",
         auth_views.LoginView.as_view(template_name="cardgame/login.html"),
@@ -24,6 +26,9 @@ urlpatterns = [
     path("create_card", views.create_card, name="create_card"),
     path("logout", views.log_out, name="logout"),
     path("leaderboard-data/", views.leaderboard_data, name="leaderboard_data"),
+    path("leaderboard-data/rank/", views.leaderboard_rank,
+         name="leaderboard_rank"),
+    path("metrics/battles/", views.battle_metrics, name="battle_metrics"),
     path("recent-card-data/", views.recent_card_data, name="recent_card_data"),
     path("user/<str:user_name>/profile", views.profile, name="profile"),
     path("challenge/<int:chal_id>", views.challenge, name="challenge"),
@@ -36,6 +41,8 @@ urlpatterns = [
     path("trades/", views.global_trade_page, name="search"),
     path("trades/search/", views.get_trades_matching_query,
          name="search_results"),
+    path("trades/search/api/", views.trade_search_api,
+         name="trade_search_api"),
     path("trades/personal", views.get_personal_trades, name="personal"),
     path("trades/create/<str:card_name>/",
          views.make_trade_page, name="create"),
@@ -5,27 +5,37 @@ and administrative functions.
 """
 
 import random
-import sys
 import datetime
 import json
 import uuid
-from io import BytesIO
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.http import HttpResponse, Http404
+from django.http import (HttpResponse, Http404, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect, render
 
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator
+from django.db.models import Exists, OuterRef
 from django.db import IntegrityError, transaction
 from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
 from django.contrib import messages
 from django.urls import reverse
-from image_gen import make_image
+from django.utils.cache import patch_cache_control
 from .models import Card, UserProfile, Challenge, Question, Trade
+from .instrumentation import metrics
+from .leaderboard import leaderboard
+from .marketplace import search_trades
+from .points import award_points
+from .ownership import owns
+from .rendering import store_upload
+from . import settlement
+from .trade_matching import match
+from .trade_notifications import CANCELLED, CREATED, notify
+from .render_queue import enqueue
 from .forms import UserCreationForm2
 
 
@@ -49,6 +59,33 @@ def collection_redirect(request):
     )
 
 
+# How many cards the collection page and its data endpoint show at once
+COLLECTION_PAGE_SIZE = 60
+# Players listed at a time when choosing who to trade with
+TRADE_RECIPIENTS_PAGE_SIZE = 50
+# Trades shown at a time in each list on the personal trades page
+INBOX_PAGE_SIZE = 20
+INBOX_TRADE_FIELDS = (
+    "id", "created_date", "sender__username", "recipient__username",
+    "offered_card__card_name", "offered_card__card_image_link",
+    "requested_card__card_name", "requested_card__card_image_link")
+
+
+def collection_cards(profile):
+    """
+    Returns every card, annotated with whether profile owns it, with owned
+    cards first. Ownership is worked out by the database, and only the
+    columns the collection needs are selected.
+    """
+    owned = UserProfile.user_profile_collected_cards.through.objects.filter(
+        userprofile_id=profile.pk, card_id=OuterRef("pk"))
+    return (Card.objects
+            .only("card_name", "card_description", "card_image_link",
+                  "card_render_key")
+            .annotate(owned=Exists(owned))
+            .order_by("-owned", "card_name"))
+
+
 def card_col(request, user_name):
     """
     Displays a user's card collection.
@@ -63,40 +100,80 @@ def card_col(request, user_name):
         Rendered template with user's card images or failure message.
         Seperates cards into either being owned or not
         owned by the user and sends each cards information to the template.
+        Cards are shown a page at a time, owned cards first.
     """
     try:
-        imgs_has = []
-        imgs_not = []
-        card_titleshas = []
-        card_titlenot = []
-        card_descriptionshas = []
         u = UserProfile.objects.get(user__username=user_name)
-        for i in u.user_profile_collected_cards.all():
-            imgs_has.append(i.card_image_link)
-            card_titleshas.append(i.card_name)
-            card_descriptionshas.append(i.card_description)
-        for j in Card.objects.all():
-            imgs_not.append(j.card_image_link)
-            card_titlenot.append(j.card_name)
-        imgs_not = list(filter(lambda x: x not in imgs_has, imgs_not))
-        card_titlenot = list(filter(lambda x: x not in card_titleshas,
-                                    card_titlenot))
-
-        cards_has = [{"image": img, "title": title, "description": description}
-                     for img, title, description in
-                     zip(imgs_has, card_titleshas,
-                         card_descriptionshas)]
-        cards_not = [{"image": img, "title": title}
-                     for img, title in zip(imgs_not, card_titlenot)]
-        print(cards_has)
-        print(cards_not)
+        page = Paginator(collection_cards(u), COLLECTION_PAGE_SIZE)\
+            .get_page(request.GET.get("page"))
+
+        cards_has = []
+        cards_not = []
+        for card in page:
+            d = {"image": card.card_image_link, "title": card.card_name,
+                 "sources": card.image_sources()}
+            if card.owned:
+                d["description"] = card.card_description
+                cards_has.append(d)
+            else:
+                cards_not.append(d)
         return render(request, "cardgame/card_col.html",
-                      {"cardshas": cards_has, "cardsnot": cards_not})
+                      {"cardshas": cards_has, "cardsnot": cards_not,
+                       "page": page})
 
     except ObjectDoesNotExist:
         # if user does not exist
         raise Http404()
-    return HttpResponse("fail")  # change this later!
+
+
+def card_col_data(request, user_name):
+    """
+    Streams a page of a user's card collection as JSON.
+
+    Args:
+        request: HTTP request object. ?page= picks the page and ?owned=1
+            or ?owned=0 only lists owned or unowned cards.
+        user_name: Username whose collection to list
+
+    Returns:
+        A streamed JSON object with the page number, whether there is a
+        next page, and the cards on the page.
+    """
+    try:
+        u = UserProfile.objects.get(user__username=user_name)
+    except ObjectDoesNotExist:
+        raise Http404()
+    cards = collection_cards(u)
+    if request.GET.get("owned") in ("0", "1"):
+        cards = cards.filter(owned=request.GET["owned"] == "1")
+    try:
+        number = max(1, int(request.GET.get("page", 1)))
+    except ValueError:
+        number = 1
+    # One extra row tells us whether there is a next page without
+    # having to count the whole catalogue.
+    start = (number - 1) * COLLECTION_PAGE_SIZE
+    rows = cards[start:start + COLLECTION_PAGE_SIZE + 1]
+
+    def stream():
+        yield '{"page": %d, "cards": [' % number
+        count = 0
+        has_next = False
+        for card in rows.iterator():
+            if count == COLLECTION_PAGE_SIZE:
+                has_next = True
+                break
+            yield ("," if count else "") + json.dumps({
+                "name": card.card_name,
+                "owned": card.owned,
+                "description": card.card_description if card.owned else None,
+                "image": card.image_url("thumb"),
+                "image_srcset": card.image_srcset(),
+            })
+            count += 1
+        yield '], "has_next": %s}' % json.dumps(has_next)
+
+    return StreamingHttpResponse(stream(), content_type="application/json")
 
 
 def recent_card_data(request):
@@ -107,7 +184,8 @@ def recent_card_data(request):
     data = {
         "name": recent_card.card_name,
         "description": recent_card.card_description,
-        "image": recent_card.card_image_link.url,
+        "image": recent_card.image_url("medium"),
+        "image_srcset": recent_card.image_srcset(),
     }
 
     return JsonResponse(data)
@@ -202,42 +280,26 @@ def create_card(request):
             return HttpResponse("Missing required parameters", status=400)
 
         try:
-
-            # Generates card image with given script.
-            c = make_image(
-                "staticfiles/card_gen/back.png",
-                card_name,
-                card_description,
-                card_image,
-                card_env,
-                card_beauty,
-                card_cost,
-            )
-
-            c_io = BytesIO()
-            c.save(c_io, format="PNG")
-            # We have to convert from a PIL image to a DJANGO image
-            django_file = InMemoryUploadedFile(
-                c_io,
-                None,
-                str(card_name).replace(" ", "_") + ".png",
-                "image/png",
-                sys.getsizeof(c_io),
-                None,
-            )
-
-            # Creates the card object and saves to database
-            card = Card.objects.create(
-                card_name=card_name,
-                card_subtitle=card_subtitle,
-                card_description=card_description,
-                card_image_link=django_file,
-                environmental_friendliness=card_env,
-                beauty=card_beauty,
-                cost=card_cost,
-            )
-            card.save()
-
+            # Keeps the uploaded picture; the card shows the placeholder
+            # image until the render queue has rendered it.
+            source = store_upload(card_image)[0] if card_image else ""
+            with transaction.atomic():
+                card = Card.objects.create(
+                    card_name=card_name,
+                    card_subtitle=card_subtitle,
+                    card_description=card_description,
+                    card_source_image=source,
+                    environmental_friendliness=card_env,
+                    beauty=card_beauty,
+                    cost=card_cost,
+                )
+                if source:
+                    enqueue(card)
+
+            if source:
+                return HttpResponse("Card created successfully! "
+                                    "Its image is being rendered.",
+                                    status=202)
             return HttpResponse("Card created successfully!")
 
         # catches errors such as non-unique primary key
@@ -297,15 +359,51 @@ def leaderboard_data(request):
         The required leaderboard data
     """
 
-    top_players = UserProfile.objects.order_by("-user_profile_points")[
-        :5
-    ]  # Retrieves Top 5 Players
-    data = [
-        {"username": player.user.username,
-         "points": player.user_profile_points}
-        for player in top_players
-    ]
-    return JsonResponse(data, safe=False)  # Returns JSON response to template
+    # The leaderboard keeps the top 5 players encoded, along with an ETag,
+    # so polls that find nothing has changed get an empty 304.
+    body, tag = leaderboard.top_json()
+    if tag in request.headers.get("If-None-Match", ""):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = f'"{tag}"'
+    # Makes browsers check back with the ETag instead of reusing old data
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+@login_required
+def leaderboard_rank(request):
+    """
+    Returns the logged in user's points and rank on the leaderboard.
+
+    Args:
+        request: HTTP request object
+
+    Returns:
+        JSON with the username, points, rank and number of players
+    """
+    up = UserProfile.objects.get(user=request.user)
+    return JsonResponse({"username": request.user.username,
+                         "points": up.user_profile_points,
+                         "rank": leaderboard.rank(up),
+                         "players": len(leaderboard)})
+
+
+@staff_member_required
+def battle_metrics(request):
+    """
+    Returns the histograms of how long each battle handler takes, how
+    long it waits on the database and how many queries it makes, in
+    this process (see cardgame.instrumentation).
+
+    Args:
+        request: HTTP request object
+
+    Returns:
+        JSON keyed by handler name
+    """
+    return JsonResponse(metrics.as_dict())
 
 
 @login_required
@@ -395,46 +493,35 @@ def challenges(request):
     details of all active challenges as context
     """
 
-    try:
-        ctime = datetime.datetime.now()
-        upc = UserProfile.objects.get(user=request.user)\
-            .user_profile_collected_cards
-        #     return render(request, "cardgame/home.html")
-        # Filters all challenges that are ongoing
-        challenges = Challenge.objects.filter(
-            start_time__lte=ctime, end_time__gte=ctime
-        )
-        chals = []
-        available = False
-        # checks if there are challenges available, needed to prevent fails
-        if challenges.count != 0:
-            available: bool = True
-            for c in challenges:
-                # verifies that the user doesn't already
-                # have the associated card
-                if c.card not in upc.all():
-                    d = {
-                        "longitude": c.longitude,
-                        "latitude": c.latitude,
-                        "start": c.start_time,
-                        "end": c.end_time,
-                        "card_name": c.card.card_name,
-                        "points": c.points_reward,
-                        "desc": c.description,
-                        "image_link": c.card.card_image_link,
-                        "id": c.id,
-                    }  # dict with all relevant properties
-                    chals.append(d)
-
-        # renders the template
-        return render(
-            request,
-            "cardgame/challenges.html",
-            {"challenges": chals, "open_chals": available},
-        )
-
-    except ObjectDoesNotExist:
-        raise Http404()
+    ctime = datetime.datetime.now()
+    # Filters all challenges that are ongoing, leaving out the ones whose
+    # card the user already has, in a single query
+    challenges = (
+        Challenge.objects.filter(start_time__lte=ctime, end_time__gte=ctime)
+        .exclude(card__userprofile__user=request.user)
+        .select_related("card")
+    )
+    chals = []
+    for c in challenges:
+        d = {
+            "longitude": c.longitude,
+            "latitude": c.latitude,
+            "start": c.start_time,
+            "end": c.end_time,
+            "card_name": c.card.card_name,
+            "points": c.points_reward,
+            "desc": c.description,
+            "image_link": c.card.card_image_link,
+            "id": c.id,
+        }  # dict with all relevant properties
+        chals.append(d)
+
+    # renders the template
+    return render(
+        request,
+        "cardgame/challenges.html",
+        {"challenges": chals, "open_chals": bool(chals)},
+    )
 
 
 @login_required
@@ -456,9 +543,10 @@ def challenge(request, chal_id):
         try:
             # checks that the user doesn't already have the card
             user = request.user
-            up = UserProfile.objects.get(user=user)
-            chal = Challenge.objects.get(id=chal_id)
-            if chal.card in up.user_profile_collected_cards.all():
+            up = UserProfile.objects.select_related("collection_bitmap")\
+                .get(user=user)
+            chal = Challenge.objects.select_related("card").get(id=chal_id)
+            if owns(up, chal.card):
                 return HttpResponse("sorry, you already have this card!")
 
             # gets challenge information
@@ -519,18 +607,15 @@ def add_card(request, chal_id):
     # gets the user
     u = request.user
     # gets the user profile
-    up = UserProfile.objects.get(user=u)
+    up = UserProfile.objects.select_related("collection_bitmap").get(user=u)
     # gives the user the card
-    if not (up.user_profile_collected_cards
-            .filter(card_name=card.card_name).exists()):
+    if not owns(up, card):
 
         up.user_profile_collected_cards.add(card)
         # Gives the user the points for the card
-        up.user_profile_points = up.user_profile_points + c.points_reward
-        up.user_most_recent_card = card.card_name
-        up.user_most_recent_card_date = datetime.datetime.now()
-
-        up.save()
+        award_points(up, c.points_reward,
+                     user_most_recent_card=card.card_name,
+                     user_most_recent_card_date=datetime.datetime.now())
 
     return HttpResponse(request)
 
@@ -591,8 +676,10 @@ def get_battle_cards(request):
                     "name": card.card_name,
                     "subtitle": card.card_subtitle,
                     "description": card.card_description,
-                    "image": card.card_image_link.url if card.card_image_link
+                    "image": card.image_url("thumb") if card.card_image_link
                     else None,
+                    "image_srcset": card.image_srcset()
+                    if card.card_image_link else None,
                     "environmental_friendliness": (
                         card.environmental_friendliness
                         if hasattr(card, "environmental_friendliness")
@@ -633,128 +720,108 @@ def global_trade_page(request):
     return render(request, "cardgame/search.html")
 
 
+def trade_search_params(request):
+    """The search_trades arguments given in request's query string."""
+    return {"offered": request.GET.get("in_card"),
+            "requested": request.GET.get("out_card"),
+            "fulfillable": bool(request.GET.get("fulfillable")),
+            "after": request.GET.get("after")}
+
+
 @login_required
 def get_trades_matching_query(request):
-    if request.method == 'GET':
-        try:
-            # We expect some variety of form here
-            # not sure how the form is going to pass the values
-            # so i'm just going to write down this and hope it works
-            # this probably doesn't work
-            # basic filter for now, can change later
-            out_card = request.GET.get("out_card")
-            in_card = request.GET.get("in_card")
-            trades = Trade.objects.all().filter(recipient=None).\
-                exclude(sender=request.user)
-            if (request.GET.get("out_card") != ''):
-                trades = trades.filter(requested_card__card_name=out_card)
-            if (request.GET.get("in_card") != ''):
-                trades = trades.filter(offered_card__card_name=in_card)
-            if trades.count() == 0:
-                messages.error(request,
-                               "No trades available with these conditions!")
-                return redirect(request.META['HTTP_REFERER'])
-            t = []
-            for tr in trades:
-                data = {}
-                data['id'] = tr.id
-                data['sender'] = tr.sender.username
-                data['date'] = tr.created_date
-                data['offered_card'] = tr.offered_card.card_name
-                data['offered_card_image'] = tr.offered_card.card_image_link
-                data['requested_card'] = tr.requested_card.card_name
-                data['requested_card_image'] = tr.requested_card.\
-                    card_image_link
-                t.append(data)
-            return render(request, "cardgame/search_results.html", {'data': t})
-        except ObjectDoesNotExist:
-            return HttpResponse("why don't you try hard?")
+    """
+    Renders a page of the public trades matching the search form: the
+    card wanted (in_card), the card to give in exchange (out_card) and
+    whether to only show trades the user can accept (fulfillable).
+    Further pages are reached with the after cursor in the Next link.
+    """
+    params = trade_search_params(request)
+    try:
+        trades, cursor = search_trades(request.user, **params)
+    except ValueError:
+        return HttpResponse("Invalid page", status=400)
+    if not trades and not params["after"]:
+        messages.error(request,
+                       "No trades available with these conditions!")
+        return redirect(request.META.get('HTTP_REFERER', reverse("search")))
+
+    next_page = None
+    if cursor:
+        query = request.GET.copy()
+        query["after"] = cursor
+        next_page = query.urlencode()
+    return render(request, "cardgame/search_results.html",
+                  {'data': trades, 'next_page': next_page})
+
+
+@login_required
+def trade_search_api(request):
+    """
+    Returns a page of the public trades as JSON, taking the same query
+    string as get_trades_matching_query.
+
+    Returns:
+        JSON with the trades and the cursor of the next page (or null),
+        to pass back as ?after=
+    """
+    try:
+        trades, cursor = search_trades(request.user,
+                                       **trade_search_params(request))
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+    return JsonResponse({
+        "trades": [{
+            "id": trade.id,
+            "sender": trade.sender.username,
+            "date": trade.created_date.isoformat(),
+            "offered_card": {"name": trade.offered_card.card_name,
+                             "image": trade.offered_card.image_url("thumb")},
+            "requested_card": {
+                "name": trade.requested_card.card_name,
+                "image": trade.requested_card.image_url("thumb")},
+        } for trade in trades],
+        "next": cursor,
+    })
 
 
 @login_required
 def get_personal_trades(request):
-    u = request.user
-    print(u)
-    incoming = Trade.objects.filter(recipient=u)
-    inc = []
-    out = []
-    for tr in incoming:
-        data = {}
-        data['id'] = tr.id
-        data['sender'] = tr.sender.username
-        data['c_date'] = tr.created_date
-        data['incoming_card'] = tr.offered_card.card_name
-        data['incoming_card_image'] = tr.offered_card.card_image_link
-        data['requested_card'] = tr.requested_card.card_name
-        data['requested_card_image'] = tr.requested_card.card_image_link
-        inc.append(data)
-    outgoing = Trade.objects.filter(sender=u)
-    print(outgoing)
-    for trd in outgoing:
-        data_out = {}
-        if trd.recipient:
-            data_out['recipient'] = trd.recipient.username
-        else:
-            data_out['recipient'] = "public"
-        data_out['id'] = trd.id
-        data_out['sender'] = trd.sender.username
-        data_out['c_date'] = trd.created_date
-        data_out['incoming_card'] = trd.offered_card.card_name
-        data_out['incoming_card_image'] = trd.offered_card.card_image_link
-        data_out['requested_card'] = trd.requested_card.card_name
-        data_out['requested_card_image'] = trd.requested_card.card_image_link
-        out.append(data_out)
+    """
+    Renders the trades made to and by the user, newest first, a page of
+    each at a time (?incoming= and ?outgoing= choose the pages). Each
+    list is one query with its users and cards joined, plus its count.
+    """
+    trades = Trade.objects\
+        .select_related("sender", "recipient", "offered_card",
+                        "requested_card")\
+        .only(*INBOX_TRADE_FIELDS)\
+        .order_by("-created_date", "-id")
+    incoming = Paginator(trades.filter(recipient=request.user),
+                         INBOX_PAGE_SIZE)\
+        .get_page(request.GET.get("incoming"))
+    outgoing = Paginator(trades.filter(sender=request.user),
+                         INBOX_PAGE_SIZE)\
+        .get_page(request.GET.get("outgoing"))
 
     return render(request, "cardgame/personal_trades.html",
-                  {'incoming': inc, 'outgoing': out})
+                  {'incoming': incoming, 'outgoing': outgoing})
 
 
 @login_required
-@transaction.atomic
 def accept_trade(request, t_id):
-    # Validate that the user can access the trade
-    user = request.user
+    """
+    Completes trade t_id for the user accepting it. The trade and both
+    players' profiles are locked while their cards are checked and
+    swapped, so the same trade can't be accepted twice (see
+    cardgame.settlement).
+    """
     try:
-        trade = Trade.objects.get(id=t_id)
-    except ObjectDoesNotExist:
-        return Http404()
-
-    if (trade.recipient is not None and trade.recipient != user):
-        messages.error(request, "You can't make this trade!")
-        return redirect(request.META['HTTP_REFERER'])
-
-    # Now we verify that both players have the cards they need
-    sender_profile = UserProfile.objects.get(user=trade.sender)
-    recipient_profile = UserProfile.objects.get(user=user)
-    requested_card = trade.requested_card
-    offered_card = trade.offered_card
-
-    if not (sender_profile.user_profile_collected_cards
-            .filter(card_name=offered_card.card_name).exists()
-            and recipient_profile.user_profile_collected_cards.
-            filter(card_name=requested_card.card_name).exists()):
-
-        messages.error(request, "You can't make this trade,\n\
-            as either you or the sender doesn't have the right card!")
-        return redirect(request.META['HTTP_REFERER'])
-    if (sender_profile.user_profile_collected_cards
-            .filter(card_name=requested_card.card_name).exists()
-            or recipient_profile.user_profile_collected_cards.
-            filter(card_name=offered_card.card_name)):
-
-        messages.error(request, "You can't make this trade,\n\
-                       as either you or the sender already has the card!")
-        return redirect(request.META['HTTP_REFERER'])
-
-    # Now we can proceed with the trade
-    # TODO: make this atomic or something
-    sender_profile.user_profile_collected_cards.add(requested_card)
-    recipient_profile.user_profile_collected_cards.add(offered_card)
-    sender_profile.user_profile_collected_cards.remove(offered_card)
-    recipient_profile.user_profile_collected_cards.remove(requested_card)
-    Trade.objects.get(id=t_id).delete()
+        settlement.accept_trade(t_id, request.user)
+    except settlement.SettlementError as e:
+        messages.error(request, str(e))
+        return redirect(request.META.get("HTTP_REFERER", reverse("personal")))
     return HttpResponse("trade completed successfully!")
-    # there is no way this works but that's life
 
 
 @login_required
@@ -770,6 +837,7 @@ def cancel_trade(request, t_id):
             return render(request, "cardgame/personal_trades.html")
         # actually cancels the trade
         Trade.objects.get(id=t_id).delete()
+        notify(CANCELLED, trade, actor=user)
         return HttpResponse("success!")
 
     except ObjectDoesNotExist:
@@ -813,30 +881,33 @@ def trade_page(request, t_id):
 
 @login_required
 def make_trade_page(request, card_name):
-    titles = []
-    names = []
-    user = UserProfile.objects.get(user=request.user)
-    requested_card = Card.objects.get(card_name=card_name)
-    ownedCards = user.user_profile_collected_cards.all()
-    all_users = User.objects.all()
-    eligible_users = []
-    for user in all_users:
-        if UserProfile.objects.get(user=user).\
-                user_profile_collected_cards.\
-                filter(card_name=requested_card.card_name).exists():
-
-            eligible_users.append(user)
-
-    for user in eligible_users:
-        if user != request.user:
-            names.append(user.username)
+    """
+    Renders the page for offering one of the user's cards for
+    card_name, either to anyone or to a player who owns card_name.
 
-    for card in ownedCards:
-        titles.append(card.card_name)
+    The players to choose from are a page of the owners of card_name,
+    optionally only those whose username starts with ?q=. They come
+    from one query on the collection table, so the page takes the same
+    number of queries however many players there are.
+    """
+    requested_card = Card.objects.get(card_name=card_name)
+    titles = Card.objects.filter(userprofile__user=request.user)\
+        .values_list("card_name", flat=True)
+    owners = User.objects.filter(
+        userprofile__user_profile_collected_cards=requested_card)\
+        .exclude(pk=request.user.pk).order_by("username")
+    query = request.GET.get("q", "").strip()
+    if query:
+        owners = owners.filter(username__istartswith=query)
+    page = Paginator(owners.values_list("username", flat=True),
+                     TRADE_RECIPIENTS_PAGE_SIZE)\
+        .get_page(request.GET.get("page"))
 
     return render(request, "cardgame/make_trade.html",
                   {"requested_card": requested_card,
-                   "ownedCards": titles, "all_users": names})
+                   "ownedCards": titles, "all_users": page,
+                   "page": page, "query": query,
+                   "show_users": bool(query) or page.number > 1})
 
 
 @csrf_exempt
@@ -870,6 +941,13 @@ def submit_trade(request):
             )
 
             trade.save()
+            # Public trades are settled straight away if other open
+            # trades complete them
+            if match(trade):
+                messages.success(request, "Your trade was matched with "
+                                 "another and has been completed!")
+                return HttpResponse("trade completed successfully!")
+            notify(CREATED, trade, actor=user)
             return HttpResponse(200)
             # return render(request, "cardgame/personal_trades.html")
         except ObjectDoesNotExist:
@@ -17,6 +17,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cards.settings')
 # Get the ASGI application first
 django_asgi_app = get_asgi_application()
 
+# Start this process's card render worker, which also picks up renders
+# queued or interrupted before a restart (see cardgame.render_queue)
+from cardgame.render_queue import wake_worker
+wake_worker()
+
 # Then import the channel components after the Django app is loaded
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
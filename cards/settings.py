@@ -77,11 +77,28 @@ WSGI_APPLICATION = "cards.wsgi.application"
 ASGI_APPLICATION = "cards.asgi.application"
 
 # Channel layers for websockets
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
+# The in-memory layer only works with a single worker process. Set
+# CHANNEL_LAYER=sqlite to share messages between the workers on this host
+# (see cardgame/channel_layers.py).
+# The matchmaking queue is not shared: it lives in each worker's memory,
+# so players waiting in different workers are never paired. Run a single
+# worker where matchmaking is used (see cardgame/matchmaking.py).
+if os.environ.get("CHANNEL_LAYER", "memory") == "sqlite":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "cardgame.channel_layers.SQLiteChannelLayer",
+            "CONFIG": {
+                "path": os.environ.get("CHANNEL_LAYER_PATH",
+                                       BASE_DIR / "channels.sqlite3"),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
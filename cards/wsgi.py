@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cards.settings')
 
 application = get_wsgi_application()
+
+# Start this process's card render worker, which also picks up renders
+# queued or interrupted before a restart (see cardgame.render_queue)
+from cardgame.render_queue import wake_worker
+wake_worker()
@@ -5,9 +5,88 @@ If you change them, the cards will look completely different.
 Proceed with the utmost caution!
 
 """
+import os
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from io import BytesIO
 from PIL import Image, ImageFont, ImageDraw
-from pathlib import Path
-from copy import deepcopy
+from text_layout import fit_text, draw_lines
+
+# Bump this whenever the card layout changes, so cached renders are redone.
+TEMPLATE_VERSION = 2
+CARD_SIZE = (1200, 1600)
+BACKGROUND = "static/card_gen/back.png"
+TITLE_FONT = "static/card_gen/font/Kanit-Bold.ttf"
+DESC_FONT = "static/card_gen/font/Kanit-Regular.ttf"
+DESC_SIZE = 50
+# x, y, width and height of the description box, between the picture
+# and the stats.
+DESC_BOX = (160, 860, 860, 330)
+# Smaller copies of each card for pages that show it as a tile.
+DERIVATIVE_SIZES = {"thumb": (300, 400), "medium": (600, 800)}
+
+
+class AssetCache:
+    """
+    Process-wide cache for the assets every card render needs:
+    the resized background template and the loaded fonts.
+
+    Entries are keyed by path (plus size) and remember the file's mtime,
+    so replacing a template or font on disk is picked up on the next call.
+    hits/misses let you check the cache is actually being used.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, path, loader):
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                return entry[1]
+        value = loader()
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (mtime, value)
+        return value
+
+    def background(self, path, size=CARD_SIZE):
+        """
+        Returns a copy of the background at path, resized to size.
+        A copy is handed out because callers draw on it.
+        """
+        def load():
+            with Image.open(path) as im:
+                return im.resize(size)
+
+        return self._get(("background", str(path), size), path, load).copy()
+
+    def font(self, path, size):
+        """Returns the FreeType font at path with the given point size."""
+        return self._get(("font", str(path), size), path,
+                         lambda: ImageFont.truetype(str(path), size))
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+asset_cache = AssetCache()
+
 
 def make_image(background:str, title:str, desc:str, image, env:float, beauty:float, cost:float):
 
@@ -30,9 +109,8 @@ def make_image(background:str, title:str, desc:str, image, env:float, beauty:flo
     """
 
     try:
-        #Opens and resizes the background image.
-        back = Image.open(background)
-        back = back.resize((1200,1600))
+        #Gets the resized background image from the asset cache.
+        back = asset_cache.background(background)
         front = Image.open(image)
     except FileNotFoundError:
         print("Card image could not be generated.")
@@ -43,45 +121,117 @@ def make_image(background:str, title:str, desc:str, image, env:float, beauty:flo
     Image.Image.paste(back,front, (156,210))
     draw = ImageDraw.Draw(back)
 
-    title_font = ImageFont.truetype("static/card_gen/font/Kanit-Bold.ttf", 84)
-    stat_font = ImageFont.truetype("static/card_gen/font/Kanit-Bold.ttf", 84)
-    desc_font = ImageFont.truetype("static/card_gen/font/Kanit-Regular.ttf", 50)
+    title_font = asset_cache.font(TITLE_FONT, 84)
+    stat_font = asset_cache.font(TITLE_FONT, 84)
 
     stat_line = "Impact: "+str(env) + "\nCost: "+str(cost) + "\nBeauty: "+str(beauty)
     draw.text((160,72), title, font=title_font, fill=(255,255,255)) #adds title
 
     #Turns out there's no nice way to draw text across multiple lines.
-    #We just have to separate the text into several lines and write each line.
-    #In terms of font size and line length we just have to guess and check.
-
-    MAX_CHARS:int = 32   #Defines how many chars we can have in a line before we wrap around.
-    count:int = 0
-    count_since:int = 0
-    positions = []   #Stores positions at which we need to have a newline char.
-    des_mod:str = ""
-
-    for i in range(0,len(desc)):
-        if desc[i] == " ":
-            if count > MAX_CHARS:
-                positions.append(i - count_since - 1)
-                count = deepcopy(count_since)
-            else:
-                count += 1
-            count_since = 0
-        else:
-            count += 1
-            count_since += 1
-
-    #Rewrites string but with newlines instead of spaces where required.
-    for i in range(0,len(desc)):
-        if i in positions:
-            des_mod += "\n"
-        else:
-            des_mod += desc[i]
-        
+    #text_layout wraps the description to the width of the description box,
+    #shrinking the font until it fits the height of the box as well.
+    desc_font, desc_lines = fit_text(
+        desc, lambda size: asset_cache.font(DESC_FONT, size),
+        DESC_BOX[2], DESC_BOX[3], DESC_SIZE)
+
     #Writes description onto the card.
-    draw.multiline_text((160,860), des_mod, font=desc_font, fill=(0,0,0))
+    draw_lines(draw, DESC_BOX[:2], desc_lines, desc_font, (0,0,0))
     draw.text((160,1200), stat_line, font=stat_font, fill=(0,0,0))
     #Returns the generated image.
-    return back    
+    return back
+
+
+# Everything a worker process needs to render one card. image holds the raw
+# bytes of the source picture so specs can be pickled across processes.
+CardSpec = namedtuple("CardSpec",
+                      ["key", "title", "desc", "image",
+                       "env", "beauty", "cost"])
+
+# png is None and error is set when the card could not be rendered.
+# derivatives maps (size name, format) to the encoded bytes.
+RenderResult = namedtuple("RenderResult",
+                          ["key", "png", "derivatives", "seconds", "error"])
+
+
+def render_png(background, spec):
+    """
+    Renders a single CardSpec and returns the encoded PNG as bytes.
+    Raises FileNotFoundError if the background or source image is missing.
+    """
+    image = spec.image
+    if isinstance(image, bytes):
+        image = BytesIO(image)
+    card = make_image(background, spec.title, spec.desc, image,
+                      spec.env, spec.beauty, spec.cost)
+    if card == 1:
+        raise FileNotFoundError(f"could not render card {spec.key!r}")
+    out = BytesIO()
+    card.save(out, format="PNG")
+    return out.getvalue()
+
+
+def encode_derivatives(png, formats=("webp",), sizes=DERIVATIVE_SIZES):
+    """
+    Scales a rendered card down to each of sizes and encodes it in each of
+    formats (any format PIL can write, e.g. "webp" or "avif").
+
+    Returns:
+        a dict mapping (size name, format) to the encoded bytes
+    """
+    out = {}
+    with Image.open(BytesIO(png)) as card:
+        card.load()
+        for name, size in sizes.items():
+            small = card.resize(size, Image.LANCZOS)
+            for fmt in formats:
+                buf = BytesIO()
+                small.save(buf, format=fmt.upper(), quality=80)
+                out[(name, fmt)] = buf.getvalue()
+    return out
+
+
+def _render_job(background, spec, formats):
+    start = time.perf_counter()
+    try:
+        png, error = render_png(background, spec), None
+        derivatives = encode_derivatives(png, formats) if formats else {}
+    except Exception as e:
+        png, derivatives, error = None, {}, str(e)
+    return RenderResult(spec.key, png, derivatives,
+                        time.perf_counter() - start, error)
+
+
+def render_cards(cards, workers=None, background=BACKGROUND, formats=()):
+    """
+    Renders many cards in parallel on a process pool.
+
+    Args:
+        cards: an iterable of CardSpec
+        workers: number of worker processes, defaults to the CPU count.
+            workers=1 renders in this process, which is handy for debugging.
+        background: path to the card template
+        formats: formats to encode the smaller derivatives in, if any
+
+    Yields:
+        a RenderResult per card, in completion order, as soon as it is done.
+        Only a couple of cards per worker are in flight at once so that a
+        large deck does not have to sit in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for spec in cards:
+            yield _render_job(background, spec, formats)
+        return
 
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = workers * 2
+        pending = set()
+        for spec in cards:
+            pending.add(pool.submit(_render_job, background, spec,
+                                    formats))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in wait(pending).done:
+            yield future.result()
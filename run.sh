@@ -1 +1,9 @@
-../bin/python -m uvicorn cards.asgi:application
+# WORKERS=4 ./run.sh runs several worker processes behind one port; they
+# then share websocket messages through the SQLite channel layer.
+# Matchmaking needs a single worker: each worker has its own queue, so
+# players waiting in different workers are never paired.
+WORKERS=${WORKERS:-1}
+if [ "$WORKERS" -gt 1 ]; then
+    export CHANNEL_LAYER=${CHANNEL_LAYER:-sqlite}
+fi
+../bin/python -m uvicorn cards.asgi:application --workers "$WORKERS"
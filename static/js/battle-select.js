@@ -2,6 +2,46 @@ document.addEventListener('DOMContentLoaded', () => {
     const createBattleBtn = document.getElementById('create-battle');
     const joinBattleBtn = document.getElementById('join-battle');
     const roomIdInput = document.getElementById('room-id');
+    const findBattleBtn = document.getElementById('find-battle');
+    const matchmakingStatus = document.getElementById('matchmaking-status');
+    let matchmakingSocket = null;
+
+    findBattleBtn.addEventListener('click', () => {
+        if (matchmakingSocket) {
+            // Clicking again leaves the queue
+            matchmakingSocket.close();
+            return;
+        }
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        matchmakingSocket = new WebSocket(`${protocol}//${window.location.host}/ws/matchmaking/`);
+        findBattleBtn.textContent = 'Cancel';
+        matchmakingStatus.textContent = 'Looking for an opponent...';
+
+        matchmakingSocket.onmessage = (e) => {
+            const data = JSON.parse(e.data);
+            switch (data.event) {
+                case 'queued':
+                    matchmakingStatus.textContent = `Waiting for an opponent (${data.waiting} in queue)...`;
+                    break;
+                case 'match_found':
+                    matchmakingStatus.textContent = `Matched with ${data.opponent_name}!`;
+                    window.location.href = `/battle/${data.room_id}/`;
+                    break;
+                case 'error':
+                    matchmakingStatus.textContent = data.message;
+                    break;
+            }
+        };
+
+        matchmakingSocket.onclose = () => {
+            matchmakingSocket = null;
+            findBattleBtn.textContent = 'Find Opponent';
+            if (matchmakingStatus.textContent.startsWith('Waiting') ||
+                matchmakingStatus.textContent.startsWith('Looking')) {
+                matchmakingStatus.textContent = '';
+            }
+        };
+    });
 
     createBattleBtn.addEventListener('click', () => {
         window.location.href = '/battle/';
@@ -4,6 +4,9 @@ let gameState = "waiting";
 let isMyTurn = false;
 let currentRound = 1;
 let isPlayer1 = true;
+// Events arrive as JSON text, or as UTF-8 JSON bytes when the server
+// supports the faster battle.orjson encoding.
+const eventDecoder = new TextDecoder();
 
 // Connect to WebSocket
 function connect() {
@@ -16,7 +19,9 @@ function connect() {
             return;
         }
         
-        socket = new WebSocket(`${protocol}//${host}/ws/battle/${roomId}/`);
+        socket = new WebSocket(`${protocol}//${host}/ws/battle/${roomId}/`,
+                               ['battle.orjson', 'battle.json']);
+        socket.binaryType = 'arraybuffer';
         
         socket.addEventListener('open', () => {
             logMessage('Connected to battle server!');
@@ -26,7 +31,8 @@ function connect() {
         
         socket.addEventListener('message', (event) => {
             try {
-                const data = JSON.parse(event.data);
+                const data = JSON.parse(typeof event.data === 'string' ?
+                    event.data : eventDecoder.decode(event.data));
                 console.log('Received message:', data);
                 handleMessage(data);
             } catch (e) {
@@ -57,6 +63,11 @@ function handleMessage(data) {
     console.log("Received message:", data);
     
     switch(data.event) {
+        case 'batch':
+            // Several events sent together, in order
+            data.events.forEach(handleMessage);
+            break;
+
         case 'battle_created':
             logMessage('Battle room created. Waiting for opponent...');
             gameState = data.status || "waiting";
@@ -257,11 +268,13 @@ function createCardElement(card, showStats = false) {
     
     // Use a default image if none provided
     const imageSrc = card.image || '/static/img/card_placeholder.png';
+    // Lets the browser pick the smallest copy of the card that fits
+    const srcset = card.image_srcset ? `srcset="${card.image_srcset}" sizes="180px"` : '';
     
     el.innerHTML = `
         <h3>${card.name || 'Unknown Card'}</h3>
         <div class="card-image">
-            <img src="${imageSrc}" alt="${card.name || 'Card'}" onerror="this.src='/static/img/card_placeholder.png'">
+            <img src="${imageSrc}" ${srcset} alt="${card.name || 'Card'}" onerror="this.removeAttribute('srcset'); this.src='/static/img/card_placeholder.png'">
         </div>
         ${showStats ? createStatsHTML(card) : ''}
     `;
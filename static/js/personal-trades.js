@@ -0,0 +1,81 @@
+document.addEventListener('DOMContentLoaded', () => {
+    const notice = document.getElementById('trade-notice');
+    const incoming = document.getElementById('incoming-trades');
+    const incomingCount = document.getElementById('incoming-count');
+    const outgoingCount = document.getElementById('outgoing-count');
+    const buttonClasses = 'btn bg-gradient-to-r from-[#6aa243] to-[#1A281F] text-white font-[kanit] py-2 px-4 rounded hover:opacity-90 transition hover:scale-[1.05] duration-100';
+
+    function addToCount(counter, change) {
+        counter.textContent = Math.max(0, parseInt(counter.textContent, 10) + change);
+    }
+
+    function button(label, url) {
+        const btn = document.createElement('button');
+        btn.className = buttonClasses;
+        btn.textContent = label;
+        btn.addEventListener('click', () => {
+            window.location.href = url;
+        });
+        return btn;
+    }
+
+    function incomingTrade(trade) {
+        const item = document.createElement('div');
+        item.className = 'grid-item bg-neutral-200/50 rounded-xl shadow-md p-6 m-4';
+        item.dataset.tradeId = trade.id;
+        const lines = [
+            ['h2', 'text-2xl font font-[kanit] mb-2', ` Offered: ${trade.offered_card}`],
+            ['h2', 'text-2xl font font-[kanit] mb-2', ` Wanted: ${trade.requested_card}`],
+            ['p', 'text-gray-700 font-[kanit] pb-4', `Offered By: ${trade.sender}`],
+        ];
+        for (const [tag, className, text] of lines) {
+            const element = document.createElement(tag);
+            element.className = className;
+            element.textContent = text;
+            item.appendChild(element);
+        }
+        item.appendChild(button('Accept', `/trade/${trade.id}/accept`));
+        item.appendChild(document.createTextNode(' '));
+        item.appendChild(button('Decline', `/trade/${trade.id}/cancel`));
+        return item;
+    }
+
+    function removeTrade(trade) {
+        const item = document.querySelector(`[data-trade-id="${trade.id}"]`);
+        if (!item) {
+            return;
+        }
+        addToCount(item.parentElement === incoming ? incomingCount : outgoingCount, -1);
+        item.remove();
+    }
+
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${window.location.host}/ws/trades/`);
+
+    socket.onmessage = (e) => {
+        const data = JSON.parse(e.data);
+        const trade = data.trade;
+        switch (data.event) {
+            case 'trade_created':
+                incoming.prepend(incomingTrade(trade));
+                addToCount(incomingCount, 1);
+                notice.textContent = `${trade.sender} offered you ${trade.offered_card} for ${trade.requested_card}.`;
+                break;
+            case 'trade_accepted':
+                removeTrade(trade);
+                notice.textContent = `Your trade of ${trade.offered_card} for ${trade.requested_card} was accepted!`;
+                break;
+            case 'trade_matched':
+                removeTrade(trade);
+                notice.textContent = `Your trade of ${trade.offered_card} for ${trade.requested_card} was matched and completed!`;
+                break;
+            case 'trade_cancelled':
+                removeTrade(trade);
+                notice.textContent = `The trade of ${trade.offered_card} for ${trade.requested_card} was cancelled.`;
+                break;
+            case 'error':
+                notice.textContent = data.message;
+                break;
+        }
+    };
+});
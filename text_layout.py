@@ -0,0 +1,108 @@
+"""
+Text layout helpers for drawing wrapped text onto card images.
+
+PIL has no way of wrapping text, so these split text into lines that fit
+a given pixel width, measuring words with the font that will draw them.
+Layouts are memoized, since the same card text is laid out every time the
+card is rendered.
+"""
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def wrap_text(text: str, font, width: float):
+    """
+    Wraps text so that no line is wider than width pixels.
+
+    Each word is measured once, so this runs in time linear in the length
+    of the text. Existing newlines are kept, and a word that is wider than
+    a whole line on its own is broken across lines.
+
+    Args:
+        text: the text to wrap
+        font: a PIL FreeTypeFont used to measure the text
+        width: the maximum width of a line in pixels
+
+    Returns:
+        a tuple of lines
+    """
+    space = font.getlength(" ")
+    lines = []
+    for paragraph in text.split("\n"):
+        line = []
+        line_width = 0.0
+        for word in paragraph.split():
+            word_width = font.getlength(word)
+            if word_width > width:
+                # Too long for any line, so break it between characters.
+                if line:
+                    lines.append(" ".join(line))
+                    line, line_width = [], 0.0
+                *full, word = _break_word(word, font, width)
+                lines.extend(full)
+                word_width = font.getlength(word)
+            if line and line_width + space + word_width > width:
+                lines.append(" ".join(line))
+                line, line_width = [], 0.0
+            line_width += word_width + (space if line else 0)
+            line.append(word)
+        lines.append(" ".join(line))
+    return tuple(lines)
+
+
+def _break_word(word, font, width):
+    pieces = []
+    start = 0
+    piece_width = 0.0
+    for i, char in enumerate(word):
+        char_width = font.getlength(char)
+        if i > start and piece_width + char_width > width:
+            pieces.append(word[start:i])
+            start, piece_width = i, 0.0
+        piece_width += char_width
+    pieces.append(word[start:])
+    return pieces
+
+
+def line_height(font, spacing: int = 4):
+    """Returns the distance in pixels between two lines drawn in font."""
+    return font.getbbox("A")[3] + spacing
+
+
+def fit_text(text: str, load_font, width: float, height: float,
+             max_size: int, min_size: int = 20, spacing: int = 4):
+    """
+    Finds the largest font size at which text, once wrapped, fits into a
+    width x height box.
+
+    Args:
+        text: the text to lay out
+        load_font: a callable taking a point size and returning the font
+        width: the width of the box in pixels
+        height: the height of the box in pixels
+        max_size: the size to try first
+        min_size: the smallest size to try. If the text still doesn't fit,
+            it is laid out at this size anyway.
+        spacing: extra pixels between lines
+
+    Returns:
+        a (font, lines) tuple
+    """
+    size = max_size
+    while True:
+        font = load_font(size)
+        lines = wrap_text(text, font, width)
+        if size <= min_size \
+                or len(lines) * line_height(font, spacing) <= height:
+            return font, lines
+        size = max(min_size, size - 2)
+
+
+def draw_lines(draw, xy, lines, font, fill, spacing: int = 4):
+    """Draws lines one below the other, starting at xy."""
+    x, y = xy
+    step = line_height(font, spacing)
+    for line in lines:
+        draw.text((x, y), line, font=font, fill=fill)
+        y += step